@@ -1,49 +1,162 @@
-import requests
+import queue
 import logging
+import threading
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import chain
 from urllib.parse import urljoin
+from api.http_client import get_json, make_session
 
 LOGGER = logging.getLogger()
 
-def get_data(url, params=None, **kwargs):
-    data = []
-    response = requests.get(url, params=params, **kwargs).json()
+PAGE_SIZE = 10000
+# pages waiting to be consumed per worker, the producers block when the consumer is slower
+QUEUE_PAGES_PER_WORKER = 2
+DEFAULT_WORKERS = 4
 
-    if 'data' in response:
-        data.extend(response['data'])
 
-    if 'next_page_token' in response:
+def iter_pages(url, params=None, session=None, timeout=3):
+    """
+    Yields the `data` of every page following `next_page_token`, only one page is kept in memory.
+    """
+    session = session or make_session()
+    params = dict(params or {})
+    while True:
+        response = get_json(session, url, params=params, timeout=timeout)
+        yield response.get('data', [])
+        if 'next_page_token' not in response:
+            break
         params['next_page_token'] = response['next_page_token']
-        data.extend(get_data(url, params, **kwargs))
 
-    return data
+
+def get_data(url, params=None, **kwargs):
+    return list(chain.from_iterable(iter_pages(url, params, **kwargs)))
+
+
+def iter_parallel(jobs, workers=DEFAULT_WORKERS):
+    """
+    Runs the page iterators of `jobs` ({job: iterator factory}) on `workers` threads,
+    yields (job, page) in the order the pages arrive. The bounded queue keeps the memory bounded.
+    """
+    pages = queue.Queue(maxsize=workers * QUEUE_PAGES_PER_WORKER)
+    pending = queue.Queue()
+    for job in jobs.items():
+        pending.put(job)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def work():
+        while not stopped.is_set():
+            try:
+                job, make_pages = pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                for page in make_pages():
+                    if not put((job, page, None)):
+                        return
+            except Exception as error:
+                put((job, None, error))
+                return
+        put((None, done, None))
+
+    threads = [threading.Thread(target=work, daemon=True) for _ in range(min(workers, len(jobs)))]
+    for thread in threads:
+        thread.start()
+    try:
+        running = len(threads)
+        while running:
+            job, page, error = pages.get()
+            if error is not None:
+                raise error
+            if page is done:
+                running -= 1
+                continue
+            yield job, page
+    finally:
+        stopped.set()
 
 
+def time_chunks(start_time, end_time=None, chunk_days=None):
+    """
+    Splits the interval into [start, end) chunks of `chunk_days`, the last one is open (until now).
+    """
+    if start_time is None or not chunk_days:
+        return [(start_time, end_time)]
+    end = end_time or datetime.utcnow()
+    chunks = []
+    while start_time + timedelta(days=chunk_days) < end:
+        chunks.append((start_time, start_time + timedelta(days=chunk_days)))
+        start_time += timedelta(days=chunk_days)
+    chunks.append((start_time, end_time))
+
+    return chunks
+
 
 class CoinMetrics:
 
-    def __init__(self, api_key, base_url='https://api.coinmetrics.io/v4/'):
+    def __init__(self, api_key, base_url='https://api.coinmetrics.io/v4/', session=None, workers=DEFAULT_WORKERS):
         self.base_url = base_url
         self.api_key = api_key
+        self.workers = workers
+        # one keep-alive session for all the requests of the client
+        self.session = session or make_session(pool_size=workers)
 
     def timeseries(self):
         base_url = urljoin(self.base_url, 'timeseries/')
-        Timeseries = namedtuple("timeseries", ["asset_metrics"])
+        Timeseries = namedtuple("timeseries", ["asset_metrics", "iter_asset_metrics", "iter_asset_metrics_parallel"])
 
-        def asset_metrics(metrics, start_time=None, end_time=None, assets='btc', frequency='1d'):
-            params = {
+        def params(metrics, start_time=None, end_time=None, assets='btc', frequency='1d', end_inclusive=True):
+            return {
                 'api_key': self.api_key,
                 'assets': assets,
                 'metrics': metrics,
                 'frequency': frequency,
+                'page_size': PAGE_SIZE,
                 'start_time': start_time.isoformat() if isinstance(start_time, datetime) else start_time,
-                'end_time': end_time.isoformat() if isinstance(end_time, datetime) else end_time
+                'end_time': end_time.isoformat() if isinstance(end_time, datetime) else end_time,
+                'end_inclusive': str(end_inclusive).lower(),
             }
 
-            return get_data(urljoin(base_url, 'asset-metrics'), params=params, timeout=3)
+        def iter_asset_metrics(metrics, start_time=None, end_time=None, assets='btc', frequency='1d',
+                               end_inclusive=True):
+            return iter_pages(urljoin(base_url, 'asset-metrics'),
+                              params(metrics, start_time, end_time, assets, frequency, end_inclusive),
+                              session=self.session, timeout=3)
+
+        def asset_metrics(metrics, start_time=None, end_time=None, assets='btc', frequency='1d'):
+            return list(chain.from_iterable(iter_asset_metrics(metrics, start_time, end_time, assets, frequency)))
+
+        def iter_asset_metrics_parallel(metrics, start_time=None, end_time=None, assets='btc', frequency='1d',
+                                        chunk_days=None):
+            """
+            Fetches every metric (and every time chunk of `chunk_days`) concurrently,
+            yields (metric, page) as the pages arrive.
+            """
+            jobs = {}
+            for metric in metrics:
+                for chunk_start, chunk_end in time_chunks(start_time, end_time, chunk_days):
+                    # the chunks don't overlap: only the last one includes its end
+                    end_inclusive = chunk_end is end_time
+                    jobs[(metric, chunk_start)] = (
+                        lambda m=metric, s=chunk_start, e=chunk_end, i=end_inclusive:
+                        iter_asset_metrics(m, s, e, assets, frequency, i)
+                    )
+
+            for (metric, _), page in iter_parallel(jobs, self.workers):
+                yield metric, page
 
         return Timeseries(
-            asset_metrics
+            asset_metrics,
+            iter_asset_metrics,
+            iter_asset_metrics_parallel
         )
-
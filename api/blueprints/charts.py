@@ -1,19 +1,21 @@
 from flask import Blueprint, jsonify
-import psycopg2
 import calendar
-from config import config
-from extensions import cache
+from extensions import cache, db
 import pandas as pd
 from queries import get_mining_countries, get_mining_provinces
+from services.response_store import response_store
 
 bp = Blueprint('charts', __name__, url_prefix='/charts')
+# the charts are read from the DB, so the prepared responses expire like the cached queries
+CHARTS_MAX_AGE = 300
 
 
 @bp.route('/mining_equipment_efficiency')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def mining_equipment_efficiency():
     @cache.cached(key_prefix='all_miners')
     def get_miners():
-        with psycopg2.connect(**config['custom_data']) as conn:
+        with db.connection('custom_data') as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM miners')
             return cursor.fetchall()
@@ -32,10 +34,11 @@ def mining_equipment_efficiency():
 
 
 @bp.route('/profitability_threshold')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def profitability_threshold():
     @cache.cached(key_prefix='all_prof_threshold')
     def get_prof_thresholds():
-        with psycopg2.connect(**config['blockchain_data']) as conn:
+        with db.connection('blockchain_data') as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM prof_threshold')
             return cursor.fetchall()
@@ -57,6 +60,7 @@ def profitability_threshold():
 
 
 @bp.route('/mining_countries')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def mining_countries():
     response = []
     mining_countries = get_mining_countries()
@@ -72,6 +76,7 @@ def mining_countries():
 
 
 @bp.route('/mining_provinces')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def mining_provinces():
     response = []
     mining_provinces = get_mining_provinces()
@@ -87,10 +92,11 @@ def mining_provinces():
 
 
 @bp.route('/mining_map_countries')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def mining_map_countries():
     @cache.cached(key_prefix='all_mining_map_countries')
     def get_mining_map_countries():
-        with psycopg2.connect(**config['custom_data']) as conn:
+        with db.connection('custom_data') as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM mining_map_countries')
             return cursor.fetchall()
@@ -109,10 +115,11 @@ def mining_map_countries():
 
 
 @bp.route('/mining_map_provinces')
+@response_store.stored(key=lambda: (), max_age=CHARTS_MAX_AGE)
 def mining_map_provinces():
     @cache.cached(key_prefix='all_mining_map_provinces')
     def get_mining_map_provinces():
-        with psycopg2.connect(**config['custom_data']) as conn:
+        with db.connection('custom_data') as conn:
             cursor = conn.cursor()
             cursor.execute('SELECT * FROM mining_map_provinces')
             return cursor.fetchall()
@@ -1,19 +1,33 @@
-import psycopg2
+import io
+import csv
+import json
+import math
 import datetime
-from flask import Blueprint, jsonify, request
-from config import config
-from extensions import cache
+import psycopg2
+import psycopg2.extras
+from flask import Blueprint, jsonify, request, abort
+from extensions import db
 from schema import Schema, Or
 from decorators import validators, auth
+from bulk_writer import to_copy_value
+from services.data_snapshot import data_snapshots
+from services.write_behind import write_behind
 
 bp = Blueprint('contribute', __name__, url_prefix='/contribute')
 
-@cache.cached(key_prefix='all_countries')
-def get_countries():
-    with psycopg2.connect(**config['custom_data']) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM countries')
-        return cursor.fetchall()
+PERIODS = frozenset(('daily', 'weekly', 'biweekly', 'monthly',))
+UNITS = frozenset(('th/s', 'ph/s', 'eh/s',))
+COLUMNS = ['period', 'country', 'province', 'average_hashrate', 'unit', 'period_start_date', 'api_token_id']
+# rows validated and copied at once, the body is read in batches of that size
+BULK_BATCH_ROWS = 5000
+BULK_MAX_ROWS = 500000
+# the errors of the rows after that are counted but not returned
+BULK_MAX_ERRORS = 1000
+
+def get_country_names() -> frozenset:
+    # the countries table is a part of the data snapshot, the set is built once per data version
+    snapshot = data_snapshots.current()
+    return snapshot.derived('contribute_country_names', lambda: frozenset(snapshot['countries']['country']))
 
 def datetime_validate(date_text):
     try:
@@ -27,16 +41,167 @@ schema = Schema({
     'data': [
         {
             'period_start_date': Schema(datetime_validate, error='date should be in "YYYY-MM-DD" format'),
-            'period': Schema(lambda s: s in ('daily', 'weekly', 'biweekly', 'monthly',),
+            'period': Schema(lambda s: isinstance(s, str) and s in PERIODS,
                                 error='"period" should be "daily", "weekly", "biweekly" or "monthly"'),
-            'country': Schema(lambda s: s in [row[0] for row in get_countries()], error='"country" should be one from the list, see documentation'),
+            'country': Schema(lambda s: isinstance(s, str) and s in get_country_names(), error='"country" should be one from the list, see documentation'),
             'province': Schema(Or(str, None), error='"province" should be string or null'),
             'average_hashrate': Schema(Or(float, int), error='"average_hashrate" should be numeric'),
-            'unit': Schema(lambda s: s in ('th/s', 'ph/s', 'eh/s',), error='"unit" should be "th/s", "ph/s" or "eh/s"')
+            'unit': Schema(lambda s: isinstance(s, str) and s in UNITS, error='"unit" should be "th/s", "ph/s" or "eh/s"')
         }
     ]
 }, ignore_extra_keys=True)
 
+
+class RowValidator:
+    """
+    Validation of the bulk rows with the same rules and messages as `schema`, without the schema objects:
+    the checks are plain functions and the sets are built once. CSV values are strings, so the numbers
+    are parsed and an empty province is null.
+    """
+    def __init__(self, country_names: frozenset):
+        self.country_names = country_names
+
+    def __call__(self, row: dict, api_token_id):
+        """Returns (values in the COLUMNS order, None) or (None, errors)."""
+        errors = []
+        if not isinstance(row, dict):
+            return None, ['row should be an object']
+        missing = [key for key in ('period_start_date', 'period', 'country', 'province', 'average_hashrate', 'unit')
+                   if key not in row]
+        if missing:
+            return None, [f"Missing key: {', '.join(repr(key) for key in missing)}"]
+
+        try:
+            period_start_date = datetime.datetime.strptime(row['period_start_date'], '%Y-%m-%d').date()
+        except (TypeError, ValueError):
+            period_start_date = None
+            errors.append('date should be in "YYYY-MM-DD" format')
+        # a list or an object is not hashable, the membership tests are for strings only
+        if not isinstance(row['period'], str) or row['period'] not in PERIODS:
+            errors.append('"period" should be "daily", "weekly", "biweekly" or "monthly"')
+        if not isinstance(row['country'], str) or row['country'] not in self.country_names:
+            errors.append('"country" should be one from the list, see documentation')
+        province = None if row['province'] == '' else row['province']
+        if province is not None and not isinstance(province, str):
+            errors.append('"province" should be string or null')
+        average_hashrate = row['average_hashrate']
+        try:
+            if isinstance(average_hashrate, str):
+                average_hashrate = float(average_hashrate)
+            elif isinstance(average_hashrate, bool) or not isinstance(average_hashrate, (int, float)):
+                raise ValueError
+            # "nan" and "inf" are parsed by float() but are not hashrates
+            if not math.isfinite(average_hashrate):
+                raise ValueError
+        except (ValueError, OverflowError):
+            errors.append('"average_hashrate" should be numeric')
+        if not isinstance(row['unit'], str) or row['unit'] not in UNITS:
+            errors.append('"unit" should be "th/s", "ph/s" or "eh/s"')
+
+        if errors:
+            return None, errors
+        return (row['period'], row['country'], province, average_hashrate, row['unit'], period_start_date,
+                api_token_id), None
+
+
+def save_contributions(jobs):
+    """Write-behind handler of the contributions: the rows of all the jobs in one multi-row statement."""
+    with db.connection('custom_data') as conn:
+        cursor = conn.cursor()
+        psycopg2.extras.execute_values(
+            cursor, f"INSERT INTO hashrate_geo_distribution ({', '.join(COLUMNS)}) VALUES %s",
+            [tuple(row) for _, payload in jobs for row in payload['rows']], page_size=1000
+        )
+
+
+def decode_body_lines(invalid_lines: set):
+    """
+    Lines of the streamed body, decoded one by one: the BOM of an Excel CSV export is dropped, and the numbers
+    of the lines which are not valid UTF-8 are added to `invalid_lines` (their bad bytes are replaced).
+    """
+    for line_number, line in enumerate(iter(request.stream.readline, b''), start=1):
+        encoding = 'utf-8-sig' if line_number == 1 else 'utf-8'
+        try:
+            yield line.decode(encoding)
+        except UnicodeDecodeError:
+            invalid_lines.add(line_number)
+            yield line.decode(encoding, errors='replace')
+
+
+def iter_body_rows():
+    """
+    Rows of the streamed body, one by one: NDJSON (one object per line) or CSV with a header.
+    Yields (line number, row), a line which is not valid JSON or UTF-8 is yielded as the error message.
+    """
+    invalid_lines = set()
+    lines = decode_body_lines(invalid_lines)
+    if request.mimetype == 'text/csv':
+        reader = csv.DictReader(lines)
+        # a header which is not valid UTF-8 is reported as the missing keys of the rows
+        reader.fieldnames
+        invalid_lines.clear()
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as error:
+                invalid_lines.clear()
+                yield reader.line_num, f'invalid CSV: {str(error)}'
+                continue
+            if invalid_lines:
+                invalid_lines.clear()
+                yield reader.line_num, 'the row is not valid UTF-8'
+                continue
+            yield reader.line_num, row
+
+    for line_number, line in enumerate(lines, start=1):
+        if invalid_lines:
+            invalid_lines.clear()
+            yield line_number, 'the line is not valid UTF-8'
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as error:
+            yield line_number, f'invalid JSON: {str(error)}'
+
+
+def copy_rows(cursor, rows):
+    buffer = io.StringIO()
+    for values in rows:
+        buffer.write('\t'.join(to_copy_value(value) for value in values))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY hashrate_geo_distribution ({', '.join(COLUMNS)}) FROM STDIN", buffer)
+
+
+def insert_batch(cursor, batch):
+    """
+    Copies the (line number, values) rows of the batch. If the batch is rejected by the DB,
+    the rows are inserted one by one and the errors of the rejected rows are returned.
+    """
+    cursor.execute('SAVEPOINT contribute_batch')
+    try:
+        copy_rows(cursor, [values for _, values in batch])
+        return []
+    except psycopg2.Error:
+        cursor.execute('ROLLBACK TO SAVEPOINT contribute_batch')
+
+    insert_sql = f"INSERT INTO hashrate_geo_distribution ({', '.join(COLUMNS)}) " \
+                 f"VALUES ({', '.join(['%s'] * len(COLUMNS))})"
+    errors = []
+    for line_number, values in batch:
+        cursor.execute('SAVEPOINT contribute_row')
+        try:
+            cursor.execute(insert_sql, values)
+        except psycopg2.Error as error:
+            cursor.execute('ROLLBACK TO SAVEPOINT contribute_row')
+            errors.append((line_number, [str(error).strip()]))
+    return errors
+
+
 @bp.route('/miners_geo_distribution', methods=('POST',))
 @auth.bearer()
 @validators.validate(schema)
@@ -318,7 +483,10 @@ def miners_geo_distribution(api_token):
                 $ref: "#/definitions/Hashrate"
     responses:
       200:
-        description: Records created
+        description: Nothing to create (empty list)
+      202:
+        description: Records are validated and queued, they are created shortly after the response.
+                     Poll /miners_geo_distribution/jobs/{job_id} to know whether they are created.
         schema:
           type: object
           properties:
@@ -330,9 +498,11 @@ def miners_geo_distribution(api_token):
             status:
               type: string
               enum:
-                - success
-                - fail
-              example: success
+                - queued
+              example: queued
+            job_id:
+              type: integer
+              example: 42
       422:
         description: Validation error
         schema:
@@ -344,17 +514,154 @@ def miners_geo_distribution(api_token):
               example: 'date should be in \"YYYY-MM-DD\" format'
     """
     data = request.json['data']
-    if len(data) > 0:
-        with psycopg2.connect(**config['custom_data']) as conn:
-            cursor = conn.cursor()
-            insert_sql = "INSERT INTO hashrate_geo_distribution (period, country, province, average_hashrate, unit, period_start_date, api_token_id)" \
-                         " VALUES (%(period)s, %(country)s, %(province)s, %(average_hashrate)s, %(unit)s, %(period_start_date)s, %(api_token_id)s)"
-            try:
-                for row in data:
-                    row['api_token_id'] = api_token[0]
+    if len(data) == 0:
+        return jsonify(data=data, status="success")
+
+    for row in data:
+        row['api_token_id'] = api_token[0]
+    # the validated rows are journaled and inserted by the write-behind dispatcher
+    job_id = write_behind.enqueue('contribution', {'rows': [[row[column] for column in COLUMNS] for row in data]},
+                                  target=str(api_token[0]))
+
+    return jsonify(data=data, status="queued", job_id=job_id), 202
+
+
+@bp.route('/miners_geo_distribution/jobs/<int:job_id>')
+@auth.bearer()
+def miners_geo_distribution_job(api_token, job_id):
+    """
+    State of queued contributions
+    ---
+    tags:
+      - Contribute
+    security:
+      - Bearer: []
+    parameters:
+      - in: path
+        name: job_id
+        type: integer
+        required: true
+    responses:
+      200:
+        description: The records are queued (retried after a DB error), created, or failed for good.
+                     Failed records are not created, they have to be sent again.
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              enum:
+                - queued
+                - created
+                - failed
+              example: created
+            attempts:
+              type: integer
+            error:
+              type: string
+              description: The last error of a queued or failed job
+      404:
+        description: Unknown job, a job of another token or a job created more than a week ago
+    """
+    job = write_behind.job(job_id)
+    if job is None or job['kind'] != 'contribution' or job['target'] != str(api_token[0]):
+        abort(404)
+
+    if job['state'] == 'done':
+        return jsonify(status='created')
+
+    return jsonify(status='failed' if job['state'] == 'dead' else 'queued', attempts=job['attempts'],
+                   error=job['last_error'])
+
+
+@bp.route('/miners_geo_distribution/bulk', methods=('POST',))
+@auth.bearer()
+def miners_geo_distribution_bulk(api_token):
+    """
+    Contribute many rows of geographical hashrate distribution at once
+    ---
+    tags:
+      - Contribute
+    security:
+      - Bearer: []
+    consumes:
+      - application/x-ndjson
+      - text/csv
+    parameters:
+      - in: body
+        name: body
+        description: One Hashrate object per line (NDJSON) or CSV with the Hashrate fields as the header.
+                     The body is read as a stream, so it can contain months of daily data.
+                     The rows are created in batches of 5000, each batch is committed on its own.
+        schema:
+          $ref: "#/definitions/Hashrate"
+    responses:
+      200:
+        description: Valid rows are created, invalid ones are returned with their errors
+        schema:
+          type: object
+          properties:
+            status:
+              type: string
+              enum:
+                - success
+                - partial
+                - fail
+              example: partial
+            received:
+              type: integer
+            created:
+              type: integer
+            failed:
+              type: integer
+            errors:
+              type: array
+              description: Errors of the first 1000 invalid rows
+              items:
+                type: object
+                properties:
+                  line:
+                    type: integer
+                  errors:
+                    type: array
+                    items:
+                      type: string
+    """
+    validate_row = RowValidator(get_country_names())
+    counts = {'received': 0, 'created': 0, 'failed': 0}
+    errors = []
+
+    def add_errors(line_number, messages):
+        counts['failed'] += 1
+        if len(errors) < BULK_MAX_ERRORS:
+            errors.append({'line': line_number, 'errors': messages})
+
+    def flush(batch):
+        # each batch is committed on its own, the connection is not held while the body is read
+        with db.connection('custom_data') as conn:
+            batch_errors = insert_batch(conn.cursor(), batch)
+        counts['created'] += len(batch) - len(batch_errors)
+        for line_number, messages in batch_errors:
+            add_errors(line_number, messages)
+        batch.clear()
 
-                cursor.executemany(insert_sql, data)
-            except Exception as error:
-                return jsonify(data=data, status="fail", error=str(error))
+    batch = []
+    for line_number, row in iter_body_rows():
+        if counts['received'] >= BULK_MAX_ROWS:
+            # the rest of the body is not read, the upload is reported as partial at best
+            counts['failed'] += 1
+            errors.append({'line': line_number, 'errors': [f'too many rows, the limit is {BULK_MAX_ROWS}']})
+            break
+        counts['received'] += 1
+        values, messages = (None, [row]) if isinstance(row, str) else validate_row(row, api_token[0])
+        if messages:
+            add_errors(line_number, messages)
+            continue
+        batch.append((line_number, values))
+        if len(batch) >= BULK_BATCH_ROWS:
+            flush(batch)
+    if batch:
+        flush(batch)
 
-    return jsonify(data=data, status="success")
+    status = 'success' if counts['failed'] == 0 else 'partial' if counts['created'] > 0 else 'fail'
+    return jsonify(status=status, errors=errors, **counts)
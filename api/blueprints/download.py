@@ -1,52 +1,58 @@
-from typing import List, Dict, Union
-from flask import Blueprint, make_response, request
-import csv
-import io
-from datetime import datetime
+from typing import List, Dict, Sequence
+from flask import Blueprint, request
+import numpy as np
+import pandas as pd
 from services import EnergyConsumption, EnergyConsumptionByTypes, EnergyConsumptionPowerByTypes
 from queries import get_mining_countries, get_mining_provinces
 from packaging.version import parse as version_parse
+from services.price_cache import canonical_price
+from services.response_store import response_store
+from services.file_export import TABLE_FILE_TYPES, iter_columns, iter_csv, send_csv, send_table
 
 
 bp = Blueprint('download', __name__, url_prefix='/download')
+# v1.0.5 and the mining maps are read from the DB, so the prepared files expire like the cached queries
+DOWNLOAD_MAX_AGE = 300
 
 
-def get_data(version=None, price=0.05):
-    def to_dict(timestamp, row):
+def data_key(version=None):
+    try:
+        return version, canonical_price(request.args.get('price', 0.05)), request.args.get('file_type', 'csv')
+    except ValueError:
+        return None
+
+
+def file_key(version=None):
+    return version, request.args.get('file_type', 'csv')
+
+
+def get_data(version=None, price=0.05) -> Dict[str, np.ndarray]:
+    def frame_columns(energy_df: pd.DataFrame, columns: List[str]) -> Dict[str, np.ndarray]:
+        timestamps = energy_df.index.to_numpy(dtype=np.int64)
         return {
-            'timestamp': timestamp,
-            'date': datetime.utcfromtimestamp(timestamp).isoformat(),
-            'guess_consumption': row['guess_consumption'],
-            'max_consumption': row['max_consumption'],
-            'min_consumption': row['min_consumption']
+            'timestamp': timestamps,
+            'date': timestamps.view('datetime64[s]'),
+            **{column: energy_df[column].to_numpy() for column in columns}
         }
 
     def v1_0_5(price):
         energy_consumption = EnergyConsumption()
 
-        return [to_dict(timestamp, row) for timestamp, row in energy_consumption.get_data(price)]
+        return frame_columns(energy_consumption.get_frame(price),
+                             ['guess_consumption', 'max_consumption', 'min_consumption'])
 
     def v1_1_0(price):
         energy_consumption_by_types = EnergyConsumptionByTypes()
 
-        return [to_dict(timestamp, row) for timestamp, row in energy_consumption_by_types.get_data(price)]
+        return frame_columns(energy_consumption_by_types.get_frame(price),
+                             ['guess_consumption', 'max_consumption', 'min_consumption'])
 
     def v1_1_1(price):
-        def to_dict_extended(timestamp, row):
-            return {
-                'timestamp': timestamp,
-                'date': datetime.utcfromtimestamp(timestamp).isoformat(),
-                'guess_consumption': row['guess_consumption'],
-                'max_consumption': row['max_consumption'],
-                'min_consumption': row['min_consumption'],
-                'guess_power': row['guess_power'],
-                'max_power': row['max_power'],
-                'min_power': row['min_power']
-            }
-
         energy_consumption_by_types = EnergyConsumptionPowerByTypes()
 
-        return [to_dict_extended(timestamp, row) for timestamp, row in energy_consumption_by_types.get_data(price)]
+        return frame_columns(energy_consumption_by_types.get_frame(price),
+                             ['guess_consumption', 'max_consumption', 'min_consumption', 'guess_power', 'max_power',
+                              'min_power'])
 
     func = locals().get(version.replace('.', '_'))
     if callable(func):
@@ -55,27 +61,27 @@ def get_data(version=None, price=0.05):
     raise NotImplementedError('Not Implemented')
 
 
-def send_file(first_line=None, file_type='csv'):
-    def send_csv(headers: Dict[str, str], rows: List[Dict[str, Union[str, int, float]]], filename='export.csv'):
-        si = io.StringIO()
-        keys = headers.keys()
-        cw = csv.DictWriter(si, fieldnames=keys, extrasaction="ignore")
-        if first_line is not None and len(keys) > 0:
-            cw.writerow({list(keys)[0]: first_line})
-        cw.writerow(headers)
-        cw.writerows(rows)
-        output = make_response(si.getvalue())
-        output.headers["Content-Disposition"] = f"attachment; filename={filename}"
-        output.headers["Content-type"] = "text/csv"
-        return output
+def send_file(headers: Dict[str, str], columns: Dict[str, Sequence], first_line=None, file_type='csv'):
+    if file_type in TABLE_FILE_TYPES:
+        # typed columns named by the keys, the first line of the csv is kept in the schema metadata
+        metadata = {'description': first_line} if first_line is not None else None
+        return send_table({key: columns[key] for key in headers.keys()}, file_type, metadata)
+
+    values = [np.datetime_as_string(columns[key]) if np.asarray(columns[key]).dtype.kind == 'M' else columns[key]
+              for key in headers.keys()]
+
+    return send_csv(iter_csv(list(headers.values()), iter_columns(values), first_line))
+
 
-    return send_csv
+def to_columns(headers: Dict[str, str], rows: List[Dict]) -> Dict[str, list]:
+    return {key: [row.get(key) for row in rows] for key in headers.keys()}
 
 
 @bp.route('/data')
+@response_store.stored(key=data_key, max_age=DOWNLOAD_MAX_AGE)
 def data(version=None):
     file_type = request.args.get('file_type', 'csv')
-    price = request.args.get('price', 0.05)
+    price = canonical_price(request.args.get('price', 0.05))
     headers = {
         'timestamp': 'Timestamp',
         'date': 'Date and Time',
@@ -92,13 +98,14 @@ def data(version=None):
         headers['min_power'] = 'power MIN'
         headers['guess_power'] = 'power GUESS'
 
-    rows = get_data(version, float(price))
-    send_file_func = send_file(first_line=f'Average electricity cost assumption: {price} USD/kWh', file_type=file_type)
+    columns = get_data(version, price)
 
-    return send_file_func(headers, rows)
+    return send_file(headers, columns, first_line=f'Average electricity cost assumption: {price} USD/kWh',
+                     file_type=file_type)
 
 
 @bp.route('/mining_countries')
+@response_store.stored(key=file_key, max_age=DOWNLOAD_MAX_AGE)
 def mining_countries(version=None):
     if version_parse(version) < version_parse('v1.1.0'):
         raise NotImplementedError('Not Implemented')
@@ -109,13 +116,13 @@ def mining_countries(version=None):
         'name': 'Country',
         'value': 'Share of global hashrate',
     }
-    rows = get_mining_countries()
-    send_file_func = send_file(file_type=file_type)
+    rows = [{**row, 'value': round(row['value'] * 100, 2)} for row in get_mining_countries()]
 
-    return send_file_func(headers, list(map(lambda row: {**row, 'value': round(row['value'] * 100, 2)}, rows)))
+    return send_file(headers, to_columns(headers, rows), file_type=file_type)
 
 
 @bp.route('/mining_provinces')
+@response_store.stored(key=file_key, max_age=DOWNLOAD_MAX_AGE)
 def mining_provinces(version=None):
     if version_parse(version) < version_parse('v1.1.0'):
         raise NotImplementedError('Not Implemented')
@@ -127,8 +134,6 @@ def mining_provinces(version=None):
         # 'value': 'Share of global hashrate',
         'local_value': 'Share of Chinese hashrate'
     }
-    rows = get_mining_provinces()
-    send_file_func = send_file(file_type=file_type)
+    rows = [{**row, 'local_value': round(row['local_value'] * 100, 2)} for row in get_mining_provinces()]
 
-    return send_file_func(headers,
-                          list(map(lambda row: {**row, 'local_value': round(row['local_value'] * 100, 2)}, rows)))
+    return send_file(headers, to_columns(headers, rows), file_type=file_type)
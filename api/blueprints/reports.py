@@ -1,35 +1,20 @@
 import os
-import datetime
 from flask import Blueprint, jsonify, request, abort
-from firebase_admin import storage
 from services.realtime_collection import realtime_collections, Collections
+from services.signed_urls import SignedFileListing, signed_urls
 
 bp = Blueprint('reports.py', __name__, url_prefix='/reports.py')
 
 BUCKET = os.environ.get("DEFAULT_BUCKET")
 FOLDER = 'reports'
 
-def to_obj(doc):
-    doc_copy = doc.copy()
-    doc_copy['fileurl'] = [
-        storage.bucket(BUCKET) \
-            .blob(f'{FOLDER}/{doc["filename"]}') \
-            .generate_signed_url(
-            expiration=datetime.timedelta(days=1),
-        )
-    ]
-
-    return doc_copy
+listing = SignedFileListing(Collections.REPORTS, BUCKET, FOLDER, signed_urls)
 
 @bp.route('/')
 def index():
     project = request.args.get('project', 'cbeci')
-    docs = realtime_collections.collections[Collections.REPORTS].get()
-
-    def docs_filter(doc):
-        return doc.get('is_active') == True and doc.get('project') == project
 
-    return jsonify(data=list(sorted(map(to_obj, filter(docs_filter, docs)), key=lambda doc: doc.get('order_position'))))
+    return jsonify(data=listing.index(project))
 
 
 @bp.route('/<string:key>')
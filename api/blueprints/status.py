@@ -0,0 +1,73 @@
+from flask import Blueprint, jsonify
+from extensions import db
+from decorators import auth
+from decorators.auth import api_tokens
+from services.data_snapshot import snapshot_refresher
+from services.realtime_collection import realtime_collections
+from services.realtime_estimate import realtime_estimates
+from services.response_store import response_store
+from services.signed_urls import signed_urls
+from services.single_flight import single_flight
+from services.write_behind import write_behind
+
+bp = Blueprint('status', __name__, url_prefix='/status')
+
+# the statuses have the last errors of the services (DB hosts, tokens...), they are served to the internal IP only,
+# except the readiness of /collections
+
+
+@bp.route('/snapshot')
+@auth.internal()
+def snapshot():
+    return jsonify(data=snapshot_refresher.status())
+
+
+@bp.route('/responses')
+@auth.internal()
+def responses():
+    return jsonify(data=response_store.status())
+
+
+@bp.route('/single-flight')
+@auth.internal()
+def single_flight_status():
+    return jsonify(data=single_flight.status())
+
+
+@bp.route('/db')
+@auth.internal()
+def db_pools():
+    return jsonify(data=db.status())
+
+
+@bp.route('/estimates')
+@auth.internal()
+def estimates():
+    return jsonify(data=realtime_estimates.status())
+
+
+@bp.route('/tokens')
+@auth.internal()
+def tokens():
+    return jsonify(data=api_tokens.status())
+
+
+@bp.route('/write-behind')
+@auth.internal()
+def write_behind_status():
+    return jsonify(data=write_behind.status())
+
+
+@bp.route('/signed-urls')
+@auth.internal()
+def signed_urls_status():
+    return jsonify(data=signed_urls.status())
+
+
+@bp.route('/collections')
+def collections():
+    status = realtime_collections.status()
+    if not auth.limits_exempt_when():
+        status = {'ready': status['ready']}
+    # 503 until every collection has docs to serve
+    return jsonify(data=status), 200 if status['ready'] else 503
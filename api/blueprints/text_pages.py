@@ -1,31 +1,36 @@
 from flask import Blueprint, jsonify, request, abort
-from services.realtime_collection import realtime_collections, Collections
+from services.realtime_collection import CollectionIndex, realtime_collections, Collections
 
 bp = Blueprint('text_pages', __name__, url_prefix='/text_pages')
 
 
-@bp.route('/')
-def index():
-    project = request.args.get('project', 'cbeci')
-    parent = request.args.get('parent')
-    docs = realtime_collections.collections[Collections.TEXT_PAGES].get()
+# the listing does not include the page contents
+EXCLUDED_PROPS = ['content', 'commands', 'modals', 'panels', 'updatedAt', 'updatedBy']
+
+
+def doc_keys(doc):
+    if doc.get('is_active') != True:
+        return ()
+
+    return ('project', doc.get('project')), ('parent', doc.get('project'), doc.get('parent'))
 
-    def docs_filter(doc):
-        if parent is not None and doc.get('parent') != parent:
-            return False
 
-        return doc.get('is_active') == True and doc.get('project') == project
+def doc_to_dict(doc):
+    return {prop: value for prop, value in doc.items() if prop not in EXCLUDED_PROPS}
 
-    def doc_to_dict(doc):
-        copy = doc.copy()
 
-        for prop in ['content', 'commands', 'modals', 'panels', 'updatedAt', 'updatedBy']:
-            if prop in copy:
-                del copy[prop]
+listing = realtime_collections.add_index(Collections.TEXT_PAGES, 'listing', CollectionIndex(doc_keys, doc_to_dict))
+
+
+@bp.route('/')
+def index():
+    project = request.args.get('project', 'cbeci')
+    parent = request.args.get('parent')
 
-        return copy
+    if parent is None:
+        return jsonify(data=listing.get(('project', project)))
 
-    return jsonify(data=list(map(doc_to_dict, filter(docs_filter, docs))))
+    return jsonify(data=listing.get(('parent', project, parent)))
 
 
 @bp.route('/<string:key>')
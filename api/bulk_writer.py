@@ -0,0 +1,136 @@
+import io
+import math
+import logging
+from typing import Iterable, List, Optional, Sequence
+import psycopg2
+import psycopg2.extras
+
+LOGGER = logging.getLogger()
+
+# batches bigger than that are loaded with COPY through a temporary table, the smaller ones with execute_values
+COPY_THRESHOLD = 5000
+PAGE_SIZE = 1000
+
+
+def to_copy_value(value) -> str:
+    """
+    Value in the COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return repr(value)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class BulkWriter:
+    """
+    Stages the rows of a table and writes them in one transaction: `flush` inserts all the staged rows
+    with one multi-row statement (or COPY for the big batches) and commits.
+    Existing keys are skipped (`ON CONFLICT DO NOTHING`), or updated with `upsert=True`.
+    If the batch fails, the rows are retried one by one, the failed rows are logged and skipped.
+    With `commit=False` the rows are left in the transaction of the connection, to be committed with the
+    other writes of the caller.
+    """
+    def __init__(self, connection, table: str, columns: Sequence[str], key: Sequence[str] = ('timestamp',),
+                 create_sql: Optional[str] = None, upsert: bool = False, copy_threshold: int = COPY_THRESHOLD,
+                 commit: bool = True):
+        self.connection = connection
+        self.table = table
+        self.columns = list(columns)
+        self.key = list(key)
+        self.key_indexes = [self.columns.index(column) for column in self.key]
+        self.create_sql = create_sql
+        self.upsert = upsert
+        self.copy_threshold = copy_threshold
+        self.commit = commit
+        # rows by key, the last staged row of a key wins like it would with row by row upserts
+        self.rows = {}
+        self._table_checked = False
+
+    def add(self, row: Sequence):
+        row = tuple(row)
+        key = tuple(row[index] for index in self.key_indexes) if self.key else len(self.rows)
+        self.rows[key] = row
+
+    def extend(self, rows: Iterable[Sequence]):
+        for row in rows:
+            self.add(row)
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def on_conflict(self) -> str:
+        if not self.key:
+            return ''
+        target = ', '.join(self.key)
+        updates = [f'{column} = EXCLUDED.{column}' for column in self.columns if column not in self.key]
+        if self.upsert and updates:
+            return f" ON CONFLICT ({target}) DO UPDATE SET {', '.join(updates)}"
+        return f' ON CONFLICT ({target}) DO NOTHING'
+
+    def _insert_sql(self, source: str) -> str:
+        return f"INSERT INTO {self.table} ({', '.join(self.columns)}) {source}{self.on_conflict}"
+
+    def flush(self) -> int:
+        """
+        Writes the staged rows (and commits), returns the number of the rows sent (skipped existing keys included).
+        """
+        rows = list(self.rows.values())
+        self.rows = {}
+        with self.connection.cursor() as cursor:
+            if self.create_sql and not self._table_checked:
+                cursor.execute(self.create_sql)
+                self._table_checked = True
+            if not rows:
+                if self.commit:
+                    self.connection.commit()
+                return 0
+            cursor.execute('SAVEPOINT bulk_writer')
+            try:
+                if len(rows) > self.copy_threshold:
+                    self._copy(cursor, rows)
+                else:
+                    psycopg2.extras.execute_values(cursor, self._insert_sql('VALUES %s'), rows, page_size=PAGE_SIZE)
+                written = len(rows)
+            except psycopg2.Error as error:
+                LOGGER.warning(f"{self.table}: bulk write failed, writing the rows one by one: '{error}'")
+                cursor.execute('ROLLBACK TO SAVEPOINT bulk_writer')
+                written = self._write_rows(cursor, rows)
+            if self.commit:
+                self.connection.commit()
+
+        return written
+
+    def _copy(self, cursor, rows: List[tuple]):
+        staging_table = f'{self.table}_staging'
+        # only the written columns, without the constraints and the defaults (e.g. serial ids) of the table
+        cursor.execute(f"CREATE TEMP TABLE {staging_table} AS SELECT {', '.join(self.columns)} FROM {self.table} "
+                       f"WITH NO DATA")
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(to_copy_value(value) for value in row))
+            buffer.write('\n')
+        buffer.seek(0)
+        cursor.copy_expert(f"COPY {staging_table} ({', '.join(self.columns)}) FROM STDIN", buffer)
+        cursor.execute(self._insert_sql(f"SELECT {', '.join(self.columns)} FROM {staging_table}"))
+        cursor.execute(f'DROP TABLE {staging_table}')
+
+    def _write_rows(self, cursor, rows: List[tuple]) -> int:
+        insert_sql = self._insert_sql(f"VALUES ({', '.join(['%s'] * len(self.columns))})")
+        written = 0
+        for row in rows:
+            cursor.execute('SAVEPOINT bulk_writer_row')
+            try:
+                cursor.execute(insert_sql, row)
+                written += 1
+            except psycopg2.Error as error:
+                LOGGER.exception(f"{self.table}: {str(error)}")
+                cursor.execute('ROLLBACK TO SAVEPOINT bulk_writer_row')
+
+        return written
@@ -7,7 +7,6 @@ Created on Thu May 16 14:24:16 2019
 from flask import Flask, jsonify, make_response, request, has_request_context
 from flask_cors import CORS
 from flask_limiter import Limiter
-from flask_limiter.util import get_remote_address
 from logging.handlers import RotatingFileHandler
 from schema import SchemaError
 from flask_swagger import swagger
@@ -15,19 +14,27 @@ from flask_swagger_ui import get_swaggerui_blueprint
 from datetime import datetime
 import flask
 import requests
+import psycopg2.extras
 import logging
 import time
-import psycopg2
-import csv
-import io
+import math
 import os
 from services.firebase import init_app as init_firebase_app
 from dotenv import load_dotenv
-from config import config, start_date
-from decorators.auth import AuthenticationError
-from extensions import cache
-from helpers import load_typed_hasrates
-from services.realtime_collection import realtime_collections
+from config import config
+from decorators.auth import AuthenticationError, get_request_ip, limits_exempt_when
+from extensions import cache, get_cache_config, shared_cache, get_shared_backend, db
+from extensions.db import DB_POOL_MAX_CONNECTIONS
+from services.data_snapshot import data_snapshots, snapshot_refresher
+from services.price_cache import canonical_price, RESULT_CACHE_MAX_BYTES
+from services.response_store import response_store
+from services.file_export import iter_columns, iter_csv, send_csv
+from services.single_flight import single_flight
+from services.realtime_collection import realtime_collections, REALTIME_COLLECTIONS_CACHE_DIR
+from services.realtime_estimate import realtime_estimates
+from services.country_ranking import get_country_ranking
+from services.write_behind import write_behind, post_webhooks, webhook_dedupe_key, WRITE_BEHIND_PATH
+from blueprints.contribute import save_contributions
 from forms.feedback_form import FeedbackForm
 from services.energy_consumption_power_by_types import EnergyConsumptionPowerByTypes
 
@@ -37,35 +44,17 @@ LOG_LEVEL = logging.INFO
 
 SWAGGER_URL = '/api/docs/contribute'
 SWAGGER_SPEC_URL = '/api/docs/spec'
+COUNTRIES_WINDOW_SIZE = 5
+COUNTRIES_WINDOW_MAX_SIZE = 50
 
 def get_limiter_flag():
     val = os.environ.get("LIMITER_ENABLED")
 
     return val is not None and val.lower() not in ("0", "false", "no")
 
-# loading data in cache of each worker:
-def load_data():
-    with psycopg2.connect(**config['blockchain_data']) as conn:
-        c = conn.cursor()
-        c.execute('SELECT * FROM prof_threshold WHERE timestamp >= %s', (start_date.timestamp(),))
-        prof_threshold = c.fetchall()
-        c.execute('SELECT * FROM hash_rate WHERE timestamp >= %s', (start_date.timestamp(),))
-        hash_rate = c.fetchall()
-        c.execute('SELECT * FROM energy_consumption_ma WHERE timestamp >= %s', (start_date.timestamp(),))
-        cons = c.fetchall()
-    typed_hasrates = load_typed_hasrates()
-    with psycopg2.connect(**config['custom_data']) as conn2:
-        c2 = conn2.cursor()
-        c2.execute('SELECT * FROM miners WHERE is_active is true')
-        miners=c2.fetchall()
-        c2.execute('SELECT * FROM countries')
-        countries=c2.fetchall()
-    return prof_threshold, hash_rate, miners, countries, cons, typed_hasrates
-
-
 def get_hashrate():
-    rate = hash_rate[-1][2]
-    return int(0 if rate is None else rate)
+    rate = data_snapshots.current()['hash_rate']['value'][-1]
+    return int(0 if math.isnan(rate) else rate)
     # return int(requests.get("https://blockchain.info/q/hashrate", timeout=3).json())
 
 
@@ -74,17 +63,28 @@ def send_err_to_slack(err, name):
         headers = {'Content-type': 'application/json',}
         data = {"text":""}
         data["text"] = f"Getting {name} failed. It unexpectedly returned: " + str(err)[0:140]
-        requests.post(config['webhook_err'], headers=headers, data=str(data))
+        # delivered by the write-behind dispatcher, the same pending message is not queued twice
+        send_webhook(config['webhook_err'], str(data), headers)
     except:
         pass # not the best practice but we want API working even if Slack msg failed for any reason
 
-def get_request_ip():
-    return request.headers.get('X-Real-Ip') or get_remote_address()
+def send_webhook(url, data, headers):
+    write_behind.enqueue('webhook', {'data': data, 'headers': headers}, target=url,
+                         dedupe_key=webhook_dedupe_key(url, data))
 
-def limits_exempt_when():
-    exempt_ip = os.environ.get("RATELIMIT_EXEMPT_IP")
-
-    return exempt_ip is not None and exempt_ip.lower() not in ("0", "false", "no") and get_request_ip() == exempt_ip
+def save_feedback(jobs):
+    with db.connection('custom_data') as conn:
+        c = conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS feedback (id SERIAL PRIMARY KEY, timestamp INT,"
+                  "name TEXT, organisation TEXT, email TEXT, message TEXT);")
+        # the tables created before were keyed on the timestamp, which rejected the messages of the same second
+        c.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'feedback' AND column_name = 'id'")
+        if c.fetchone() is None:
+            c.execute("ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_pkey")
+            c.execute("ALTER TABLE feedback ADD COLUMN id SERIAL PRIMARY KEY")
+        psycopg2.extras.execute_values(c, "INSERT INTO feedback (timestamp, name, organisation, email, message) "
+                                          "VALUES %s",
+                                       [tuple(payload['row']) for _, payload in jobs])
 
 def get_file_handler(filename):
     file_handler = RotatingFileHandler(filename, maxBytes=10 * 1024 * 1024, backupCount=5)  # mb * kb * b
@@ -112,7 +112,7 @@ def get_file_handler(filename):
 def create_app():
     app = Flask(__name__)
 
-    from blueprints import charts, contribute, download, text_pages, reports, sponsors
+    from blueprints import charts, contribute, download, text_pages, reports, sponsors, status
 
     app.register_blueprint(charts.bp, url_prefix='/api/charts')
     app.register_blueprint(text_pages.bp, url_prefix='/api/text_pages')
@@ -120,6 +120,7 @@ def create_app():
     app.register_blueprint(sponsors.bp, url_prefix='/api/sponsors')
     app.register_blueprint(contribute.bp, url_prefix='/api/contribute')
     app.register_blueprint(download.bp, url_prefix='/api/<string:version>/download')
+    app.register_blueprint(status.bp, url_prefix='/api/status')
 
     swaggerui_bp = get_swaggerui_blueprint(
         SWAGGER_URL,
@@ -133,7 +134,7 @@ def create_app():
     return app
 
 app = create_app()
-cache.init_app(app)
+cache.init_app(app, config=get_cache_config())
 app.logger.setLevel(LOG_LEVEL)
 app.logger.addHandler(get_file_handler("./logs/errors.log"))
 ratelimit_storage_url = os.environ.get("RATELIMIT_STORAGE_URL")
@@ -149,12 +150,29 @@ if get_limiter_flag():
         default_limits_exempt_when=limits_exempt_when
     )
 
-init_firebase_app(cert=os.path.abspath(f"../storage/firebase/service-account-cert.{os.environ.get('PROJECT_ID')}.json"))
-realtime_collections.init()
+# the writes and the webhooks which are done after the response
+write_behind.init(path=os.environ.get('WRITE_BEHIND_PATH') or WRITE_BEHIND_PATH)
+write_behind.register('feedback', save_feedback, batch_size=100)
+write_behind.register('contribution', save_contributions, batch_size=1000)
+write_behind.register('webhook', post_webhooks, batch_size=1, rate_limit=1)
 
-# initialisation of cache vars:
-prof_threshold, hash_rate, miners, countries, cons, typed_hasrates = load_data()
-lastupdate = time.time()
+init_firebase_app(cert=os.path.abspath(f"../storage/firebase/service-account-cert.{os.environ.get('PROJECT_ID')}.json"))
+# the last known docs are served until the first live snapshot
+realtime_collections.init(cache_dir=os.environ.get('REALTIME_COLLECTIONS_CACHE_DIR') or REALTIME_COLLECTIONS_CACHE_DIR)
+
+def on_snapshot_refresh_error(err):
+    app.logger.exception(f"Getting data from DB err: {str(err)}")
+    send_err_to_slack(err, 'DB')
+
+db.init(max_connections=int(os.environ.get('DB_POOL_MAX_CONNECTIONS') or DB_POOL_MAX_CONNECTIONS))
+
+# initialisation of the data snapshot, the tables are loaded once per host and shared by the workers,
+# then it is refreshed in the background:
+data_snapshots.load()
+snapshot_refresher.init(max_age=3600, on_error=on_snapshot_refresh_error)
+response_store.init(max_bytes=int(os.environ.get('RESPONSE_STORE_MAX_BYTES') or RESULT_CACHE_MAX_BYTES))
+shared_cache.init(get_shared_backend())
+single_flight.init(backend=shared_cache if shared_cache.enabled else None)
 lastupdate_power = time.time()
 try:
     hashrate = get_hashrate()
@@ -162,6 +180,7 @@ except Exception as err:
     hashrate = 0
     logging.exception(str(err))
     send_err_to_slack(err, 'INIT HASHRATE')
+realtime_estimates.update(hashrate, lastupdate_power)
 
 @app.errorhandler(429)
 def ratelimit_handler(e):
@@ -185,19 +204,15 @@ def bad_request(error):
 
 @app.before_request
 def before_request():
-    global lastupdate, lastupdate_power, prof_threshold, hash_rate, miners, countries, cons, hashrate, typed_hasrates
-    if time.time() - lastupdate > 3600:
-        try:
-            prof_threshold, hash_rate, miners, countries, cons, typed_hasrates = load_data()
-        except Exception as err:
-            app.logger.exception(f"Getting data from DB err: {str(err)}")
-            send_err_to_slack(err, 'DB')
-        else:
-            lastupdate = time.time()
+    global lastupdate_power, hashrate
+    snapshot_refresher.start()
+    write_behind.start()
     if time.time() - lastupdate_power > 45:
         try:
             # if executed properly, answer should be int
             hashrate = get_hashrate()
+            # the current day estimates are recomputed for the new hash rate
+            realtime_estimates.update(hashrate, time.time())
         except Exception as err:
             app.logger.exception(str(err))
             send_err_to_slack(err, 'HASHRATE')
@@ -205,14 +220,23 @@ def before_request():
             lastupdate_power = time.time()
 
 
+def get_data_price(value=None):
+    if value is None:
+        value = request.args.get('p')
+    return canonical_price(value)
+
+def data_key(value=None):
+    try:
+        return (get_data_price(value),)
+    except:
+        return None
+
 @app.route('/api/data')
 @app.route('/api/data/<value>')
-@cache.memoize()
+@response_store.stored(key=data_key, shared=True)
 def recalculate_data(value=None):
     try:
-        if value is None:
-            value = request.args.get('p')
-        price = float(value)
+        price = get_data_price(value)
     except:
         return "Welcome to the CBECI API data endpoint. To get bitcoin electricity consumption estimate timeseries, specify electricity price parameter 'p' (in USD), for example /api/data?p=0.05"
 
@@ -229,50 +253,49 @@ def recalculate_data(value=None):
 
     return jsonify(data=[to_dict(timestamp, row) for timestamp, row in energy_consumption.get_data(price)])
 
+def invalid_price_response():
+    return make_response(jsonify(error="Specify electricity price parameter 'p' (in USD), "
+                                       "for example /api/estimate?p=0.05"), 400)
+
+def estimated_power(value, key):
+    # the price is validated and quantized like the one of /api/estimate, so the estimates are shared
+    try:
+        price = get_data_price(value)
+    except (TypeError, ValueError):
+        return invalid_price_response()
+    power = realtime_estimates.estimate(price)[key]
+    return jsonify(power if power is not None else 'mining is not profitable')
+
 @app.route("/api/max/<value>")
 def recalculate_max(value):
-    price = float(value)
-    k = 0.05/price  # that is because base calculations in the DB is for the price 0.05 USD/KWth
-    prof_eqp = []   # temp var for the list of profitable equipment efficiency at any given moment
-    for miner in miners:
-        if prof_threshold[-1][0]>miner[1] and prof_threshold[-1][2]*k>miner[2]: prof_eqp.append(miner[2])
-        # ^^current date miner release date ^^checks if miner is profit. ^^if yes, adds miner's efficiency to the list
-    try:
-        max_consumption = max(prof_eqp)*hashrate*1.2/1e6
-    except:
-        max_consumption = 'mining is not profitable'
-    return jsonify(max_consumption)
+    return estimated_power(value, 'max_power')
 
 
 @app.route("/api/min/<value>")
 def recalculate_min(value):
-    price = float(value)
-    k = 0.05/price  # that is because base calculations in the DB is for the price 0.05 USD/KWth
-    prof_eqp = []  # temp var for the list of profitable equipment efficiency at any given moment
-    for miner in miners:
-        if prof_threshold[-1][0]>miner[1] and prof_threshold[-1][2]*k>miner[2]: prof_eqp.append(miner[2])
-        # ^^current date miner release date ^^checks if miner is profit. ^^if yes, adds miner's efficiency to the list
-    try:
-        min_consumption = min(prof_eqp)*hashrate*1.01/1e6
-    except:
-        min_consumption = 'mining is not profitable'
-    return jsonify(min_consumption)
+    return estimated_power(value, 'min_power')
 
 
 @app.route("/api/guess/<value>")
 def recalculate_guess(value):
-    price = float(value)
-    k = 0.05/price  # that is because base calculations in the DB is for the price 0.05 USD/KWth
-    prof_eqp = []   # temp var for the list of profitable equipment efficiency at any given moment
+    return estimated_power(value, 'guess_power')
 
-    for miner in miners:
-        if prof_threshold[-1][0]>miner[1] and prof_threshold[-1][2]*k>miner[2]: prof_eqp.append(miner[2])
-        # ^^current date miner release date ^^checks if miner is profit. ^^if yes, adds miner's efficiency to the list
+
+@app.route("/api/estimate")
+@app.route("/api/estimate/<value>")
+def realtime_estimate(value=None):
+    # min, max and guess power of the latest day at once, `?p=` or /api/estimate/<price>
     try:
-        guess_consumption = sum(prof_eqp)/len(prof_eqp)*hashrate*1.10/1e6
-    except:
-        guess_consumption = 'mining is not profitable'
-    return jsonify(guess_consumption)
+        price = get_data_price(value)
+    except (TypeError, ValueError):
+        return invalid_price_response()
+    return jsonify(data=realtime_estimates.estimate(price))
+
+
+@app.route("/api/estimate/curve")
+def realtime_estimate_curve():
+    # power of the latest day by electricity price, one point per profitable miner
+    return jsonify(data=realtime_estimates.curve())
 # =============================================================================
 # @app.route("/api/countries", methods=['GET','POST'])
 # def countries_old():
@@ -280,25 +303,31 @@ def recalculate_guess(value):
 # =============================================================================
 
 @app.route("/api/countries")
+@response_store.stored(key=lambda: ())
 def countries_btc():
-    tup2dict = {a:[c,d,b] for a,b,c,d,e,f in countries}
-    tup2dict['Bitcoin'][0] = round(cons[-1][4],2)
-    dictsort = sorted(tup2dict.items(), key = lambda i: -1 if i[1][0] is None else i[1][0], reverse=True)
-    response = []
-    for item in dictsort:
-         electricity_consumption = 0 if item[1][0] is None else item[1][0]
-         response.append({
-            'country': item[0],
-            'code': item[1][2],
-            'y': electricity_consumption,
-            'x': dictsort.index(item)+1,
-            'bitcoin_percentage': round(electricity_consumption/round(cons[-1][4], 2)*100, 2),
-            'logo': item[1][1]
-            })
-    for item in response:
-        if item['country'] == "Bitcoin":
-            item['color'] = "#ffb81c"
-    return jsonify(response)
+    # ranked once per data version
+    return jsonify(get_country_ranking().items)
+
+
+def countries_window_key():
+    try:
+        size = int(request.args.get('size', COUNTRIES_WINDOW_SIZE))
+    except ValueError:
+        return None
+    return request.args.get('country', 'Bitcoin'), min(max(size, 0), COUNTRIES_WINDOW_MAX_SIZE)
+
+@app.route("/api/countries/window")
+@response_store.stored(key=countries_window_key)
+def countries_window():
+    # the countries ranked around `country` (Bitcoin by default): /api/countries/window?country=Bitcoin&size=5
+    params = countries_window_key()
+    if params is None:
+        return make_response(jsonify(error="'size' must be an integer"), 400)
+    country, size = params
+    try:
+        return jsonify(get_country_ranking().window(country, size))
+    except KeyError:
+        return make_response(jsonify(error=f"Unknown country: {country}"), 404)
 
 
 @app.route("/api/feedback", methods=['POST'])
@@ -307,102 +336,69 @@ def feedback():
     form = FeedbackForm(content)
     if not form.valid():
         return jsonify(errors=form.get_errors()), 422
-    with psycopg2.connect(**config['custom_data']) as conn:
-        c = conn.cursor()
-        c.execute("CREATE TABLE IF NOT EXISTS feedback (timestamp INT PRIMARY KEY," 
-                  "name TEXT, organisation TEXT, email TEXT, message TEXT);")
-        insert_sql = "INSERT INTO feedback (timestamp, name, organisation, email, message) VALUES (%s, %s, %s, %s, %s)"
-        name = content['name']
-        content['organisation'] = content['organisation'] if content['organisation'] else None
-        organisation = content['organisation']
-        email = content['email']
-        message = content['message']
-        timestamp = int(time.time())
-        try:
-            c.execute(insert_sql, (timestamp, name, organisation, email, message))
-        except Exception as error:
-            return jsonify(data=content, status="fail", error=error.pgcode)
-        finally:
-            headers = {'Content-type': 'application/json', }
-            sl_d = {
-                "attachments": [
-                    {
-                        "fallback": "CBECI feedback received",
-                        "color": "#36a64f",
-                        "author_name": name,
-                        "author_link": "mailto:" + email,
-                        "title": organisation,
-                        "text": message,
-                        "footer": "cbeci.org",
-                        "footer_icon": "https://i.ibb.co/HPhL1xy/favicon.png",
-                        "ts": timestamp
-                    }
-                ]
+    name = content['name']
+    content['organisation'] = content['organisation'] if content['organisation'] else None
+    organisation = content['organisation']
+    email = content['email']
+    message = content['message']
+    timestamp = int(time.time())
+    # the row and the notifications are journaled, the dispatcher writes and sends them after the response
+    write_behind.enqueue('feedback', {'row': (timestamp, name, organisation, email, message)})
+
+    headers = {'Content-type': 'application/json', }
+    sl_d = {
+        "attachments": [
+            {
+                "fallback": "CBECI feedback received",
+                "color": "#36a64f",
+                "author_name": name,
+                "author_link": "mailto:" + email,
+                "title": organisation,
+                "text": message,
+                "footer": "cbeci.org",
+                "footer_icon": "https://i.ibb.co/HPhL1xy/favicon.png",
+                "ts": timestamp
             }
+        ]
+    }
 
-            date_for_ms = datetime.utcfromtimestamp(timestamp).isoformat()
-            ms_d = {
-                "summary": "CBECI feedback received",
-                "themeColor": "FFB81C",
-                "title": "CBECI feedback received",
-                "sections": [
+    date_for_ms = datetime.utcfromtimestamp(timestamp).isoformat()
+    ms_d = {
+        "summary": "CBECI feedback received",
+        "themeColor": "FFB81C",
+        "title": "CBECI feedback received",
+        "sections": [
+            {
+                "activityTitle": name,
+                "activitySubtitle": date_for_ms,
+                "activityImage": "https://i.ibb.co/0B6NSnK/user.jpg",
+                "facts": [
+                    {
+                        "name": "Organisation:",
+                        "value": organisation
+                    },
                     {
-                        "activityTitle": name,
-                        "activitySubtitle": date_for_ms,
-                        "activityImage": "https://i.ibb.co/0B6NSnK/user.jpg",
-                        "facts": [
-                            {
-                                "name": "Organisation:",
-                                "value": organisation
-                            },
-                            {
-                                "name": "Email:",
-                                "value": email
-                            }
-                        ],
-                        "text": message
+                        "name": "Email:",
+                        "value": email
                     }
-                ]
+                ],
+                "text": message
             }
+        ]
+    }
 
-            sl_d = str(sl_d)
-            ms_d = str(ms_d)
-            flask.g.slackmsg = (sl_d, headers)
-            flask.g.msmsg = (ms_d, headers)
+    send_webhook(config['webhook'], str(sl_d), headers)
+    send_webhook(config['webhook_ms'], str(ms_d), headers)
     return jsonify(data=content, status="success", error="")
 
 
-@app.teardown_request
-def teardown_request(_: Exception):
-    if hasattr(flask.g, 'slackmsg'):
-        try:
-            sl_d, headers = flask.g.slackmsg
-            requests.post(config['webhook'], headers=headers, data=sl_d)
-        except Exception as error:
-            app.logger.exception(str(error))
-    if hasattr(flask.g, 'msmsg'):
-        try:
-            ms_d, headers = flask.g.msmsg
-            requests.post(config['webhook_ms'], headers=headers, data=ms_d)
-        except Exception as error:
-            app.logger.exception(str(error))
-
-
 @app.route('/api/csv', methods=['GET'])
 def download_report():
-        with psycopg2.connect(**config['blockchain_data']) as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM energy_consumption_ma WHERE timestamp >= %s', (start_date.timestamp(),))
-        rows = c.fetchall()
-        si = io.StringIO()
-        cw = csv.writer(si)
+        energy_consumption_ma = data_snapshots.current()['energy_consumption_ma']
+        columns = ['timestamp', 'date', 'max_consumption', 'min_consumption', 'guess_consumption']
+        rows = iter_columns([energy_consumption_ma[column] for column in columns])
         line = ['Timestamp', 'Date and Time', 'MAX', 'MIN', 'GUESS']
-        cw.writerow(line)
-        cw.writerows(rows)
-        output = make_response(si.getvalue())
-        output.headers["Content-Disposition"] = "attachment; filename=export.csv"
-        output.headers["Content-type"] = "text/csv"
-        return output
+        return send_csv(iter_csv(line, rows))
 # =============================================================================
 # # ====== test endpoints ahead =========================================
 # @app.route('/api/new/data/<value>')
@@ -6,6 +6,6 @@ def get_config(config_path):
     with open(config_path) as fp:
         return yaml.load(fp, yaml.FullLoader)
 
-config = get_config(os.path.join(os.path.dirname(__file__), '..', 'CONFIG.yml'))
+config = get_config(os.environ.get('CONFIG_PATH') or os.path.join(os.path.dirname(__file__), '..', 'CONFIG.yml'))
 
 start_date = datetime(year=2014, month=7, day=1)
@@ -1,29 +1,138 @@
+import os
+import hmac
+import time
+import hashlib
+import logging
+import threading
 from functools import wraps
 from flask import request
-from extensions import cache
-import psycopg2
-from config import config
+from flask_limiter.util import get_remote_address
+from extensions import db
 
-@cache.cached(key_prefix='all_api_tokens')
-def get_api_tokens():
-    with psycopg2.connect(**config['custom_data']) as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM api_tokens WHERE is_active is TRUE')
-        return cursor.fetchall()
+# revoked and new tokens are seen by every worker after at most that many seconds
+API_TOKENS_REFRESH_INTERVAL = 10
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class ApiTokenIndex:
+    """
+    Active API tokens by the hash of the token. The index is refreshed incrementally: the ids and the row
+    versions (xmin) of the active tokens are compared with the indexed ones, and only the new and the changed
+    rows are loaded, the revoked (inactive or deleted) tokens are removed.
+    """
+    def __init__(self, refresh_interval: float = API_TOKENS_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.tokens = {}
+        # id -> (row version, token hash or None for a row without a token)
+        self.versions = {}
+        self.refreshed_at = None
+        self.refresh_lock = threading.Lock()
+        self.refreshes = 0
+        self.loaded_rows = 0
+        self.last_error = None
+
+    def refresh(self):
+        with db.connection('custom_data') as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, xmin::text FROM api_tokens WHERE is_active is TRUE')
+            versions = dict(cursor.fetchall())
+            changed = [token_id for token_id, version in versions.items()
+                       if self.versions.get(token_id, (None,))[0] != version]
+            rows = []
+            if changed:
+                cursor.execute('SELECT * FROM api_tokens WHERE is_active is TRUE AND id = ANY(%s)', (changed,))
+                rows = cursor.fetchall()
+
+        # the new index replaces the current one at once, the requests never see a partial update
+        tokens = dict(self.tokens)
+        token_versions = dict(self.versions)
+        for token_id in [token_id for token_id in token_versions if token_id not in versions or token_id in changed]:
+            token_hash = token_versions.pop(token_id)[1]
+            if token_hash is not None:
+                tokens.pop(token_hash, None)
+        for row in rows:
+            # the rows without a token are indexed by version only, so they are not loaded again
+            token_hash = hash_token(row[2]) if row[2] else None
+            if token_hash is not None:
+                tokens[token_hash] = row
+            token_versions[row[0]] = (versions[row[0]], token_hash)
+        self.tokens = tokens
+        self.versions = token_versions
+        self.refreshed_at = time.time()
+        self.refreshes += 1
+        self.loaded_rows += len(rows)
+
+    def maybe_refresh(self):
+        if self.refreshed_at is None:
+            with self.refresh_lock:
+                if self.refreshed_at is None:
+                    self.refresh()
+            return
+        if time.time() - self.refreshed_at < self.refresh_interval or not self.refresh_lock.acquire(blocking=False):
+            return
+        # one request refreshes the index, the others keep using the current one
+        try:
+            if time.time() - self.refreshed_at >= self.refresh_interval:
+                self.refresh()
+                self.last_error = None
+        except Exception as error:
+            self.last_error = f'{type(error).__name__}: {error}'
+            logging.exception(f'API tokens refresh error: {str(error)}')
+        finally:
+            self.refresh_lock.release()
+
+    def get(self, token: str):
+        self.maybe_refresh()
+        row = self.tokens.get(hash_token(token))
+        if row is None or not hmac.compare_digest(row[2].encode(), token.encode()):
+            return None
+        return row
+
+    def status(self) -> dict:
+        return {
+            'tokens': len(self.tokens),
+            'refreshed_at': self.refreshed_at,
+            'refresh_interval': self.refresh_interval,
+            'refreshes': self.refreshes,
+            'loaded_rows': self.loaded_rows,
+            'last_error': self.last_error,
+        }
+
+
+api_tokens = ApiTokenIndex()
 
 class AuthenticationError(Exception):
     pass
 
-def bearer(header='Authorization'):
+def get_request_ip():
+    return request.headers.get('X-Real-Ip') or get_remote_address()
+
+def limits_exempt_when():
+    exempt_ip = os.environ.get("RATELIMIT_EXEMPT_IP")
+
+    return exempt_ip is not None and exempt_ip.lower() not in ("0", "false", "no") and get_request_ip() == exempt_ip
+
+def internal():
+    """The endpoint answers the requests of the internal IP only (RATELIMIT_EXEMPT_IP, the one not rate limited)."""
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            def get_api_token(auth_token):
-                for row in get_api_tokens():
-                    if row[2] == auth_token:
-                        return row
-                return None
+            if not limits_exempt_when():
+                raise AuthenticationError('Internal endpoint')
+
+            return f(*args, **kwargs)
+
+        return decorated_function
 
+    return decorator
+
+def bearer(header='Authorization'):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
             auth_header = request.headers.get(header)
 
             auth_token = ''
@@ -34,7 +143,7 @@ def bearer(header='Authorization'):
 
             api_token = None
             if auth_token:
-                api_token = get_api_token(auth_token)
+                api_token = api_tokens.get(auth_token)
             if api_token is None:
                 raise AuthenticationError('Invalid bearer token')
 
@@ -42,4 +151,4 @@ def bearer(header='Authorization'):
 
         return decorated_function
 
-    return decorator
\ No newline at end of file
+    return decorator
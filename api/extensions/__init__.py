@@ -1 +1,3 @@
-from .cache import cache
\ No newline at end of file
+from .cache import cache, get_cache_config
+from .shared_cache import shared_cache, get_shared_backend
+from .db import db
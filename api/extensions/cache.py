@@ -1,3 +1,27 @@
+import os
+import tempfile
 from flask_caching import Cache
 
+CACHE_KEY_PREFIX = 'cbeci:'
+
 cache = Cache(config={'CACHE_TYPE': 'SimpleCache'})
+
+
+def get_cache_dir():
+    # tmpfs keeps the cached files in memory
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.environ.get('CACHE_DIR') or os.path.join(base_dir, 'cbeci_cache')
+
+
+def get_cache_config():
+    """
+    SimpleCache keeps a copy per worker, RedisCache and FileSystemCache are shared by the workers.
+    """
+    cache_type = os.environ.get('CACHE_TYPE') or 'SimpleCache'
+    cache_config = {'CACHE_TYPE': cache_type, 'CACHE_KEY_PREFIX': CACHE_KEY_PREFIX}
+    if cache_type == 'RedisCache':
+        cache_config['CACHE_REDIS_URL'] = os.environ['CACHE_REDIS_URL']
+    elif cache_type == 'FileSystemCache':
+        cache_config['CACHE_DIR'] = os.path.join(get_cache_dir(), 'flask')
+
+    return cache_config
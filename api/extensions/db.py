@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import contextlib
+from typing import Dict
+import psycopg2
+import psycopg2.extensions
+from config import config
+
+DB_POOL_MAX_CONNECTIONS = 5
+DB_POOL_TIMEOUT = 10
+# idle connections older than that are checked with `SELECT 1` before they are handed out
+DB_POOL_CHECK_AFTER = 30
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Connections of a database for one worker process. The connections are not shared with the forked workers:
+    a child process drops the inherited connections without closing them (closing would end the parent's sessions)
+    and opens its own ones.
+    """
+    def __init__(self, name: str, params: dict, max_connections: int = DB_POOL_MAX_CONNECTIONS,
+                 timeout: float = DB_POOL_TIMEOUT, check_after: float = DB_POOL_CHECK_AFTER):
+        self.name = name
+        self.params = params
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.check_after = check_after
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        # (connection, returned at) in LIFO order, the most recently used connections are the healthiest
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(self.max_connections)
+        self.in_use = 0
+        self.acquired = 0
+        self.created = 0
+        self.discarded = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self._reset()
+
+    def _is_healthy(self, conn, returned_at: float) -> bool:
+        if conn.closed or conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.time() - returned_at < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        with self.lock:
+            self.discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        self._check_pid()
+        started_at = time.time()
+        if not self.slots.acquire(timeout=self.timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise PoolTimeoutError(f'No {self.name} connection is available after {self.timeout} seconds')
+        waited = time.time() - started_at
+        with self.lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+
+        try:
+            while True:
+                with self.lock:
+                    conn, returned_at = self.idle.pop() if self.idle else (None, None)
+                if conn is None:
+                    conn = psycopg2.connect(**self.params)
+                    with self.lock:
+                        self.created += 1
+                    return conn
+                if self._is_healthy(conn, returned_at):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._release_slot()
+            raise
+
+    def putconn(self, conn, broken: bool = False):
+        if self.pid != os.getpid():
+            # borrowed before the fork, the connection belongs to the parent process
+            return
+        if broken or conn.closed:
+            self._discard(conn)
+        else:
+            with self.lock:
+                self.idle.append((conn, time.time()))
+        self._release_slot()
+
+    def _release_slot(self):
+        with self.lock:
+            self.in_use -= 1
+        self.slots.release()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Same as `with psycopg2.connect(...) as conn`: commits on success, rolls back on error,
+        then the connection goes back to the pool instead of staying open.
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            broken = conn.closed != 0
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            self.putconn(conn, broken)
+            raise
+        except BaseException:
+            self.putconn(conn, True)
+            raise
+        else:
+            self.putconn(conn)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'pid': self.pid,
+                'max_connections': self.max_connections,
+                'idle': len(self.idle),
+                'in_use': self.in_use,
+                'acquired': self.acquired,
+                'created': self.created,
+                'discarded': self.discarded,
+                'timeouts': self.timeouts,
+                'avg_wait_time': self.wait_time / self.acquired if self.acquired else None,
+                'max_wait_time': self.max_wait_time,
+            }
+
+
+class ConnectionPools:
+    """
+    Pools by the config section name (`blockchain_data`, `custom_data`), created on the first use.
+    """
+    def __init__(self, config: dict = config):
+        self.config = config
+        self.max_connections = DB_POOL_MAX_CONNECTIONS
+        self.timeout = DB_POOL_TIMEOUT
+        self.pools: Dict[str, ConnectionPool] = {}
+        self.lock = threading.Lock()
+
+    def init(self, max_connections: int = DB_POOL_MAX_CONNECTIONS, timeout: float = DB_POOL_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+    def get_pool(self, name: str) -> ConnectionPool:
+        pool = self.pools.get(name)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.get(name)
+                if pool is None:
+                    pool = self.pools[name] = ConnectionPool(name, self.config[name], self.max_connections,
+                                                             self.timeout)
+        return pool
+
+    def connection(self, name: str):
+        """
+        Pooled connection of the `name` database from the config: `with db.connection('custom_data') as conn:`
+        """
+        return self.get_pool(name).connection()
+
+    def status(self) -> dict:
+        return {name: pool.status() for name, pool in self.pools.items()}
+
+
+db = ConnectionPools()
@@ -0,0 +1,167 @@
+import os
+import mmap
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Optional
+from .cache import CACHE_KEY_PREFIX, get_cache_dir
+
+SHARED_CACHE_TTL = 3600
+SHARED_CACHE_LOCK_TIMEOUT = 60
+
+
+class RedisBackend:
+    def __init__(self, client, ttl: int = SHARED_CACHE_TTL, lock_timeout: int = SHARED_CACHE_LOCK_TIMEOUT):
+        self.client = client
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs):
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: bytes):
+        self.client.set(key, value, ex=self.ttl)
+
+    def lock(self, key: str):
+        return self.client.lock(f'{key}:lock', timeout=self.lock_timeout, blocking_timeout=self.lock_timeout)
+
+
+class FileLock:
+    def __init__(self, path: str, timeout: int):
+        self.path = path
+        self.timeout = timeout
+        self.fp = None
+
+    def acquire(self) -> bool:
+        self.fp = open(self.path, 'a')
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() > deadline:
+                    self.fp.close()
+                    self.fp = None
+                    return False
+                time.sleep(0.05)
+
+    def release(self):
+        if self.fp is not None:
+            fcntl.flock(self.fp, fcntl.LOCK_UN)
+            self.fp.close()
+            self.fp = None
+
+
+class FileBackend:
+    """
+    One file per key for the single host deployments. The files are written to a temporary file and renamed,
+    so the readers never see a partial value, and read through mmap.
+    The keys of a dataset version are kept in the same directory, the directories of the old versions are removed.
+    """
+    def __init__(self, path: str, ttl: int = SHARED_CACHE_TTL, lock_timeout: int = SHARED_CACHE_LOCK_TIMEOUT,
+                 keep_versions: int = 2):
+        self.path = path
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self.keep_versions = keep_versions
+
+    def _file_path(self, key: str) -> str:
+        # `<prefix><version>:...`, the directory is the namespace of the dataset version
+        namespace = key.split(':', 2)[:2]
+        return os.path.join(self.path, hashlib.sha1(':'.join(namespace).encode()).hexdigest()[:16],
+                            hashlib.sha1(key.encode()).hexdigest())
+
+    def get(self, key: str) -> Optional[bytes]:
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, 'rb') as fp:
+                if time.time() - os.fstat(fp.fileno()).st_mtime > self.ttl:
+                    return None
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    return data[:]
+        except (FileNotFoundError, ValueError):
+            # ValueError is raised by mmap for the empty files
+            return None
+
+    def _make_dirs(self, file_path: str) -> str:
+        directory = os.path.dirname(file_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            self._cleanup(directory)
+
+        return directory
+
+    def set(self, key: str, value: bytes):
+        file_path = self._file_path(key)
+        directory = self._make_dirs(file_path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(value)
+        os.replace(tmp_path, file_path)
+
+    def lock(self, key: str):
+        file_path = self._file_path(key)
+        self._make_dirs(file_path)
+
+        return FileLock(f'{file_path}.lock', self.lock_timeout)
+
+    def _cleanup(self, current: str):
+        directories = sorted(
+            (entry for entry in os.scandir(self.path) if entry.is_dir() and entry.path != current),
+            key=lambda entry: entry.stat().st_mtime,
+            reverse=True
+        )
+        for entry in directories[self.keep_versions - 1:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class SharedCache:
+    """
+    Cache of serialized (bytes) results shared by the workers, nothing is pickled. The keys are tuples which start
+    with the dataset version, e.g. (version, price, 'data'), and are namespaced as `cbeci:<version>:<price>:data`.
+    """
+    def __init__(self, backend=None, prefix: str = CACHE_KEY_PREFIX):
+        self.backend = backend
+        self.prefix = prefix
+
+    def init(self, backend):
+        self.backend = backend
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def make_key(self, key: tuple) -> str:
+        return self.prefix + ':'.join(str(part) for part in key)
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        return self.backend.get(self.make_key(key))
+
+    def set(self, key: tuple, value: bytes):
+        self.backend.set(self.make_key(key), value)
+
+    def lock(self, key: tuple):
+        return self.backend.lock(self.make_key(key))
+
+
+def get_shared_backend():
+    cache_type = os.environ.get('CACHE_TYPE')
+    if cache_type == 'RedisCache':
+        return RedisBackend.from_url(os.environ['CACHE_REDIS_URL'])
+    if cache_type == 'FileSystemCache':
+        return FileBackend(os.path.join(get_cache_dir(), 'shared'))
+    logging.info('Shared cache is disabled, set CACHE_TYPE to RedisCache or FileSystemCache to enable it')
+
+    return None
+
+
+shared_cache = SharedCache()
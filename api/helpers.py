@@ -1,34 +1,77 @@
 # from .extensions import cache
 import calendar
-import psycopg2.extras
-from config import config
+from typing import Dict, List, Sequence
+import numpy as np
+from extensions import db
 
 # =============================================================================
 # functions for loading data
 # =============================================================================
 # @cache.memoize()
 def load_typed_hasrates(table='hash_rate_by_types'):
-    with psycopg2.connect(**config['blockchain_data']) as conn:
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        typed_hasrates = {}
-        hash_rate_types = ['s7', 's9']
-        for hash_rate_type in hash_rate_types:
-            cursor.execute(f'SELECT type, value, date FROM {table} WHERE type = %s;', (hash_rate_type,))
-            data = cursor.fetchall()
-            formatted_data = {}
-            for row in data:
-                formatted_data[calendar.timegm(row['date'].timetuple())] = row
-            typed_hasrates[hash_rate_type] = formatted_data
-    return typed_hasrates
+    with db.connection('blockchain_data') as conn:
+        cursor = conn.cursor()
+        # all the types at once, the types are the ones found in the table
+        cursor.execute(f'SELECT type, date, value FROM {table} ORDER BY date;')
+        rows = cursor.fetchall()
+    return TypedHashRates.from_columns(
+        [row[0] for row in rows],
+        [calendar.timegm(row[1].timetuple()) for row in rows],
+        [row[2] for row in rows]
+    )
 
 # =============================================================================
 # functions for hash rate calculation
 # =============================================================================
-def get_hash_rates_by_miners_types(typed_hasrates, timestamp):
-    hash_rates = {}
-    for miner_type, hr in typed_hasrates.items():
-        hash_rates[miner_type] = hr[timestamp]['value']
-    return hash_rates
+class TypedHashRates:
+    """
+    Hash rate shares of the miner types as a days x types matrix. The days missing for a type take the value
+    of the previous day, the days before the first value of a type are 0.
+    """
+    def __init__(self, types: List[str], timestamps: np.ndarray, values: np.ndarray):
+        self.types = types
+        self.timestamps = timestamps
+        self.values = values
+
+    @classmethod
+    def from_columns(cls, types: Sequence[str], timestamps: Sequence[int], values: Sequence[float]):
+        types = np.asarray(types, dtype=str)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        type_names, type_indexes = np.unique(types, return_inverse=True)
+        days = np.unique(timestamps)
+        matrix = np.full((len(days), len(type_names)), np.nan)
+        matrix[np.searchsorted(days, timestamps), type_indexes] = np.asarray(values, dtype=np.float64)
+
+        # forward fill: every cell takes the last known row of its column
+        known = ~np.isnan(matrix)
+        last_known = np.maximum.accumulate(np.where(known, np.arange(len(days))[:, None], 0), axis=0)
+        matrix = matrix[last_known, np.arange(len(type_names))]
+        matrix[np.isnan(matrix)] = 0
+
+        return cls(type_names.tolist(), days, matrix)
+
+    def align(self, timestamps: Sequence[int]) -> np.ndarray:
+        """Rows of the given days (len(timestamps) x types), the last known row is used for the missing days."""
+        positions = np.searchsorted(self.timestamps, np.asarray(timestamps, dtype=np.int64), side='right') - 1
+        if len(self.timestamps) == 0:
+            return np.zeros((len(positions), len(self.types)))
+        aligned = self.values[np.maximum(positions, 0)]
+        aligned[positions < 0] = 0
+
+        return aligned
+
+    def get(self, timestamp: int) -> Dict[str, float]:
+        return dict(zip(self.types, self.align([timestamp])[0].tolist()))
+
+    def efficiencies(self, typed_avg_effciency: Dict[str, float]) -> np.ndarray:
+        """Average efficiency of every type in the column order, 0 for the types without miners."""
+        return np.array([typed_avg_effciency.get(t.lower(), 0) for t in self.types], dtype=np.float64)
+
+    def rows(self) -> List[tuple]:
+        """(type, timestamp, value) of every day and type."""
+        return [(t, timestamp, value) for timestamp, row in zip(self.timestamps.tolist(), self.values.tolist())
+                for t, value in zip(self.types, row)]
+
 
 # @cache.memoize()
 def get_avg_effciency_by_miners_types(miners):
@@ -0,0 +1,33 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# (connect, read) seconds
+HTTP_TIMEOUT = (5, 60)
+HTTP_RETRIES = 3
+# waits 0, 2, 4... seconds between the retries
+HTTP_BACKOFF_FACTOR = 1
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def make_session(retries: int = HTTP_RETRIES, backoff_factor: float = HTTP_BACKOFF_FACTOR,
+                 pool_size: int = 10) -> requests.Session:
+    """
+    Keep-alive session which retries the failed connections and the temporary errors (429, 5xx) with backoff,
+    `Retry-After` of the server is respected. One session is shared by the threads of a crawl.
+    """
+    retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=HTTP_RETRY_STATUSES,
+                  respect_retry_after_header=True)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_json(session: requests.Session, url: str, params=None, timeout=HTTP_TIMEOUT):
+    response = session.get(url, params=params, timeout=timeout)
+    response.raise_for_status()
+
+    return response.json()
@@ -0,0 +1,50 @@
+from typing import Dict, List
+from services.data_snapshot import DataSnapshot, data_snapshots
+
+BITCOIN = 'Bitcoin'
+BITCOIN_COLOR = '#ffb81c'
+
+
+class CountryRanking:
+    """
+    Countries and Bitcoin ranked by the electricity consumption (the countries without data are the last ones),
+    in the format of /api/countries. Built once per data version.
+    """
+    def __init__(self, items: List[dict]):
+        self.items = items
+        self.positions: Dict[str, int] = {item['country']: position for position, item in enumerate(items)}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: DataSnapshot):
+        bitcoin_consumption = round(snapshot['energy_consumption_ma'].last()['guess_consumption'], 2)
+        countries = {row['country']: [row['electricity_consumption'], row['country_flag'], row['code']]
+                     for row in snapshot['countries'].rows()}
+        countries[BITCOIN][0] = bitcoin_consumption
+        ranked = sorted(countries.items(), key=lambda i: -1 if i[1][0] is None else i[1][0], reverse=True)
+
+        items = []
+        for rank, (country, (electricity_consumption, country_flag, code)) in enumerate(ranked, start=1):
+            electricity_consumption = 0 if electricity_consumption is None else electricity_consumption
+            item = {
+                'country': country,
+                'code': code,
+                'y': electricity_consumption,
+                'x': rank,
+                'bitcoin_percentage': round(electricity_consumption / bitcoin_consumption * 100, 2),
+                'logo': country_flag
+            }
+            if country == BITCOIN:
+                item['color'] = BITCOIN_COLOR
+            items.append(item)
+
+        return cls(items)
+
+    def window(self, country: str = BITCOIN, size: int = 5) -> List[dict]:
+        """`size` countries ranked above and below `country`, KeyError for an unknown country."""
+        position = self.positions[country]
+        return self.items[max(position - size, 0):position + size + 1]
+
+
+def get_country_ranking() -> CountryRanking:
+    snapshot = data_snapshots.current()
+    return snapshot.derived('country_ranking', lambda: CountryRanking.from_snapshot(snapshot))
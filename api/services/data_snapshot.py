@@ -0,0 +1,417 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+from types import MappingProxyType
+from typing import Callable, Dict, List, Optional
+import numpy as np
+from config import config, start_date
+from extensions import db
+from helpers import TypedHashRates, load_typed_hasrates
+
+SNAPSHOT_MAX_AGE = 3600
+# every table is a list of columns: (name, dtype). Fixed size dtypes are stored as .npy files and memory mapped
+# by every worker, 'json' columns (short text tables with NULLs) are kept in the snapshot metadata.
+TABLES = {
+    'prof_threshold': [('timestamp', 'int64'), ('date', 'U32'), ('value', 'float64')],
+    'hash_rate': [('timestamp', 'int64'), ('date', 'U32'), ('value', 'float64')],
+    'energy_consumption_ma': [('timestamp', 'int64'), ('date', 'U32'), ('max_consumption', 'float64'),
+                              ('min_consumption', 'float64'), ('guess_consumption', 'float64')],
+    'hash_rate_by_types': [('type', 'U16'), ('timestamp', 'int64'), ('value', 'float64')],
+    'miners': [('miner_name', 'json'), ('unix_date_of_release', 'json'), ('efficiency_j_gh', 'json'), ('qty', 'json'),
+               ('type', 'json')],
+    'countries': [('country', 'json'), ('code', 'json'), ('electricity_consumption', 'json'), ('country_flag', 'json'),
+                  ('series_id', 'json'), ('year', 'json')],
+}
+
+
+def get_snapshot_dir():
+    path = os.environ.get('DATA_SNAPSHOT_DIR')
+    if path:
+        return path
+    # tmpfs keeps the memory mapped tables in the page cache shared by all the workers
+    base_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+    return os.path.join(base_dir, f"cbeci_snapshots_{config['blockchain_data']['dbname']}")
+
+
+def load_tables() -> Dict[str, List[tuple]]:
+    with db.connection('blockchain_data') as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT timestamp, date, value FROM prof_threshold WHERE timestamp >= %s ORDER BY timestamp',
+                       (start_date.timestamp(),))
+        prof_threshold = cursor.fetchall()
+        cursor.execute('SELECT timestamp, date, value FROM hash_rate WHERE timestamp >= %s ORDER BY timestamp',
+                       (start_date.timestamp(),))
+        hash_rate = cursor.fetchall()
+        cursor.execute('SELECT timestamp, date, max_consumption, min_consumption, guess_consumption '
+                       'FROM energy_consumption_ma WHERE timestamp >= %s ORDER BY timestamp',
+                       (start_date.timestamp(),))
+        energy_consumption_ma = cursor.fetchall()
+    typed_hasrates = load_typed_hasrates()
+    with db.connection('custom_data') as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT miner_name, unix_date_of_release, efficiency_j_gh, qty, type '
+                       'FROM miners WHERE is_active is true')
+        miners = cursor.fetchall()
+        cursor.execute('SELECT country, code, electricity_consumption, country_flag, series_id, year FROM countries')
+        countries = cursor.fetchall()
+
+    return {
+        'prof_threshold': prof_threshold,
+        'hash_rate': hash_rate,
+        'energy_consumption_ma': energy_consumption_ma,
+        'hash_rate_by_types': typed_hasrates.rows(),
+        'miners': miners,
+        'countries': countries,
+    }
+
+
+class SnapshotTable:
+    """
+    Read-only columnar table. Numeric columns are numpy arrays (memory mapped when attached from the store).
+    """
+
+    def __init__(self, columns: Dict[str, object]):
+        self.columns = columns
+        self._rows = None
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), []))
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def rows(self) -> List[dict]:
+        """Rows in the RealDictCursor format. Built once, callers must not modify them."""
+        if self._rows is None:
+            names = list(self.columns.keys())
+            values = [column.tolist() if isinstance(column, np.ndarray) else column for column in self.columns.values()]
+            self._rows = [dict(zip(names, row)) for row in zip(*values)]
+        return self._rows
+
+    def last(self) -> Optional[dict]:
+        rows = self.rows()
+        return rows[-1] if len(rows) > 0 else None
+
+
+class DataSnapshot:
+    """
+    Immutable set of the tables the API is serving. A new version is created for every change of the data.
+    """
+
+    def __init__(self, version: str, created_at: float, tables: Dict[str, SnapshotTable]):
+        self.version = version
+        self.created_at = created_at
+        self.tables = MappingProxyType(tables)
+        self._derived = {}
+        self._derived_lock = threading.RLock()
+
+    def __getitem__(self, table) -> SnapshotTable:
+        return self.tables[table]
+
+    def derived(self, key: str, factory: Callable):
+        """Value computed from this version of the data once per process, e.g. an index or a response."""
+        if key not in self._derived:
+            with self._derived_lock:
+                if key not in self._derived:
+                    self._derived[key] = factory()
+        return self._derived[key]
+
+    def typed_hash_rates(self) -> TypedHashRates:
+        """Days x types matrix of the typed hash rates, built from the columns without the rows."""
+        def build():
+            table = self.tables['hash_rate_by_types']
+            return TypedHashRates.from_columns(table['type'], table['timestamp'], table['value'])
+
+        return self.derived('typed_hash_rates', build)
+
+    @classmethod
+    def from_rows(cls, tables_rows: Dict[str, List[tuple]], created_at=None):
+        columns = {}
+        for table, table_columns in TABLES.items():
+            rows = tables_rows[table]
+            columns[table] = {}
+            for i, (column, dtype) in enumerate(table_columns):
+                values = [row[i] for row in rows]
+                if dtype == 'json':
+                    columns[table][column] = values
+                elif dtype.startswith('U'):
+                    columns[table][column] = np.array([str(value) for value in values], dtype=dtype)
+                elif dtype == 'float64':
+                    columns[table][column] = np.array([np.nan if value is None else value for value in values],
+                                                      dtype=dtype)
+                else:
+                    columns[table][column] = np.array(values, dtype=dtype)
+
+        return cls(
+            version=cls.get_version(columns),
+            created_at=time.time() if created_at is None else created_at,
+            tables={table: SnapshotTable(table_columns) for table, table_columns in columns.items()}
+        )
+
+    @staticmethod
+    def get_version(columns) -> str:
+        digest = hashlib.sha1()
+        for table in sorted(columns):
+            for column in sorted(columns[table]):
+                values = columns[table][column]
+                digest.update(f'{table}.{column}'.encode())
+                if isinstance(values, np.ndarray):
+                    digest.update(np.ascontiguousarray(values).tobytes())
+                else:
+                    digest.update(json.dumps(values, default=str).encode())
+        return digest.hexdigest()[:16]
+
+
+class DataSnapshotStore:
+    """
+    Snapshots of the DB tables shared by all the worker processes of the host.
+
+    Every version is written once to a directory (tmpfs by default), numeric columns are `.npy` files which
+    every worker memory maps read-only, so the host keeps one copy of the data whatever the number of workers.
+    `CURRENT` points to the latest version and to the last time the DB was checked. Reloads take a file lock,
+    so only one process queries Postgres, the others wait and attach to the version it has published.
+    """
+    current_file = 'CURRENT'
+    lock_file = '.lock'
+    keep_versions = 2
+
+    def __init__(self, path=None, loader: Callable[[], Dict[str, List[tuple]]] = load_tables):
+        self._path = path
+        self.loader = loader
+        self._snapshot = None
+        self._pointer = None
+        self._lock = threading.Lock()
+        # the last time this process has loaded the tables from the DB
+        self.last_load_at = None
+        self.last_load_duration = None
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = get_snapshot_dir()
+        return self._path
+
+    @property
+    def snapshot(self) -> Optional[DataSnapshot]:
+        return self._snapshot
+
+    @property
+    def checked_at(self) -> Optional[float]:
+        """The last time the DB was checked by any process of the host."""
+        return self._pointer['checked_at'] if self._pointer is not None else None
+
+    def current(self) -> DataSnapshot:
+        """Snapshot of this process, loads or attaches to one on the first call."""
+        if self._snapshot is None:
+            return self.load()
+        return self._snapshot
+
+    def load(self, max_age=SNAPSHOT_MAX_AGE) -> DataSnapshot:
+        """
+        Returns the published snapshot if the DB was checked less than `max_age` seconds ago,
+        otherwise loads the tables from the DB (once for the whole host) and publishes a new version.
+        """
+        with self._lock:
+            os.makedirs(self.path, exist_ok=True)
+            pointer = self._read_pointer()
+            if pointer is None or time.time() - pointer['checked_at'] >= max_age:
+                with self._file_lock():
+                    # another process could have reloaded the data while we were waiting for the lock
+                    pointer = self._read_pointer()
+                    if pointer is None or time.time() - pointer['checked_at'] >= max_age:
+                        try:
+                            pointer = self._publish(self._load_from_db())
+                        except Exception:
+                            # keep serving the last published version while the DB is not available
+                            if self._snapshot is None and pointer is not None:
+                                self._snapshot = self._attach(pointer)
+                                self._pointer = pointer
+                            raise
+            # swapping the reference is atomic, readers get either the old or the new snapshot
+            self._snapshot = self._attach(pointer)
+            self._pointer = pointer
+            return self._snapshot
+
+    def _load_from_db(self) -> DataSnapshot:
+        started_at = time.time()
+        snapshot = DataSnapshot.from_rows(self.loader())
+        self.last_load_at = started_at
+        self.last_load_duration = time.time() - started_at
+        return snapshot
+
+    def _attach(self, pointer) -> DataSnapshot:
+        if self._snapshot is not None and self._snapshot.version == pointer['version']:
+            return self._snapshot
+
+        version_dir = os.path.join(self.path, pointer['version'])
+        with open(os.path.join(version_dir, 'meta.json')) as fp:
+            meta = json.load(fp)
+        tables = {}
+        for table, table_columns in TABLES.items():
+            columns = {}
+            for column, dtype in table_columns:
+                if dtype == 'json':
+                    columns[column] = meta['columns'][table][column]
+                else:
+                    columns[column] = np.load(os.path.join(version_dir, f'{table}.{column}.npy'), mmap_mode='r')
+            tables[table] = SnapshotTable(columns)
+
+        return DataSnapshot(version=pointer['version'], created_at=meta['created_at'], tables=tables)
+
+    def _publish(self, snapshot: DataSnapshot):
+        version_dir = os.path.join(self.path, snapshot.version)
+        if not os.path.isdir(version_dir):
+            tmp_dir = f'{version_dir}.tmp-{os.getpid()}'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            meta = {'created_at': snapshot.created_at, 'columns': {}}
+            for table, table_columns in TABLES.items():
+                meta['columns'][table] = {}
+                for column, dtype in table_columns:
+                    values = snapshot[table][column]
+                    if dtype == 'json':
+                        meta['columns'][table][column] = values
+                    else:
+                        np.save(os.path.join(tmp_dir, f'{table}.{column}.npy'), values, allow_pickle=False)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as fp:
+                json.dump(meta, fp, default=str)
+            os.rename(tmp_dir, version_dir)
+
+        pointer = {'version': snapshot.version, 'checked_at': time.time()}
+        self._write_json(os.path.join(self.path, self.current_file), pointer)
+        self._cleanup(snapshot.version)
+
+        return pointer
+
+    def _cleanup(self, current_version):
+        versions = [entry for entry in os.scandir(self.path) if entry.is_dir() and entry.name != current_version]
+        versions.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        # workers which did not switch yet keep using their mapping even after the files are removed
+        for entry in versions[self.keep_versions - 1:]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _read_pointer(self):
+        try:
+            with open(os.path.join(self.path, self.current_file)) as fp:
+                pointer = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if not os.path.isdir(os.path.join(self.path, pointer.get('version', ''))):
+            return None
+        return pointer
+
+    @staticmethod
+    def _write_json(filename, data):
+        tmp_filename = f'{filename}.tmp-{os.getpid()}'
+        with open(tmp_filename, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp_filename, filename)
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(os.path.join(self.path, self.lock_file), 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class SnapshotRefresher:
+    """
+    Background thread keeping the snapshot of the worker up to date.
+
+    Every `poll_interval` seconds it attaches to the version published by another worker or, when the data is
+    older than `max_age`, reloads it from the DB. Requests never wait for the DB: they are served from the current
+    snapshot while a reload is in progress or when it fails.
+    """
+
+    def __init__(self, store: DataSnapshotStore, max_age=SNAPSHOT_MAX_AGE, poll_interval=60):
+        self.store = store
+        self.max_age = max_age
+        self.poll_interval = poll_interval
+        self.on_error = None
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self.refreshing = False
+        self.last_refresh_at = None
+        self.last_refresh_duration = None
+        self.last_success_at = None
+        self.last_error = None
+        self.failures = 0
+
+    def init(self, max_age=None, poll_interval=None, on_error: Callable[[Exception], None] = None):
+        if max_age is not None:
+            self.max_age = max_age
+        if poll_interval is not None:
+            self.poll_interval = poll_interval
+        self.on_error = on_error
+
+    def start(self):
+        # threads do not survive fork(), so every worker process starts its own refresher
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='snapshot-refresher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            self.refresh()
+
+    def refresh(self):
+        self.refreshing = True
+        self.last_refresh_at = time.time()
+        try:
+            self.store.load(max_age=self.max_age)
+        except Exception as error:
+            self.failures += 1
+            self.last_error = f'{type(error).__name__}: {error}'
+            # report the first failure only, the next attempts are made every `poll_interval` seconds
+            if self.failures == 1 and callable(self.on_error):
+                self.on_error(error)
+        else:
+            self.failures = 0
+            self.last_error = None
+            self.last_success_at = time.time()
+        finally:
+            self.last_refresh_duration = time.time() - self.last_refresh_at
+            self.refreshing = False
+
+    def status(self) -> dict:
+        now = time.time()
+        snapshot = self.store.snapshot
+        checked_at = self.store.checked_at
+
+        return {
+            'version': snapshot.version if snapshot is not None else None,
+            'created_at': snapshot.created_at if snapshot is not None else None,
+            'age': now - snapshot.created_at if snapshot is not None else None,
+            'checked_at': checked_at,
+            'check_age': now - checked_at if checked_at is not None else None,
+            'max_age': self.max_age,
+            'refreshing': self.refreshing,
+            'last_refresh_at': self.last_refresh_at,
+            'last_refresh_duration': self.last_refresh_duration,
+            'last_success_at': self.last_success_at,
+            'last_error': self.last_error,
+            'failures': self.failures,
+            'last_db_load_at': self.store.last_load_at,
+            'last_db_load_duration': self.store.last_load_duration,
+        }
+
+
+data_snapshots = DataSnapshotStore()
+snapshot_refresher = SnapshotRefresher(data_snapshots)
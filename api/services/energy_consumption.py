@@ -1,8 +1,7 @@
-from extensions import cache
-from config import config, start_date
+from extensions import cache, db
+from config import start_date
 from typing import List, Dict, Union
 from datetime import datetime
-import psycopg2
 import psycopg2.extras
 import pandas as pd
 
@@ -10,7 +9,7 @@ table_prefix = 'blockchain_info_'
 
 @cache.cached(key_prefix=f'actual-{table_prefix}prof_threshold')
 def get_prof_thresholds():
-    with psycopg2.connect(**config['blockchain_data']) as conn:
+    with db.connection('blockchain_data') as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         cursor.execute(f'SELECT timestamp, date, value FROM {table_prefix}prof_threshold WHERE timestamp >= %s',
                        (start_date.timestamp(),))
@@ -19,7 +18,7 @@ def get_prof_thresholds():
 
 @cache.cached(key_prefix=f'actual-{table_prefix}hash_rate')
 def get_hash_rates():
-    with psycopg2.connect(**config['blockchain_data']) as conn:
+    with db.connection('blockchain_data') as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         cursor.execute(f'SELECT timestamp, date, value FROM {table_prefix}hash_rate WHERE timestamp >= %s', (start_date.timestamp(),))
         return cursor.fetchall()
@@ -27,7 +26,7 @@ def get_hash_rates():
 
 @cache.cached(key_prefix=f'actual-{table_prefix}miners')
 def get_miners():
-    with psycopg2.connect(**config['custom_data']) as conn:
+    with db.connection('custom_data') as conn:
         cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         cursor.execute(
             'SELECT miner_name, unix_date_of_release, efficiency_j_gh, qty, type FROM miners WHERE is_active is true')
@@ -38,7 +37,7 @@ class EnergyConsumption(object):
     # that is because base calculation in the DB is for the price 0.05 USD/KWth
     default_price = 0.05
 
-    def get_data(self, price: float):
+    def get_frame(self, price: float) -> pd.DataFrame:
         def get_profitability_equipment(price: float, timestamp: int, prof_threshold_value: float) -> List[float]:
             profitability_equipment = []
             price_coefficient = self.default_price / price
@@ -112,4 +111,7 @@ class EnergyConsumption(object):
         energy_df = pd.DataFrame(smooth_consumptions).sort_values(by='timestamp').set_index('timestamp') \
             .rolling(window=7, min_periods=1).mean()
 
-        return energy_df.iterrows()
+        return energy_df
+
+    def get_data(self, price: float):
+        return self.get_frame(price).iterrows()
@@ -1,43 +1,26 @@
-from extensions import cache
-from config import config, start_date
 from typing import List, Dict, Union
 from datetime import datetime
-from helpers import load_typed_hasrates, get_avg_effciency_by_miners_types, get_hash_rates_by_miners_types, get_guess_consumption
-import psycopg2
-import psycopg2.extras
+from helpers import get_avg_effciency_by_miners_types, get_guess_consumption
+from services.data_snapshot import data_snapshots
 import pandas as pd
 
-@cache.cached(key_prefix='actual-prof_threshold')
 def get_prof_thresholds():
-    with psycopg2.connect(**config['blockchain_data']) as conn:
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute('SELECT timestamp, date, value FROM prof_threshold WHERE timestamp >= %s',
-                       (start_date.timestamp(),))
-        return cursor.fetchall()
+    return data_snapshots.current()['prof_threshold'].rows()
 
 
-@cache.cached(key_prefix='actual-hash_rate')
 def get_hash_rates():
-    with psycopg2.connect(**config['blockchain_data']) as conn:
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute('SELECT timestamp, date, value FROM hash_rate WHERE timestamp >= %s', (start_date.timestamp(),))
-        return cursor.fetchall()
+    return data_snapshots.current()['hash_rate'].rows()
 
 
-@cache.cached(key_prefix='actual-miners')
 def get_miners():
-    with psycopg2.connect(**config['custom_data']) as conn:
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cursor.execute(
-            'SELECT miner_name, unix_date_of_release, efficiency_j_gh, qty, type FROM miners WHERE is_active is true')
-        return cursor.fetchall()
+    return data_snapshots.current()['miners'].rows()
 
 
 class EnergyConsumptionByTypes(object):
     # that is because base calculation in the DB is for the price 0.05 USD/KWth
     default_price = 0.05
 
-    def get_data(self, price: float):
+    def get_frame(self, price: float) -> pd.DataFrame:
         def get_profitability_equipment(price: float, timestamp: int, prof_threshold_value: float) -> List[float]:
             profitability_equipment = []
             price_coefficient = self.default_price / price
@@ -52,7 +35,7 @@ class EnergyConsumptionByTypes(object):
 
         def get_date_consumption(price: float, timestamp: int, prof_threshold_value: float
                                  ) -> Union[Dict[str, float], None]:
-            hash_rates = get_hash_rates_by_miners_types(typed_hasrates, timestamp)
+            hash_rates = typed_hasrates.get(timestamp)
             profitability_equipment = get_profitability_equipment(price, timestamp, prof_threshold_value)
             if len(profitability_equipment) == 0:
                 return {
@@ -98,7 +81,7 @@ class EnergyConsumptionByTypes(object):
         prof_thresholds = get_prof_thresholds()
         hash_rates = get_hash_rates()
         miners = get_miners()
-        typed_hasrates = load_typed_hasrates()
+        typed_hasrates = data_snapshots.current().typed_hash_rates()
         typed_avg_effciency = get_avg_effciency_by_miners_types(miners)
 
         hash_rates_df = pd.DataFrame(hash_rates).drop('date', axis=1).set_index('timestamp')
@@ -114,4 +97,7 @@ class EnergyConsumptionByTypes(object):
         energy_df = pd.DataFrame(smooth_consumptions).sort_values(by='timestamp').set_index('timestamp') \
             .rolling(window=7, min_periods=1).mean()
 
-        return energy_df.iterrows()
+        return energy_df
+
+    def get_data(self, price: float):
+        return self.get_frame(price).iterrows()
@@ -0,0 +1,146 @@
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from helpers import TypedHashRates
+from services.energy_calculation_service import EnergyCalculationService
+
+
+class EnergyConsumptionEngine:
+    """
+    Columnar version of the day by day calculation in EnergyConsumptionPowerByTypes.
+
+    For a fixed day the profitable equipment only depends on how many released miners have an
+    efficiency below `prof_threshold * 0.05 / price`, so the engine keeps a per-day breakpoint
+    index: efficiencies of the released miners sorted ascending and the average efficiency of
+    every prefix of that order. Any price is then answered with one binary search per day.
+
+    The float operations are done in the same order as in EnergyCalculationService so the
+    numbers match the row by row calculation, except the typed term of the guess which is one
+    matrix-vector product for any number of miner types (equal up to the float rounding).
+    """
+    # that is because base calculation in the DB is for the price 0.05 USD/KWth
+    default_price = 0.05
+    columns = ['min_consumption', 'max_consumption', 'guess_consumption', 'min_power', 'max_power', 'guess_power']
+
+    def __init__(self, timestamps, prof_thresholds_ma, hash_rates, miners_release_dates, miners_efficiencies,
+                 typed_hash_rates, typed_avg_efficiency):
+        self.energy_calculation_service = EnergyCalculationService()
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+        self.prof_thresholds_ma = np.asarray(prof_thresholds_ma, dtype=np.float64)
+        self.hash_rates = np.asarray(hash_rates, dtype=np.float64)
+        self.miners_efficiencies = np.asarray(miners_efficiencies, dtype=np.float64)
+        # days x types matrix and the average efficiency of each type
+        self.typed_hash_rates = np.asarray(typed_hash_rates, dtype=np.float64).reshape(len(self.timestamps), -1)
+        self.typed_avg_efficiency = np.asarray(typed_avg_efficiency, dtype=np.float64)
+        # the typed term of the guess efficiency does not depend on the price
+        self.typed_efficiency = self.typed_hash_rates @ self.typed_avg_efficiency
+        self._build_index(np.asarray(miners_release_dates, dtype=np.int64))
+
+    def _build_index(self, release_dates: np.ndarray):
+        miners_qty = release_dates.size
+        release_order = np.argsort(release_dates, kind='stable')
+        # number of miners released before each day. The released set only changes on release dates,
+        # so the days share at most `miners_qty + 1` different indexes.
+        self.released_qty = np.searchsorted(release_dates[release_order], self.timestamps, side='left')
+        # released qty x miners: efficiencies of the released miners in ascending order, inf for the rest
+        self.sorted_efficiencies = np.full((miners_qty + 1, miners_qty), np.inf)
+        # released qty x (miners + 1): average efficiency of the `n` cheapest released miners
+        self.avg_efficiencies = np.full((miners_qty + 1, miners_qty + 1), np.nan)
+
+        for released_qty in np.unique(self.released_qty).tolist():
+            if released_qty == 0:
+                continue
+            released = np.zeros(miners_qty, dtype=bool)
+            released[release_order[:released_qty]] = True
+            efficiencies = np.where(released, self.miners_efficiencies, np.inf)
+            order = np.argsort(efficiencies, kind='stable')
+            self.sorted_efficiencies[released_qty] = efficiencies[order]
+
+            ranks = np.empty(miners_qty, dtype=np.int64)
+            ranks[order] = np.arange(miners_qty)
+            qty = np.arange(1, released_qty + 1)
+            selected = released[None, :] & (ranks[None, :] < qty[:, None])
+            # sums are accumulated in the catalog order (cumsum), exactly like sum() over the list
+            sums = np.where(selected, self.miners_efficiencies[None, :], 0.0).cumsum(axis=1)[:, -1]
+            self.avg_efficiencies[released_qty, 1:released_qty + 1] = sums / qty
+
+    @classmethod
+    def from_rows(cls, prof_thresholds: List[dict], hash_rates: List[dict], miners: List[dict],
+                  typed_hash_rates: TypedHashRates, typed_avg_efficiency: Dict[str, float]):
+        prof_thresholds_df = pd.DataFrame(prof_thresholds, columns=['timestamp', 'date', 'value']) \
+            .sort_values(by='timestamp') \
+            .drop('date', axis=1) \
+            .set_index('timestamp')
+        prof_thresholds_ma_df = prof_thresholds_df.rolling(window=14, min_periods=1).mean()
+        timestamps = prof_thresholds_ma_df.index.to_numpy(dtype=np.int64)
+
+        hash_rates_series = pd.DataFrame(hash_rates, columns=['timestamp', 'date', 'value']) \
+            .set_index('timestamp')['value']
+        # days without the hash rate are treated as gaps and carried forward like unprofitable days
+        hash_rates_values = hash_rates_series[~hash_rates_series.index.duplicated()].reindex(timestamps)
+
+        untyped_miners = [miner for miner in miners if not miner['type']]
+
+        return cls(
+            timestamps=timestamps,
+            prof_thresholds_ma=prof_thresholds_ma_df['value'].to_numpy(dtype=np.float64),
+            hash_rates=hash_rates_values.to_numpy(dtype=np.float64),
+            miners_release_dates=[miner['unix_date_of_release'] for miner in untyped_miners],
+            miners_efficiencies=[miner['efficiency_j_gh'] for miner in untyped_miners],
+            typed_hash_rates=typed_hash_rates.align(timestamps),
+            typed_avg_efficiency=typed_hash_rates.efficiencies(typed_avg_efficiency)
+        )
+
+    def profitable_qty(self, price: float) -> np.ndarray:
+        """Number of profitable miners for every day, i.e. the position of the threshold in the day's index."""
+        price_coefficient = self.default_price / price
+        thresholds = self.prof_thresholds_ma * price_coefficient
+        last = max(self.sorted_efficiencies.shape[1] - 1, 0)
+
+        low = np.zeros(len(self.timestamps), dtype=np.int64)
+        high = self.released_qty.astype(np.int64)
+        # vectorised binary search: first miner of the day that is not cheaper than the threshold
+        while True:
+            searching = low < high
+            if not searching.any():
+                break
+            middle = (low + high) // 2
+            below = self.sorted_efficiencies[self.released_qty, np.minimum(middle, last)] < thresholds
+            low = np.where(searching & below, middle + 1, low)
+            high = np.where(searching & ~below, middle, high)
+
+        return low
+
+    def get_frame(self, price: float) -> pd.DataFrame:
+        service = self.energy_calculation_service
+        qty = self.profitable_qty(price)
+        profitable = (qty > 0) & ~np.isnan(self.hash_rates)
+        index = self.released_qty
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if self.sorted_efficiencies.shape[1] > 0:
+                min_efficiency = np.where(qty > 0, self.sorted_efficiencies[index, 0], np.nan)
+                max_efficiency = np.where(qty > 0, self.sorted_efficiencies[index, np.maximum(qty - 1, 0)], np.nan)
+                avg_efficiency = self.avg_efficiencies[index, qty]
+            else:
+                min_efficiency = max_efficiency = avg_efficiency = np.full(len(self.timestamps), np.nan)
+
+            guess_efficiency = avg_efficiency + self.typed_efficiency
+
+            # unprofitable days take the value of the previous day (0 at the start of the history)
+            hash_rate = np.where(profitable, self.hash_rates, np.nan)
+            days, hours = service.avg_days_in_year, service.hours_in_day
+            data = {
+                'min_consumption': min_efficiency * hash_rate * days * hours / 1e9 * service.min_coefficient,
+                'max_consumption': max_efficiency * hash_rate * days * hours / 1e9 * service.max_coefficient,
+                'guess_consumption': guess_efficiency * hash_rate * days * hours / 1e9 * service.guess_coefficient,
+                'min_power': min_efficiency * hash_rate / 1e6 * service.min_coefficient,
+                'max_power': max_efficiency * hash_rate / 1e6 * service.max_coefficient,
+                'guess_power': guess_efficiency * hash_rate / 1e6 * service.guess_coefficient,
+            }
+
+        energy_df = pd.DataFrame(data, index=pd.Index(self.timestamps, name='timestamp'), columns=self.columns) \
+            .ffill() \
+            .fillna(0)
+
+        return energy_df.rolling(window=7, min_periods=1).mean()
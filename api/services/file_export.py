@@ -0,0 +1,92 @@
+import io
+import csv
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+import numpy as np
+from flask import Response
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# rows written to the buffer before a chunk is sent
+CSV_CHUNK_ROWS = 1000
+# typed formats: (mimetype, file extension)
+TABLE_FILE_TYPES = {
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+}
+
+
+def iter_columns(columns: Sequence[np.ndarray]) -> Iterator[tuple]:
+    """
+    Rows of the columnar data, the missing float values (NaN) are written as empty cells like NULL.
+    """
+    def to_list(column):
+        column = np.asarray(column)
+        if column.dtype.kind == 'f':
+            nans = np.isnan(column)
+            if nans.any():
+                column = column.astype(object)
+                column[nans] = None
+        return column.tolist()
+
+    return zip(*(to_list(column) for column in columns))
+
+
+def iter_csv(header: List[str], rows: Iterable[Sequence], first_line: Optional[str] = None) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if first_line is not None and len(header) > 0:
+        writer.writerow([first_line] + [''] * (len(header) - 1))
+    writer.writerow(header)
+
+    for index, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if index % CSV_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def send_csv(chunks: Iterator[str], filename: str = 'export.csv') -> Response:
+    """
+    Streams the chunks with chunked transfer encoding, the whole file is never kept in memory.
+    """
+    return Response(chunks, mimetype='text/csv', headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+def to_arrow_table(columns: Dict[str, Sequence], metadata: Optional[Dict[str, str]] = None):
+    """
+    numpy columns without missing values (int64, float64, datetime64) are wrapped by arrow without a copy,
+    the other columns (e.g. the DB rows) are converted with the type inference of arrow.
+    """
+    arrays = {}
+    for name, column in columns.items():
+        if isinstance(column, np.ndarray):
+            arrays[name] = pa.array(column, from_pandas=column.dtype.kind == 'f')
+        else:
+            arrays[name] = pa.array(column)
+
+    return pa.table(arrays, metadata=metadata)
+
+
+def send_table(columns: Dict[str, Sequence], file_type: str, metadata: Optional[Dict[str, str]] = None,
+               filename: str = 'export') -> Response:
+    if pa is None:
+        raise NotImplementedError(f'{file_type} export is not available, pyarrow is not installed')
+
+    table = to_arrow_table(columns, metadata)
+    sink = pa.BufferOutputStream()
+    if file_type == 'parquet':
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    mimetype, extension = TABLE_FILE_TYPES[file_type]
+    return Response(sink.getvalue().to_pybytes(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}.{extension}'})
@@ -0,0 +1,100 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+PRICE_SIGNIFICANT_DIGITS = 4
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+def canonical_price(price: float, digits: int = PRICE_SIGNIFICANT_DIGITS) -> float:
+    """
+    Quantizes the electricity price, so `0.05`, `0.050` and `0.0500001` are the same request.
+    """
+    price = float(price)
+    if not math.isfinite(price) or price <= 0:
+        raise ValueError(f'Invalid electricity price: {price}')
+
+    return float(f'{price:.{digits}g}')
+
+
+class ResultCache:
+    """
+    LRU cache of the serialized results by (dataset version, ...) bounded by the total size (`len`) of the values.
+    Entries of the previous dataset versions are dropped as soon as a result of a newer version is stored.
+    """
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def init(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def get(self, key: tuple):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+            return value
+
+    def set(self, key: tuple, value):
+        version = key[0]
+        with self.lock:
+            if version != self.version:
+                self.evictions += len(self.entries)
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            if len(value) > self.max_bytes:
+                return
+            self.entries[key] = value
+            self.size += len(value)
+            self._evict()
+
+    def get_or_set(self, key: tuple, factory: Callable[[], bytes]) -> bytes:
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+
+        return value
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            _, value = self.entries.popitem(last=False)
+            self.size -= len(value)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def status(self) -> dict:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                'version': self.version,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / requests if requests else None,
+            }
+
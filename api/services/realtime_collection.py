@@ -1,23 +1,104 @@
-from google.cloud.firestore_v1 import CollectionReference
+import os
+import gzip
+import json
+import time
+import logging
+import datetime
+import threading
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
 from firebase_admin import firestore
 from services.firebase import Collections
 
+REALTIME_COLLECTIONS_CACHE_DIR = '../storage/realtime_collections'
 
-class RealtimeCollection:
 
-    def __init__(self, collection):
+class CollectionIndex:
+    """
+    Projected docs of a collection grouped by the keys returned by `keys(doc)` (a doc can be in several groups,
+    or in none), every group being a ready list payload sorted by `sort_key` (kept in the order of the changes
+    otherwise). It is updated incrementally: only the groups of a changed doc are rebuilt.
+    """
+    def __init__(self, keys: Callable[[dict], Iterable[Hashable]], projection: Optional[Callable[[dict], dict]] = None,
+                 sort_key: Optional[Callable[[dict], object]] = None):
+        self.keys = keys
+        self.projection = projection
+        self.sort_key = sort_key
+        # doc id -> keys of the groups of the doc
+        self._members: Dict[str, tuple] = {}
+        # key -> {doc id: projected doc}
+        self._groups: Dict[Hashable, Dict[str, dict]] = {}
+        self._lists: Dict[Hashable, List[dict]] = {}
+
+    def update(self, doc_id: str, doc: Optional[dict]) -> set:
+        """Moves the doc (None when removed) to its groups, returns the keys of the changed groups."""
+        old_keys = self._members.pop(doc_id, ())
+        new_keys = () if doc is None else tuple(dict.fromkeys(self.keys(doc)))
+        for key in old_keys:
+            if key not in new_keys:
+                self._groups[key].pop(doc_id, None)
+        if new_keys:
+            self._members[doc_id] = new_keys
+            projected = doc if self.projection is None else self.projection(doc)
+            for key in new_keys:
+                self._groups.setdefault(key, {})[doc_id] = projected
+
+        return set(old_keys) | set(new_keys)
+
+    def refresh(self, keys: Iterable[Hashable]):
+        lists = dict(self._lists)
+        for key in keys:
+            docs = list(self._groups.get(key, {}).values())
+            if not docs:
+                self._groups.pop(key, None)
+                lists.pop(key, None)
+                continue
+            if self.sort_key is not None:
+                docs.sort(key=self.sort_key)
+            lists[key] = docs
+        # the lists are replaced at once, the requests never see a partial update
+        self._lists = lists
+
+    def clear(self):
+        self._members = {}
+        self._groups = {}
+        self._lists = {}
+
+    def get(self, key: Hashable) -> List[dict]:
+        return self._lists.get(key, [])
+
+
+class RealtimeCollection:
+    """
+    Docs of a firestore collection kept up to date by a snapshot listener. With a `cache_path`, every live
+    snapshot is persisted to that file, and the file is loaded before subscribing, so a fresh worker serves
+    the last known docs (warm) until the first live snapshot, which replaces them (live).
+    """
+    def __init__(self, collection, cache_path: Optional[str] = None):
         super().__init__()
-        if isinstance(collection, CollectionReference):
-            self.collectionRf = collection
-        else:
+        # a CollectionReference, or a fake one in tests
+        if isinstance(collection, str):
             self.collectionRf = firestore.client().collection(collection)
+        else:
+            self.collectionRf = collection
+        self.cache_path = cache_path
         self._docs = {}
         self._unsubscribe = None
         self._loaded = False
+        # incremented after every applied snapshot, the views built from the docs are rebuilt when it changes
+        self.revision = 0
+        self._listeners = []
+        self._indexes: Dict[str, CollectionIndex] = {}
+        self._lock = threading.Lock()
+        self.warm_saved_at = None
+        self.live_since = None
+        self.persisted_at = None
+        self.last_error = None
 
         self.init()
 
     def init(self):
+        if self.cache_path:
+            self._load_cache()
         self._subscribe()
 
     def get(self, doc_id=None):
@@ -29,31 +110,141 @@ class RealtimeCollection:
 
         return None
 
+    def add_index(self, name: str, index: CollectionIndex):
+        with self._lock:
+            keys = set()
+            for doc_id, doc in self._docs.items():
+                keys |= index.update(doc_id, doc)
+            index.refresh(keys)
+            self._indexes[name] = index
+
+    def index(self, name: str) -> CollectionIndex:
+        return self._indexes[name]
+
+    def add_listener(self, listener):
+        """`listener(doc_id, old_doc, new_doc)` is called for every changed doc, `new_doc` is None when removed."""
+        self._listeners.append(listener)
+
     @property
     def is_loaded(self):
         return self._loaded
 
+    @property
+    def state(self) -> str:
+        if self._loaded:
+            return 'live'
+
+        return 'warm' if self.warm_saved_at is not None else 'empty'
+
+    def _apply(self, changes: List[Tuple[str, Optional[dict]]]):
+        """Applies the (doc id, doc) changes, the doc is None when removed."""
+        with self._lock:
+            changed = {name: set() for name in self._indexes}
+            for doc_id, new_doc in changes:
+                old_doc = self._docs.get(doc_id)
+                if new_doc is None:
+                    if old_doc is None:
+                        continue
+                    del self._docs[doc_id]
+                else:
+                    self._docs[doc_id] = new_doc
+                for name, index in self._indexes.items():
+                    changed[name] |= index.update(doc_id, new_doc)
+                for listener in self._listeners:
+                    listener(doc_id, old_doc, new_doc)
+            for name, keys in changed.items():
+                self._indexes[name].refresh(keys)
+            self.revision += 1
+
     def _subscribe(self):
         def on_snapshot_listener(collection_snapshot, changes, read_time):
+            changes = [(change.document.id, None if change.type.name == 'REMOVED' else change.document.to_dict())
+                       for change in changes]
             if self._loaded is False:
-                self._loaded = True
+                # the first snapshot has all the docs of the collection, the cached ones which are not there
+                # were removed while the worker was down
+                live_ids = {document.id for document in collection_snapshot}
+                changes += [(doc_id, None) for doc_id in list(self._docs) if doc_id not in live_ids]
 
-            for change in changes:
-                document = change.document
-                if change.type.name == 'REMOVED':
-                    del self._docs[document.id]
-                else:
-                    self._docs[document.id] = document.to_dict()
+            self._apply(changes)
+            if self._loaded is False:
+                self._loaded = True
+                self.live_since = time.time()
+            if self.cache_path:
+                self._save_cache()
 
         self._unsubscribe = self.collectionRf.on_snapshot(on_snapshot_listener)
 
+    def _load_cache(self):
+        try:
+            with gzip.open(self.cache_path, 'rt') as fp:
+                cache = json.load(fp, object_hook=_decode_value)
+            # a corrupt or foreign file is ignored like a missing one, the collection waits for the live docs
+            docs = list(cache['docs'].items())
+            if not all(isinstance(doc, dict) for _, doc in docs):
+                raise ValueError('the docs should be objects')
+            saved_at = float(cache['saved_at'])
+        except FileNotFoundError:
+            return
+        except Exception as error:
+            self.last_error = f'{type(error).__name__}: {error}'
+            logging.exception(f'Loading {self.cache_path} error: {str(error)}')
+            return
+
+        self._apply(docs)
+        self.warm_saved_at = saved_at
+
+    def _save_cache(self):
+        try:
+            docs = dict(self._docs)
+            tmp_path = f'{self.cache_path}.tmp-{os.getpid()}'
+            with gzip.open(tmp_path, 'wt') as fp:
+                json.dump({'saved_at': time.time(), 'docs': docs}, fp, default=_encode_value, separators=(',', ':'))
+            # the workers of the host write the same file, each write replaces the file at once
+            os.replace(tmp_path, self.cache_path)
+            self.persisted_at = time.time()
+        except Exception as error:
+            self.last_error = f'{type(error).__name__}: {error}'
+            logging.exception(f'Saving {self.cache_path} error: {str(error)}')
+
+    def status(self) -> dict:
+        return {
+            'state': self.state,
+            'docs': len(self._docs),
+            'revision': self.revision,
+            'warm_saved_at': self.warm_saved_at,
+            'live_since': self.live_since,
+            'persisted_at': self.persisted_at,
+            'last_error': self.last_error,
+        }
+
     def unsubscribe(self):
         if callable(self._unsubscribe):
             self._unsubscribe()
             self._unsubscribe = None
 
-        self._loaded = False
-        self._docs = {}
+        with self._lock:
+            self._loaded = False
+            self.warm_saved_at = None
+            self._docs = {}
+            for index in self._indexes.values():
+                index.clear()
+            self.revision += 1
+
+
+def _encode_value(value):
+    # the timestamps of the docs are read back as datetimes, the other firestore types as strings
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+
+    return str(value)
+
+
+def _decode_value(obj: dict):
+    if len(obj) == 1 and '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+
+    return obj
 
 
 class RealtimeCollections:
@@ -61,17 +252,40 @@ class RealtimeCollections:
         self._initialized = False
         self._instance = None
         self.collections = {}
+        # collection -> {name: index}, the indexes declared before the collections are subscribed
+        self.indexes: Dict[str, Dict[str, CollectionIndex]] = {}
 
-    def init(self, collections=None):
+    def init(self, collections=None, cache_dir: Optional[str] = REALTIME_COLLECTIONS_CACHE_DIR):
+        """`cache_dir` keeps the warm-start files of the collections, None disables them."""
         if self._initialized:
             return
 
         if collections is None:
             collections = [Collections.TEXT_PAGES, Collections.REPORTS, Collections.SPONSORS]
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
         for collection in collections:
-            self.collections[collection] = RealtimeCollection(collection=collection)
+            cache_path = os.path.join(cache_dir, f'{collection}.json.gz') if cache_dir else None
+            self.collections[collection] = RealtimeCollection(collection=collection, cache_path=cache_path)
+            for name, index in self.indexes.get(collection, {}).items():
+                self.collections[collection].add_index(name, index)
 
         self._initialized = True
 
+    def add_index(self, collection: str, name: str, index: CollectionIndex) -> CollectionIndex:
+        self.indexes.setdefault(collection, {})[name] = index
+        if collection in self.collections:
+            self.collections[collection].add_index(name, index)
+
+        return index
+
+    def status(self) -> dict:
+        collections = {name: collection.status() for name, collection in self.collections.items()}
+        return {
+            # every collection has docs to serve, either live or from the warm-start file
+            'ready': self._initialized and all(status['state'] != 'empty' for status in collections.values()),
+            'collections': collections,
+        }
+
 
 realtime_collections = RealtimeCollections()
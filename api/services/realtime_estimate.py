@@ -0,0 +1,125 @@
+import bisect
+import threading
+from itertools import accumulate
+from typing import List, Optional
+from services.data_snapshot import DataSnapshot, data_snapshots
+
+# that is because base calculation in the DB is for the price 0.05 USD/KWth
+DEFAULT_PRICE = 0.05
+MIN_COEFFICIENT = 1.01
+MAX_COEFFICIENT = 1.2
+GUESS_COEFFICIENT = 1.1
+# estimates by price kept for the current (version, hash rate)
+ESTIMATES_MAX_SIZE = 1024
+
+
+class CurrentDayIndex:
+    """
+    Miners released before the latest day sorted by efficiency, with the prefix sums of the efficiencies.
+    A miner is profitable when its efficiency is below `prof_threshold * 0.05 / price`, so the profitable
+    set of any price is a prefix of that order and is found with one binary search.
+    """
+    def __init__(self, timestamp: int, prof_threshold: float, efficiencies: List[float]):
+        self.timestamp = timestamp
+        self.prof_threshold = prof_threshold
+        self.efficiencies = sorted(efficiencies)
+        self.prefix_sums = [0.0] + list(accumulate(self.efficiencies))
+
+    @classmethod
+    def from_snapshot(cls, snapshot: DataSnapshot):
+        prof_threshold = snapshot['prof_threshold'].last()
+        return cls(
+            timestamp=prof_threshold['timestamp'],
+            prof_threshold=prof_threshold['value'],
+            efficiencies=[miner['efficiency_j_gh'] for miner in snapshot['miners'].rows()
+                          if prof_threshold['timestamp'] > miner['unix_date_of_release']]
+        )
+
+    def profitable_qty(self, price: float) -> int:
+        return bisect.bisect_left(self.efficiencies, self.prof_threshold * (DEFAULT_PRICE / price))
+
+    def power(self, qty: int, hashrate: float) -> dict:
+        if qty == 0:
+            return {'min_power': None, 'max_power': None, 'guess_power': None}
+        return {
+            'min_power': self.efficiencies[0] * hashrate * MIN_COEFFICIENT / 1e6,
+            'max_power': self.efficiencies[qty - 1] * hashrate * MAX_COEFFICIENT / 1e6,
+            'guess_power': self.prefix_sums[qty] / qty * hashrate * GUESS_COEFFICIENT / 1e6,
+        }
+
+    def curve(self, hashrate: float) -> List[dict]:
+        """
+        The estimate as a step function of the price: the n-th point is the price below which the n cheapest
+        miners are profitable, from the highest price (one miner) to the lowest one (all the released miners).
+        """
+        return [{'price': self.prof_threshold * DEFAULT_PRICE / efficiency, 'profitable_miners': qty,
+                 **self.power(qty, hashrate)}
+                for qty, efficiency in enumerate(self.efficiencies, start=1) if efficiency > 0]
+
+
+class RealtimeEstimates:
+    """
+    Power estimates of the latest day for the current hash rate. The index is built once per data version,
+    the computed estimates are dropped when the data version or the hash rate (updated every 45 seconds) change.
+    """
+    def __init__(self):
+        self.hashrate = 0
+        self.updated_at = None
+        self.lock = threading.Lock()
+        self._key = None
+        self._estimates = {}
+        self._curve = None
+
+    def update(self, hashrate: float, updated_at: Optional[float] = None):
+        self.hashrate = hashrate
+        self.updated_at = updated_at
+
+    def _current(self):
+        snapshot = data_snapshots.current()
+        index = snapshot.derived('realtime_estimate_index', lambda: CurrentDayIndex.from_snapshot(snapshot))
+        key = (snapshot.version, self.hashrate)
+        with self.lock:
+            if key != self._key:
+                self._key = key
+                self._estimates = {}
+                self._curve = None
+        return key, index
+
+    def estimate(self, price: float) -> dict:
+        key, index = self._current()
+        estimate = self._estimates.get(price)
+        if estimate is None:
+            qty = index.profitable_qty(price)
+            estimate = {
+                'timestamp': index.timestamp,
+                'price': price,
+                'hashrate': key[1],
+                'profitable_miners': qty,
+                **index.power(qty, key[1]),
+            }
+            with self.lock:
+                # an estimate computed while the hash rate was updated is not kept
+                if key == self._key:
+                    if len(self._estimates) >= ESTIMATES_MAX_SIZE:
+                        self._estimates.clear()
+                    self._estimates[price] = estimate
+
+        return estimate
+
+    def curve(self) -> dict:
+        key, index = self._current()
+        curve = self._curve
+        if curve is None:
+            curve = {'timestamp': index.timestamp, 'hashrate': key[1], 'curve': index.curve(key[1])}
+            with self.lock:
+                if key == self._key:
+                    self._curve = curve
+
+        return curve
+
+    def status(self) -> dict:
+        return {'hashrate': self.hashrate, 'updated_at': self.updated_at, 'estimates': len(self._estimates),
+                'curve': self._curve is not None}
+
+
+realtime_estimates = RealtimeEstimates()
@@ -0,0 +1,174 @@
+import gzip
+import time
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+from typing import Callable, Optional
+from flask import Response, current_app, request
+from services.data_snapshot import data_snapshots
+from services.price_cache import ResultCache
+from services.single_flight import single_flight
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# smaller bodies are not worth compressing
+COMPRESS_MIN_SIZE = 1024
+JSON_MIMETYPE = 'application/json'
+# a streamed body is kept while it is sent only up to that size, the bigger downloads are not stored,
+# so a download holds at most that much memory whatever its size
+STREAMED_MAX_BYTES = 1024 * 1024
+
+
+class PreparedResponse:
+    """
+    Final bytes of a response with its compressed variants and validators, ready to be sent as is.
+    """
+    def __init__(self, body: bytes, mimetype: str = JSON_MIMETYPE, headers: Optional[dict] = None,
+                 last_modified: Optional[float] = None):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = headers or {}
+        self.created_at = time.time()
+        self.last_modified = datetime.fromtimestamp(int(last_modified or self.created_at), timezone.utc)
+        # strong validator, every worker computes the same one for the same body
+        self.etag = hashlib.sha1(body).hexdigest()[:32]
+        self.encodings = {}
+        # the binary files (parquet, arrow) are not compressed, they are either compressed already or barely shrink
+        if len(body) >= COMPRESS_MIN_SIZE and (mimetype.startswith('text/') or mimetype == JSON_MIMETYPE):
+            if brotli is not None:
+                self.encodings['br'] = brotli.compress(body, quality=9)
+            self.encodings['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+
+    @staticmethod
+    def response_headers(response: Response) -> dict:
+        return {name: response.headers[name] for name in ('Content-Disposition',) if name in response.headers}
+
+    @classmethod
+    def from_response(cls, response: Response, last_modified: Optional[float] = None):
+        return cls(response.get_data(), response.mimetype, cls.response_headers(response), last_modified)
+
+    def __len__(self):
+        return len(self.body) + sum(len(body) for body in self.encodings.values())
+
+    def to_response(self) -> Response:
+        encoding = next((encoding for encoding in ('br', 'gzip')
+                         if encoding in self.encodings and request.accept_encodings[encoding]), None)
+        response = Response(self.encodings[encoding] if encoding else self.body, mimetype=self.mimetype,
+                            headers=self.headers)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+        # every representation has its own strong tag
+        response.set_etag(f'{self.etag}-{encoding}' if encoding else self.etag)
+        response.last_modified = self.last_modified
+
+        return response.make_conditional(request)
+
+
+class _NotStored(Exception):
+    """The view did not answer 200, its response is sent as is and is not stored nor shared."""
+    def __init__(self, response: Response):
+        super().__init__(response.status)
+        self.body = response.get_data()
+        self.status = response.status_code
+        self.headers = dict(response.headers)
+
+    def to_response(self) -> Response:
+        return Response(self.body, status=self.status, headers=self.headers)
+
+
+class ResponseStore:
+    """
+    Prepared responses by (dataset version, endpoint, parameters). A stored response is sent without calling the view.
+    """
+    def __init__(self, cache: Optional[ResultCache] = None):
+        self.cache = cache or ResultCache()
+
+    def init(self, max_bytes: int):
+        self.cache.init(max_bytes)
+
+    def stored(self, key: Callable[..., Optional[tuple]], max_age: Optional[int] = None, shared: bool = False,
+               mimetype: str = JSON_MIMETYPE):
+        """
+        `key` makes the key from the view arguments, None skips the store (e.g. invalid parameters).
+        `max_age` limits the age of the responses which are not derived from the data snapshot.
+        `shared` views compute their body once for all the workers (single flight with the shared cache),
+        the body is sent with `mimetype`.
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                params = key(*args, **kwargs)
+                if params is None:
+                    return f(*args, **kwargs)
+
+                snapshot = data_snapshots.current()
+                store_key = (snapshot.version, request.endpoint) + tuple(params)
+                prepared = self.cache.get(store_key)
+                if prepared is not None and (max_age is None or time.time() - prepared.created_at <= max_age):
+                    return prepared.to_response()
+
+                last_modified = snapshot.created_at if max_age is None else None
+                if shared:
+                    def compute() -> bytes:
+                        response = current_app.make_response(f(*args, **kwargs))
+                        if response.status_code != 200:
+                            raise _NotStored(response)
+                        return response.get_data()
+
+                    try:
+                        body = single_flight.do(store_key, compute)
+                    except _NotStored as not_stored:
+                        return not_stored.to_response()
+                    prepared = PreparedResponse(body, mimetype, last_modified=last_modified)
+                else:
+                    response = current_app.make_response(f(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    if response.is_streamed:
+                        return self._store_streamed(store_key, response, last_modified)
+                    prepared = PreparedResponse.from_response(response, last_modified)
+                self.cache.set(store_key, prepared)
+
+                return prepared.to_response()
+
+            return decorated_function
+
+        return decorator
+
+    def _store_streamed(self, store_key: tuple, response: Response, last_modified: Optional[float]) -> Response:
+        """
+        Sends the chunks as they are generated and stores the body once the stream is complete. The chunks are
+        kept only up to `STREAMED_MAX_BYTES`, the interrupted and the bigger streams are not stored.
+        """
+        chunks = iter(response.iter_encoded())
+        max_size = min(STREAMED_MAX_BYTES, self.cache.max_bytes)
+
+        def generate():
+            body = []
+            size = 0
+            for chunk in chunks:
+                if body is not None:
+                    size += len(chunk)
+                    if size <= max_size:
+                        body.append(chunk)
+                    else:
+                        # the chunks kept so far are released, the rest of the stream is only sent
+                        body = None
+                yield chunk
+            if body is not None:
+                self.cache.set(store_key, PreparedResponse(b''.join(body), response.mimetype,
+                                                           PreparedResponse.response_headers(response), last_modified))
+
+        response.response = generate()
+
+        return response
+
+    def status(self) -> dict:
+        return {**self.cache.status(), 'brotli': brotli is not None}
+
+
+response_store = ResponseStore()
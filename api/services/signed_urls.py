@@ -0,0 +1,137 @@
+import time
+import datetime
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from services.realtime_collection import CollectionIndex, realtime_collections
+
+SIGNED_URL_EXPIRATION = datetime.timedelta(days=1)
+# a cached url is signed again when it expires in less than that
+SIGNED_URL_SAFETY_MARGIN = datetime.timedelta(hours=1)
+
+# (bucket, path, expiration) -> signed url
+Signer = Callable[[Optional[str], str, datetime.timedelta], str]
+
+
+def storage_signer(bucket: Optional[str], path: str, expiration: datetime.timedelta) -> str:
+    from firebase_admin import storage
+    return storage.bucket(bucket).blob(path).generate_signed_url(expiration=expiration)
+
+
+class SignedUrlCache:
+    """
+    Signed urls of the storage files by (bucket, path). A url is reused until `safety_margin` before it
+    expires, so no client gets a url which is about to expire. The signer and the clock can be replaced
+    (e.g. by a fake signer in tests).
+    """
+    def __init__(self, signer: Signer = storage_signer, expiration: datetime.timedelta = SIGNED_URL_EXPIRATION,
+                 safety_margin: datetime.timedelta = SIGNED_URL_SAFETY_MARGIN, clock: Callable[[], float] = time.time):
+        self.signer = signer
+        self.expiration = expiration
+        self.safety_margin = safety_margin
+        self.clock = clock
+        self.lock = threading.Lock()
+        # (bucket, path) -> (url, reusable until)
+        self._urls: Dict[Tuple[Optional[str], str], Tuple[str, float]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def entry(self, bucket: Optional[str], path: str) -> Tuple[str, float]:
+        """(url, time until which the url is reused)"""
+        now = self.clock()
+        cached = self._urls.get((bucket, path))
+        if cached is not None and now < cached[1]:
+            self.hits += 1
+            return cached
+
+        # signed out of the lock, two requests may sign the same url at worst
+        entry = (self.signer(bucket, path, self.expiration),
+                 now + (self.expiration - self.safety_margin).total_seconds())
+        with self.lock:
+            self.misses += 1
+            self._urls[(bucket, path)] = entry
+        return entry
+
+    def get(self, bucket: Optional[str], path: str) -> str:
+        return self.entry(bucket, path)[0]
+
+    def invalidate(self, bucket: Optional[str], path: str):
+        with self.lock:
+            if self._urls.pop((bucket, path), None) is not None:
+                self.invalidations += 1
+
+    def status(self) -> dict:
+        return {
+            'urls': len(self._urls),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+class SignedFileListing:
+    """
+    Active docs of a realtime collection of files (reports, sponsors) by project, sorted by `order_position`,
+    with the signed url of the file. The docs come from an index of the collection, the payload of a project
+    is kept until the collection changes or one of its urls has to be signed again. The urls of a changed
+    or removed doc are invalidated.
+    """
+    def __init__(self, collection_name: str, bucket: Optional[str], folder: str, urls: SignedUrlCache):
+        self.collection_name = collection_name
+        self.bucket = bucket
+        self.folder = folder
+        self.urls = urls
+        self._collection = None
+        self.docs = realtime_collections.add_index(collection_name, 'active_by_project', CollectionIndex(
+            keys=lambda doc: (doc.get('project'),) if doc.get('is_active') == True else (),
+            sort_key=lambda doc: doc.get('order_position'),
+        ))
+        # project -> (reusable until, payload) of the collection revision `_payloads_revision`, only the projects
+        # with active docs are kept, so the clients can't grow the dict with unknown projects
+        self._payloads: Dict[str, Tuple[float, List[dict]]] = {}
+        self._payloads_revision = None
+
+    @property
+    def collection(self):
+        # the collections are subscribed after the blueprints are registered
+        if self._collection is None:
+            collection = realtime_collections.collections[self.collection_name]
+            collection.add_listener(self._on_change)
+            self._collection = collection
+
+        return self._collection
+
+    def path(self, doc: dict) -> str:
+        return f'{self.folder}/{doc["filename"]}'
+
+    def _on_change(self, doc_id: str, old_doc: Optional[dict], new_doc: Optional[dict]):
+        if old_doc is not None and 'filename' in old_doc and old_doc != new_doc:
+            self.urls.invalidate(self.bucket, self.path(old_doc))
+
+    def index(self, project: str) -> List[dict]:
+        revision = self.collection.revision
+        if revision != self._payloads_revision:
+            # the payloads of the previous revision are dropped at once, including the removed projects
+            self._payloads = {}
+            self._payloads_revision = revision
+        payloads = self._payloads
+        cached = payloads.get(project)
+        if cached is not None and self.urls.clock() < cached[0]:
+            return cached[1]
+
+        docs = self.docs.get(project)
+        if not docs:
+            return []
+
+        payload = []
+        valid_until = float('inf')
+        for doc in docs:
+            url, url_valid_until = self.urls.entry(self.bucket, self.path(doc))
+            payload.append({**doc, 'fileurl': [url]})
+            valid_until = min(valid_until, url_valid_until)
+        payloads[project] = (valid_until, payload)
+
+        return payload
+
+
+signed_urls = SignedUrlCache()
@@ -0,0 +1,110 @@
+import logging
+import threading
+from typing import Callable, Hashable, Optional
+
+SINGLE_FLIGHT_TIMEOUT = 60
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time, the concurrent callers of the same key wait for its result.
+    Keys are tuples like (dataset version, price, endpoint), so a new dataset version starts new computations.
+    """
+    def __init__(self, backend=None, timeout: int = SINGLE_FLIGHT_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.leaders = 0
+        self.waiters = 0
+        self.shared_hits = 0
+        self.backend_errors = 0
+
+    def init(self, backend=None, timeout: int = SINGLE_FLIGHT_TIMEOUT):
+        self.backend = backend
+        self.timeout = timeout
+
+    def do(self, key: Hashable, fn: Callable[[], bytes]) -> bytes:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.waiters += 1
+
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise TimeoutError(f'Computation of {key} takes more than {self.timeout} seconds')
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = self._run_shared(key, fn) if self.backend is not None else fn()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.value
+
+    def _run_shared(self, key: Hashable, fn: Callable[[], bytes]) -> bytes:
+        try:
+            value = self.backend.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                return value
+            lock = self.backend.lock(key)
+            locked = lock.acquire()
+        except Exception as err:
+            # the shared backend is an optimisation, the worker computes the result on its own without it
+            self.backend_errors += 1
+            logging.warning(f'Single flight backend error: {str(err)}')
+            return fn()
+
+        try:
+            # the result could have been stored while waiting for the lock
+            value = self.backend.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                return value
+            value = fn()
+            try:
+                self.backend.set(key, value)
+            except Exception as err:
+                self.backend_errors += 1
+                logging.warning(f'Single flight backend error: {str(err)}')
+            return value
+        finally:
+            if locked:
+                try:
+                    lock.release()
+                except Exception as err:
+                    self.backend_errors += 1
+                    logging.warning(f'Single flight backend error: {str(err)}')
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'backend': type(self.backend).__name__ if self.backend is not None else None,
+                'in_flight': len(self.calls),
+                'leaders': self.leaders,
+                'waiters': self.waiters,
+                'shared_hits': self.shared_hits,
+                'backend_errors': self.backend_errors,
+            }
+
+
+single_flight = SingleFlight()
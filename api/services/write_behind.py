@@ -0,0 +1,299 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+import requests
+
+WRITE_BEHIND_PATH = '../storage/write_behind.sqlite3'
+WRITE_BEHIND_POLL_INTERVAL = 1
+WRITE_BEHIND_MAX_ATTEMPTS = 10
+# seconds before the first retry, doubled after every failed attempt up to the max
+WRITE_BEHIND_RETRY_DELAY = 5
+WRITE_BEHIND_MAX_RETRY_DELAY = 3600
+# a claimed job which is not done after that (e.g. the worker was killed) is picked up again
+WRITE_BEHIND_CLAIM_TIMEOUT = 300
+# the done jobs are kept that many seconds as markers, for `job()`
+WRITE_BEHIND_DONE_RETENTION = 7 * 24 * 3600
+WEBHOOK_TIMEOUT = 10
+
+# (target, payload) of every job of a batch
+Handler = Callable[[List[Tuple[Optional[str], dict]]], None]
+
+
+class _Kind:
+    def __init__(self, handler: Handler, batch_size: int, rate_limit: Optional[float]):
+        self.handler = handler
+        self.batch_size = batch_size
+        # batches per second, for all the worker processes of the host
+        self.rate_limit = rate_limit
+
+
+class WriteBehindQueue:
+    """
+    Durable queue of the writes which don't have to be done before the response is sent (DB inserts, webhooks).
+
+    The jobs are journaled in a SQLite file shared by the worker processes of the host, so they survive
+    restarts. A dispatcher thread in every worker claims the due jobs in batches by kind and runs the handler
+    of the kind, at most `rate_limit` times a second for the host. When a batch of several jobs fails, its jobs
+    are run again one by one, so one bad job does not hold back the others (the handlers of the batched kinds
+    have to be atomic, e.g. one DB transaction). A failed job is retried with exponential backoff and kept as dead after `max_attempts`,
+    the dead jobs stay in the journal with their last error, see `job()`. A job with a `dedupe_key` is not
+    enqueued while the same key is pending. The done jobs are kept as markers (kind, target) for a week.
+    """
+    def __init__(self, path: Optional[str] = None, poll_interval: float = WRITE_BEHIND_POLL_INTERVAL,
+                 max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.kinds: Dict[str, _Kind] = {}
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self.lock = threading.Lock()
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.done = 0
+        self.retried = 0
+        self.dead = 0
+        self.last_error = None
+
+    def init(self, path: str = WRITE_BEHIND_PATH, poll_interval: Optional[float] = None,
+             max_attempts: Optional[int] = None):
+        self.path = path
+        self.poll_interval = poll_interval or self.poll_interval
+        self.max_attempts = max_attempts or self.max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                         'kind TEXT NOT NULL, '
+                         'target TEXT, '
+                         'payload TEXT NOT NULL, '
+                         'dedupe_key TEXT UNIQUE, '
+                         'attempts INTEGER NOT NULL DEFAULT 0, '
+                         'next_attempt_at REAL NOT NULL, '
+                         'claimed_by TEXT, '
+                         'claimed_until REAL, '
+                         'is_dead INTEGER NOT NULL DEFAULT 0, '
+                         'last_error TEXT, '
+                         'created_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_due ON jobs (is_dead, kind, next_attempt_at)')
+            conn.execute('CREATE TABLE IF NOT EXISTS done_jobs ('
+                         'id INTEGER PRIMARY KEY, '
+                         'kind TEXT NOT NULL, '
+                         'target TEXT, '
+                         'done_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS done_jobs_done_at ON done_jobs (done_at)')
+            # the last batch of the rate limited kinds, shared by the worker processes
+            conn.execute('CREATE TABLE IF NOT EXISTS rate_slots (kind TEXT PRIMARY KEY, last_run_at REAL NOT NULL)')
+
+    def register(self, kind: str, handler: Handler, batch_size: int = 1, rate_limit: Optional[float] = None):
+        """`handler` gets the (target, payload) of up to `batch_size` jobs, at most `rate_limit` times a second."""
+        self.kinds[kind] = _Kind(handler, batch_size, rate_limit)
+
+    def _connection(self, begin: str = 'BEGIN') -> sqlite3.Connection:
+        # sqlite connections can't be shared by the threads, nor by the forked processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return _Transaction(conn, begin)
+
+    def enqueue(self, kind: str, payload: dict, target: Optional[str] = None,
+                dedupe_key: Optional[str] = None) -> Optional[int]:
+        """Journals the job and returns its id, None if a job with the same `dedupe_key` is already pending."""
+        with self._connection() as conn:
+            cursor = conn.execute('INSERT OR IGNORE INTO jobs (kind, target, payload, dedupe_key, next_attempt_at, '
+                                  'created_at) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (kind, target, json.dumps(payload, default=str), dedupe_key, 0, time.time()))
+            job_id = cursor.lastrowid if cursor.rowcount > 0 else None
+        with self.lock:
+            if job_id is not None:
+                self.enqueued += 1
+            else:
+                self.deduplicated += 1
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def job(self, job_id: int) -> Optional[dict]:
+        """
+        State and owner (kind, target) of a job: `pending` (with the attempts and the last error), `dead`
+        (with the last error) or `done`, None for an unknown id or a job done more than a week ago.
+        """
+        with self._connection() as conn:
+            row = conn.execute('SELECT kind, target, attempts, is_dead, last_error FROM jobs WHERE id = ?',
+                               (job_id,)).fetchone()
+            if row is None:
+                done = conn.execute('SELECT kind, target FROM done_jobs WHERE id = ?', (job_id,)).fetchone()
+                if done is None:
+                    return None
+                return {'id': job_id, 'kind': done[0], 'target': done[1], 'state': 'done'}
+
+        kind, target, attempts, is_dead, last_error = row
+        return {'id': job_id, 'kind': kind, 'target': target, 'state': 'dead' if is_dead else 'pending',
+                'attempts': attempts, 'last_error': last_error}
+
+    def start(self):
+        # threads do not survive fork(), so every worker process starts its own dispatcher
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self.lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                busy = self.dispatch()
+            except Exception as error:
+                busy = False
+                self.last_error = f'{type(error).__name__}: {error}'
+                logging.exception(f'Write-behind dispatcher error: {str(error)}')
+            if not busy:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def dispatch(self) -> bool:
+        """Runs one batch of every kind which is due, returns True if any batch was run."""
+        busy = False
+        for kind_name, kind in self.kinds.items():
+            jobs = self._claim(kind_name, kind.batch_size, kind.rate_limit)
+            if not jobs:
+                continue
+            busy = True
+            try:
+                self._run_handler(kind, jobs)
+            except Exception as error:
+                if len(jobs) == 1:
+                    self._fail(jobs, f'{type(error).__name__}: {error}')
+                    continue
+                # one bad job fails the whole batch, the jobs are run one by one to find it
+                for job in jobs:
+                    try:
+                        self._run_handler(kind, [job])
+                    except Exception as job_error:
+                        self._fail([job], f'{type(job_error).__name__}: {job_error}')
+                    else:
+                        self._done([job])
+            else:
+                self._done(jobs)
+        return busy
+
+    @staticmethod
+    def _run_handler(kind: _Kind, jobs: List[tuple]):
+        kind.handler([(target, json.loads(payload)) for _, target, payload, _ in jobs])
+
+    def _claim(self, kind: str, limit: int, rate_limit: Optional[float] = None) -> List[tuple]:
+        now = time.time()
+        claim_id = uuid.uuid4().hex
+        # the claim is atomic between the worker processes of the host
+        with self._connection('BEGIN IMMEDIATE') as conn:
+            if rate_limit:
+                last_run_at = conn.execute('SELECT last_run_at FROM rate_slots WHERE kind = ?', (kind,)).fetchone()
+                if last_run_at is not None and now - last_run_at[0] < 1 / rate_limit:
+                    return []
+            jobs = conn.execute('SELECT id, target, payload, attempts FROM jobs WHERE is_dead = 0 AND kind = ? '
+                                'AND next_attempt_at <= ? AND (claimed_until IS NULL OR claimed_until < ?) '
+                                'ORDER BY id LIMIT ?', (kind, now, now, limit)).fetchall()
+            if jobs:
+                conn.executemany('UPDATE jobs SET claimed_by = ?, claimed_until = ? WHERE id = ?',
+                                 [(claim_id, now + WRITE_BEHIND_CLAIM_TIMEOUT, job[0]) for job in jobs])
+                if rate_limit:
+                    conn.execute('INSERT OR REPLACE INTO rate_slots (kind, last_run_at) VALUES (?, ?)', (kind, now))
+        return jobs
+
+    def _done(self, jobs: List[tuple]):
+        now = time.time()
+        with self._connection() as conn:
+            conn.executemany('INSERT OR REPLACE INTO done_jobs (id, kind, target, done_at) '
+                             'SELECT id, kind, target, ? FROM jobs WHERE id = ?', [(now, job[0]) for job in jobs])
+            conn.executemany('DELETE FROM jobs WHERE id = ?', [(job[0],) for job in jobs])
+            conn.execute('DELETE FROM done_jobs WHERE done_at < ?', (now - WRITE_BEHIND_DONE_RETENTION,))
+        with self.lock:
+            self.done += len(jobs)
+
+    def _fail(self, jobs: List[tuple], error: str):
+        now = time.time()
+        updates = []
+        for job_id, _, _, attempts in jobs:
+            attempts += 1
+            delay = min(WRITE_BEHIND_RETRY_DELAY * 2 ** (attempts - 1), WRITE_BEHIND_MAX_RETRY_DELAY)
+            # the dead jobs are kept for inspection, their dedupe key is released
+            is_dead = int(attempts >= self.max_attempts)
+            if is_dead:
+                logging.error(f'Write-behind job {job_id} is dead after {attempts} attempts: {error}')
+            else:
+                logging.warning(f'Write-behind job {job_id} failed (attempt {attempts}): {error}')
+            updates.append((attempts, now + delay, is_dead, is_dead, error, job_id))
+        with self._connection() as conn:
+            conn.executemany('UPDATE jobs SET attempts = ?, next_attempt_at = ?, claimed_by = NULL, '
+                             'claimed_until = NULL, is_dead = ?, '
+                             'dedupe_key = CASE WHEN ? THEN NULL ELSE dedupe_key END, last_error = ? WHERE id = ?',
+                             updates)
+        with self.lock:
+            self.last_error = error
+            self.dead += sum(update[2] for update in updates)
+            self.retried += sum(1 - update[2] for update in updates)
+
+    def status(self) -> dict:
+        with self._connection() as conn:
+            pending = dict(conn.execute('SELECT kind, count(*) FROM jobs WHERE is_dead = 0 GROUP BY kind').fetchall())
+            dead = dict(conn.execute('SELECT kind, count(*) FROM jobs WHERE is_dead = 1 GROUP BY kind').fetchall())
+        return {
+            'pending': pending,
+            'dead': dead,
+            'enqueued': self.enqueued,
+            'deduplicated': self.deduplicated,
+            'done': self.done,
+            'retried': self.retried,
+            'dropped': self.dead,
+            'last_error': self.last_error,
+            'dispatcher_alive': self._thread is not None and self._thread.is_alive() and self._pid == os.getpid(),
+        }
+
+
+class _Transaction:
+    """`with` block of an autocommit sqlite connection: the statements of the block are one transaction."""
+    def __init__(self, conn: sqlite3.Connection, begin: str = 'BEGIN'):
+        self.conn = conn
+        self.begin = begin
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.conn.execute(self.begin)
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.conn.in_transaction:
+            self.conn.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+def post_webhooks(jobs: List[Tuple[Optional[str], dict]]):
+    for url, payload in jobs:
+        response = requests.post(url, headers=payload.get('headers'), data=payload['data'], timeout=WEBHOOK_TIMEOUT)
+        response.raise_for_status()
+
+
+def webhook_dedupe_key(url: str, data: str) -> str:
+    return hashlib.sha1(f'{url}\n{data}'.encode()).hexdigest()
+
+
+write_behind = WriteBehindQueue()
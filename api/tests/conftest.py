@@ -0,0 +1,56 @@
+import os
+import sys
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT_DIR = os.path.dirname(API_DIR)
+
+# the API modules are imported the way chart_API.py imports them (from the api directory)
+sys.path.insert(0, API_DIR)
+# and the fetch scripts from the root directory
+sys.path.append(ROOT_DIR)
+# the tests don't connect to the databases, the sample config is enough when there is no CONFIG.yml
+if not os.path.exists(os.path.join(ROOT_DIR, 'CONFIG.yml')):
+    os.environ.setdefault('CONFIG_PATH', os.path.join(ROOT_DIR, 'sample_CONFIG.yml'))
+
+
+class FakeCollectionReference:
+    """In-memory stand-in of a firestore CollectionReference: `push` delivers a snapshot to the listener."""
+    def __init__(self, docs=None):
+        self.docs = dict(docs or {})
+        self.listener = None
+
+    def on_snapshot(self, listener):
+        self.listener = listener
+        return self.unsubscribe
+
+    def unsubscribe(self):
+        self.listener = None
+
+    def push(self, added=None, removed=()):
+        changes = []
+        for doc_id, doc in (added or {}).items():
+            changes.append(_Change('MODIFIED' if doc_id in self.docs else 'ADDED', _Document(doc_id, doc)))
+            self.docs[doc_id] = doc
+        for doc_id in removed:
+            changes.append(_Change('REMOVED', _Document(doc_id, self.docs.pop(doc_id))))
+        self.listener([_Document(doc_id, doc) for doc_id, doc in self.docs.items()], changes, None)
+
+    def push_initial(self):
+        # the first snapshot of a listener has all the docs as added
+        self.listener([_Document(doc_id, doc) for doc_id, doc in self.docs.items()],
+                      [_Change('ADDED', _Document(doc_id, doc)) for doc_id, doc in self.docs.items()], None)
+
+
+class _Document:
+    def __init__(self, doc_id, doc):
+        self.id = doc_id
+        self._doc = doc
+
+    def to_dict(self):
+        return dict(self._doc)
+
+
+class _Change:
+    def __init__(self, type_name, document):
+        self.type = type('ChangeType', (), {'name': type_name})
+        self.document = document
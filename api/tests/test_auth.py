@@ -0,0 +1,64 @@
+import contextlib
+import pytest
+from decorators import auth
+
+
+class FakeTokensTable:
+    """api_tokens rows (id, name, token) with their versions (xmin), `SELECT ... id = ANY(%s)` loads the rows."""
+    def __init__(self):
+        self.rows = {}
+        self.versions = {}
+        self._result = []
+
+    def set(self, row, version):
+        self.rows[row[0]] = row
+        self.versions[row[0]] = version
+
+    @contextlib.contextmanager
+    def connection(self, name):
+        yield self
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql, params=None):
+        if params is None:
+            self._result = list(self.versions.items())
+        else:
+            self._result = [self.rows[token_id] for token_id in params[0]]
+
+    def fetchall(self):
+        return self._result
+
+
+@pytest.fixture
+def table(monkeypatch):
+    table = FakeTokensTable()
+    monkeypatch.setattr(auth, 'db', table)
+    return table
+
+
+def test_rows_without_a_token_are_not_loaded_again(table):
+    table.set((1, 'user', 'secret'), '100')
+    table.set((2, 'pending', ''), '101')
+    table.set((3, 'pending', None), '102')
+    index = auth.ApiTokenIndex()
+
+    index.refresh()
+    assert index.loaded_rows == 3
+    assert index.status()['tokens'] == 1
+    index.refresh()
+    assert index.loaded_rows == 3
+
+    # a token given to a row later is indexed with its new version
+    table.set((2, 'pending', 'other-secret'), '103')
+    index.refresh()
+    assert index.loaded_rows == 4
+    assert index.tokens[auth.hash_token('other-secret')][0] == 2
+
+    # and a revoked row without a token is dropped without touching the tokens
+    del table.versions[3]
+    index.refresh()
+    assert index.loaded_rows == 4
+    assert sorted(index.versions) == [1, 2]
+    assert index.status()['tokens'] == 2
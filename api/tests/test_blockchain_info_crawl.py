@@ -0,0 +1,80 @@
+import os
+import json
+import shutil
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPLY_DELAY = 0.3
+
+
+@pytest.fixture(scope='module')
+def crawler(tmp_path_factory):
+    # the script reads CONFIG.yml from the working directory when it is imported
+    directory = tmp_path_factory.mktemp('crawler')
+    shutil.copy(f'{ROOT_DIR}/sample_CONFIG.yml', directory / 'CONFIG.yml')
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(directory)
+        import data_fetch_calc_blockchain_info
+    return data_fetch_calc_blockchain_info
+
+
+@pytest.fixture
+def stub():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            endpoint = self.path.split('?')[0].rsplit('/', 1)[-1]
+            requests.append(endpoint)
+            # the first request of the endpoint fails, the session retries it
+            if endpoint == 'flaky' and requests.count(endpoint) == 1:
+                self.send_response(503)
+                self.end_headers()
+                return
+            time.sleep(REPLY_DELAY)
+            body = json.dumps({'values': [{'x': 86400 * day, 'y': float(len(endpoint) + day)} for day in range(3)]})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/charts/', requests
+    server.shutdown()
+    server.server_close()
+
+
+def test_crawl(crawler, stub):
+    base_url, _ = stub
+
+    assert crawler.crawl('hash-rate', base_url=base_url) == [(0, 9.0), (86400, 10.0), (172800, 11.0)]
+
+
+def test_crawl_all_is_concurrent_and_retries(crawler, stub):
+    base_url, requests = stub
+    endpoints = ['market-price', 'difficulty', 'hash-rate', 'flaky']
+
+    started_at = time.time()
+    results = dict(crawler.crawl_all(endpoints, base_url, workers=4))
+    elapsed = time.time() - started_at
+
+    assert set(results) == set(endpoints)
+    assert results['flaky'] == [(0, 5.0), (86400, 6.0), (172800, 7.0)]
+    assert requests.count('flaky') == 2
+    # sequential requests would take 4 delays
+    assert elapsed < 2 * REPLY_DELAY + 1
+
+
+def test_prof_threshold(crawler):
+    all_data = {0: {'miners-revenue': 1e7, 'hash-rate': 1e8}, 86400: {'hash-rate': 1e8}}
+
+    assert crawler.calc_prof_threshold(all_data, 0.05) == [(0, pytest.approx(1e7 / (1e8 * 86400) / (0.05 / 3.6e6) / 1000))]
@@ -0,0 +1,92 @@
+import contextlib
+import pytest
+from flask import Flask
+from blueprints import contribute
+from decorators import auth
+
+TOKEN = (7, 'user', 'secret-token')
+
+
+class FakeConnections:
+    def __init__(self):
+        self.opened = 0
+        self.batches = []
+
+    @contextlib.contextmanager
+    def connection(self, name):
+        self.opened += 1
+        yield self
+
+    def cursor(self):
+        return self
+
+
+@pytest.fixture
+def client(monkeypatch):
+    connections = FakeConnections()
+    monkeypatch.setattr(contribute, 'db', connections)
+    monkeypatch.setattr(contribute, 'get_country_names', lambda: frozenset(('United States',)))
+    monkeypatch.setattr(contribute, 'insert_batch', lambda cursor, batch: cursor.batches.append(list(batch)) or [])
+    monkeypatch.setattr(auth.api_tokens, 'get', lambda token: TOKEN if token == TOKEN[2] else None)
+
+    app = Flask(__name__)
+    app.register_blueprint(contribute.bp)
+    client = app.test_client()
+    client.connections = connections
+    return client
+
+
+def post_bulk(client, body: bytes, mimetype: str):
+    return client.post('/contribute/miners_geo_distribution/bulk', data=body, content_type=mimetype,
+                       headers={'Authorization': f'Bearer {TOKEN[2]}'})
+
+
+def test_csv_with_bom_and_a_bad_byte(client):
+    body = '\ufeffperiod_start_date,period,country,province,average_hashrate,unit\r\n' \
+           '2021-01-01,daily,United States,,1.5,th/s\r\n'.encode()
+    body += b'2021-01-02,daily,United States,Texas\xff,2,th/s\r\n'
+    body += b'2021-01-03,daily,United States,Texas,3,th/s\r\n'
+
+    result = post_bulk(client, body, 'text/csv').get_json()
+
+    assert result['status'] == 'partial'
+    assert (result['received'], result['created'], result['failed']) == (3, 2, 1)
+    assert result['errors'] == [{'line': 3, 'errors': ['the row is not valid UTF-8']}]
+    rows = [values for batch in client.connections.batches for _, values in batch]
+    assert [row[2] for row in rows] == [None, 'Texas']
+    assert [row[3] for row in rows] == [1.5, 3.0]
+
+
+def test_ndjson_rejects_not_finite_hashrates_and_falsy_provinces(client):
+    row = '{"period_start_date": "2021-01-01", "period": "daily", "country": "United States", ' \
+          '"province": %s, "average_hashrate": %s, "unit": "th/s"}'
+    lines = [row % ('null', '1'), row % ('""', '"nan"'), row % ('0', '2'), row % ('[]', '"-inf"'),
+             row % ('"Texas"', '"1e999"'), row % ('""', '"4"')]
+    body = '\n'.join(lines).encode() + b'\n\xfe\n'
+
+    result = post_bulk(client, body, 'application/x-ndjson').get_json()
+
+    assert (result['received'], result['created'], result['failed']) == (7, 2, 5)
+    assert {error['line']: error['errors'] for error in result['errors']} == {
+        2: ['"average_hashrate" should be numeric'],
+        3: ['"province" should be string or null'],
+        4: ['"province" should be string or null', '"average_hashrate" should be numeric'],
+        5: ['"average_hashrate" should be numeric'],
+        7: ['the line is not valid UTF-8'],
+    }
+    rows = [values for batch in client.connections.batches for _, values in batch]
+    assert [(row[2], row[3]) for row in rows] == [(None, 1), (None, 4.0)]
+
+
+def test_each_batch_is_committed_on_its_own(client, monkeypatch):
+    monkeypatch.setattr(contribute, 'BULK_BATCH_ROWS', 2)
+    row = '{"period_start_date": "2021-01-0%d", "period": "daily", "country": "United States", ' \
+          '"province": null, "average_hashrate": 1, "unit": "th/s"}'
+    body = '\n'.join(row % day for day in range(1, 6)).encode()
+
+    result = post_bulk(client, body, 'application/x-ndjson').get_json()
+
+    assert result['status'] == 'success'
+    assert result['created'] == 5
+    assert client.connections.opened == 3
+    assert [len(batch) for batch in client.connections.batches] == [2, 2, 1]
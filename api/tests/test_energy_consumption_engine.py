@@ -0,0 +1,62 @@
+import random
+import numpy as np
+import pandas as pd
+import pytest
+from services.energy_consumption_engine import EnergyConsumptionEngine
+
+DAY = 24 * 60 * 60
+DAYS = 400
+MINERS = 40
+
+
+def row_by_row_profitable(timestamp, prof_threshold_ma, price, release_dates, efficiencies):
+    # the loop of EnergyConsumptionPowerByTypes.get_profitability_equipment
+    price_coefficient = 0.05 / price
+    return [efficiency for release_date, efficiency in zip(release_dates, efficiencies)
+            if timestamp > release_date and prof_threshold_ma * price_coefficient > efficiency]
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = random.Random(1)
+    timestamps = [1404172800 + DAY * day for day in range(DAYS)]
+    release_dates = [timestamps[0] + DAY * rng.randint(-100, DAYS) for _ in range(MINERS)]
+    efficiencies = [round(rng.uniform(0.02, 2.0), 2) for _ in range(MINERS)]
+    # some thresholds are exactly an efficiency of a miner
+    prof_thresholds_ma = [rng.choice(efficiencies) if day % 10 == 0 else rng.uniform(0.01, 3.0)
+                          for day in range(DAYS)]
+    hash_rates = [rng.uniform(1e5, 1e8) for _ in range(DAYS)]
+    engine = EnergyConsumptionEngine(timestamps, prof_thresholds_ma, hash_rates, release_dates, efficiencies,
+                                     typed_hash_rates=np.zeros((DAYS, 1)), typed_avg_efficiency=[0.1])
+    return engine, timestamps, prof_thresholds_ma, release_dates, efficiencies
+
+
+@pytest.mark.parametrize('price', [0.01, 0.05, 0.0731, 0.2, 1.0])
+def test_profitable_qty_matches_row_by_row(data, price):
+    engine, timestamps, prof_thresholds_ma, release_dates, efficiencies = data
+
+    expected = [len(row_by_row_profitable(timestamp, threshold, price, release_dates, efficiencies))
+                for timestamp, threshold in zip(timestamps, prof_thresholds_ma)]
+
+    assert engine.profitable_qty(price).tolist() == expected
+
+
+@pytest.mark.parametrize('price', [0.03, 0.05, 0.12])
+def test_min_max_power_match_row_by_row(data, price):
+    engine, timestamps, prof_thresholds_ma, release_dates, efficiencies = data
+
+    rows = []
+    for day, (timestamp, threshold) in enumerate(zip(timestamps, prof_thresholds_ma)):
+        profitable = row_by_row_profitable(timestamp, threshold, price, release_dates, efficiencies)
+        hash_rate = engine.hash_rates[day]
+        if profitable:
+            rows.append({'min_power': min(profitable) * hash_rate / 1e6 * 1.01,
+                         'max_power': max(profitable) * hash_rate / 1e6 * 1.2})
+        else:
+            # the unprofitable days take the previous values, 0 at the start
+            rows.append(rows[-1] if rows else {'min_power': 0, 'max_power': 0})
+    expected = pd.DataFrame(rows).rolling(window=7, min_periods=1).mean()
+
+    frame = engine.get_frame(price)
+    for column in ['min_power', 'max_power']:
+        np.testing.assert_allclose(frame[column].to_numpy(), expected[column].to_numpy(), rtol=1e-12)
@@ -0,0 +1,105 @@
+import gzip
+import datetime
+import pytest
+from conftest import FakeCollectionReference
+from services.realtime_collection import CollectionIndex, RealtimeCollection, RealtimeCollections
+
+UPDATED_AT = datetime.datetime(2021, 5, 4, 3, 2, 1, tzinfo=datetime.timezone.utc)
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return str(tmp_path / 'TextPages.json.gz')
+
+
+def active_by_project():
+    return CollectionIndex(lambda doc: (doc['project'],) if doc.get('is_active') else ())
+
+
+def test_live_snapshot_is_persisted(cache_path):
+    reference = FakeCollectionReference({'a': {'project': 'cbeci', 'is_active': True, 'updatedAt': UPDATED_AT}})
+    collection = RealtimeCollection(reference, cache_path=cache_path)
+    assert collection.state == 'empty'
+
+    reference.push_initial()
+    assert collection.state == 'live'
+    assert collection.persisted_at is not None
+
+    # a new worker serves the persisted docs before its first snapshot
+    warm = RealtimeCollection(FakeCollectionReference(), cache_path=cache_path)
+    assert warm.state == 'warm'
+    assert warm.get('a') == {'project': 'cbeci', 'is_active': True, 'updatedAt': UPDATED_AT}
+
+
+def test_stale_snapshot_is_reconciled_with_the_first_live_snapshot(cache_path):
+    reference = FakeCollectionReference({
+        'kept': {'project': 'cbeci', 'is_active': True, 'title': 'old'},
+        'removed': {'project': 'cbeci', 'is_active': True},
+    })
+    RealtimeCollection(reference, cache_path=cache_path)
+    reference.push_initial()
+
+    # while the worker is down a doc is changed, one is removed and one is added
+    live = FakeCollectionReference({
+        'kept': {'project': 'cbeci', 'is_active': True, 'title': 'new'},
+        'added': {'project': 'cbeci', 'is_active': True},
+    })
+    collection = RealtimeCollection(live, cache_path=cache_path)
+    changes = []
+    collection.add_listener(lambda doc_id, old_doc, new_doc: changes.append((doc_id, new_doc is None)))
+    index = active_by_project()
+    collection.add_index('active_by_project', index)
+    assert collection.state == 'warm'
+    assert sorted(collection._docs) == ['kept', 'removed']
+    assert len(index.get('cbeci')) == 2
+
+    live.push_initial()
+    assert collection.state == 'live'
+    assert sorted(collection._docs) == ['added', 'kept']
+    assert collection.get('kept')['title'] == 'new'
+    assert sorted(doc.get('title') or '' for doc in index.get('cbeci')) == ['', 'new']
+    assert ('removed', True) in changes
+
+    # the reconciled docs are persisted for the next worker
+    assert sorted(RealtimeCollection(FakeCollectionReference(), cache_path=cache_path)._docs) == ['added', 'kept']
+
+
+@pytest.mark.parametrize('content', [b'not gzip', gzip.compress(b'{"docs": '), gzip.compress(b'[]'),
+                                     gzip.compress(b'{"docs": {"a": 1}, "saved_at": 1}')])
+def test_corrupt_snapshot_is_ignored(cache_path, content):
+    with open(cache_path, 'wb') as fp:
+        fp.write(content)
+
+    reference = FakeCollectionReference({'a': {'project': 'cbeci', 'is_active': True}})
+    collection = RealtimeCollection(reference, cache_path=cache_path)
+    assert collection.state == 'empty'
+    assert collection.get() == []
+    assert collection.last_error is not None
+
+    # the live snapshot replaces the corrupt file
+    reference.push_initial()
+    assert collection.state == 'live'
+    assert RealtimeCollection(FakeCollectionReference(), cache_path=cache_path).state == 'warm'
+
+
+def test_readiness(cache_path, tmp_path):
+    warm_reference = FakeCollectionReference({'a': {'project': 'cbeci'}})
+    RealtimeCollection(warm_reference, cache_path=cache_path)
+    warm_reference.push_initial()
+
+    collections = RealtimeCollections()
+    collections.collections = {
+        'TextPages': RealtimeCollection(FakeCollectionReference(), cache_path=cache_path),
+        'Reports': RealtimeCollection(FakeCollectionReference(), cache_path=str(tmp_path / 'Reports.json.gz')),
+    }
+    collections._initialized = True
+
+    status = collections.status()
+    assert not status['ready']
+    assert status['collections']['TextPages']['state'] == 'warm'
+    assert status['collections']['Reports']['state'] == 'empty'
+
+    collections.collections['Reports'].collectionRf.push_initial()
+    status = collections.status()
+    assert status['ready']
+    assert status['collections']['Reports']['state'] == 'live'
@@ -0,0 +1,68 @@
+import random
+import pytest
+from services.price_cache import canonical_price
+from services.realtime_estimate import CurrentDayIndex
+
+PROF_THRESHOLD = 0.57
+HASHRATE = 1.5e8
+
+
+@pytest.fixture(scope='module')
+def efficiencies():
+    rng = random.Random(2)
+    # one miner is exactly at the threshold of the default price
+    return [round(rng.uniform(0.02, 2.0), 2) for _ in range(50)] + [PROF_THRESHOLD]
+
+
+def row_by_row(efficiencies, price):
+    # the loop of the former /api/max, /api/min and /api/guess
+    k = 0.05 / price
+    prof_eqp = [efficiency for efficiency in efficiencies if PROF_THRESHOLD * k > efficiency]
+    if not prof_eqp:
+        return None
+    return {
+        'min_power': min(prof_eqp) * HASHRATE * 1.01 / 1e6,
+        'max_power': max(prof_eqp) * HASHRATE * 1.2 / 1e6,
+        'guess_power': sum(prof_eqp) / len(prof_eqp) * HASHRATE * 1.1 / 1e6,
+        'qty': len(prof_eqp),
+    }
+
+
+@pytest.mark.parametrize('price', [0.001, 0.01, 0.03, 0.05, 0.0731, 0.5, 10.0])
+def test_profitable_qty_and_power_match_row_by_row(efficiencies, price):
+    index = CurrentDayIndex(timestamp=0, prof_threshold=PROF_THRESHOLD, efficiencies=efficiencies)
+    expected = row_by_row(efficiencies, price)
+
+    qty = index.profitable_qty(price)
+    power = index.power(qty, HASHRATE)
+    if expected is None:
+        assert qty == 0
+        assert power == {'min_power': None, 'max_power': None, 'guess_power': None}
+        return
+    assert qty == expected['qty']
+    assert power['min_power'] == expected['min_power']
+    assert power['max_power'] == expected['max_power']
+    assert power['guess_power'] == pytest.approx(expected['guess_power'], rel=1e-12)
+
+
+def test_curve_steps_match_row_by_row(efficiencies):
+    index = CurrentDayIndex(timestamp=0, prof_threshold=PROF_THRESHOLD, efficiencies=efficiencies)
+
+    for point in index.curve(HASHRATE):
+        # just below the step price the cheapest `profitable_miners` miners are profitable, not just above it
+        below = row_by_row(efficiencies, point['price'] * (1 - 1e-9))
+        above = row_by_row(efficiencies, point['price'] * (1 + 1e-9))
+        assert below['qty'] >= point['profitable_miners']
+        assert (above['qty'] if above else 0) < point['profitable_miners']
+        assert point['min_power'] == pytest.approx(below['min_power'])
+
+
+@pytest.mark.parametrize('value', ['0', '-0.05', 'nan', 'inf', '-inf', 'abc', None])
+def test_invalid_prices_are_rejected_before_the_estimate(value):
+    # /api/max, /api/min, /api/guess and /api/estimate answer 400 for these
+    with pytest.raises((TypeError, ValueError)):
+        canonical_price(value)
+
+
+def test_equal_prices_share_the_estimate_key():
+    assert canonical_price('0.05') == canonical_price('0.0500') == canonical_price('0.0500001') == 0.05
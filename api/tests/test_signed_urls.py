@@ -0,0 +1,139 @@
+import datetime
+import pytest
+import services.signed_urls as signed_urls
+from conftest import FakeCollectionReference
+from services.realtime_collection import RealtimeCollection, RealtimeCollections
+
+HOUR = 60 * 60
+
+
+class FakeSigner:
+    def __init__(self):
+        self.signed = []
+
+    def __call__(self, bucket, path, expiration):
+        self.signed.append((bucket, path, expiration))
+        return f'https://storage.test/{bucket}/{path}?signature={len(self.signed)}'
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture
+def signer():
+    return FakeSigner()
+
+
+@pytest.fixture
+def cache(signer, clock):
+    return signed_urls.SignedUrlCache(signer=signer, expiration=datetime.timedelta(days=1),
+                                      safety_margin=datetime.timedelta(hours=1), clock=clock)
+
+
+def test_url_is_reused_until_the_safety_margin(cache, signer, clock):
+    url = cache.get('bucket', 'reports/a.pdf')
+    assert signer.signed == [('bucket', 'reports/a.pdf', datetime.timedelta(days=1))]
+
+    clock.now += 23 * HOUR - 1
+    assert cache.get('bucket', 'reports/a.pdf') == url
+    assert len(signer.signed) == 1
+
+    # one hour before the url expires it is signed again
+    clock.now += 1
+    refreshed = cache.get('bucket', 'reports/a.pdf')
+    assert refreshed != url
+    assert len(signer.signed) == 2
+    assert cache.entry('bucket', 'reports/a.pdf') == (refreshed, clock.now + 23 * HOUR)
+
+
+def test_urls_by_bucket_and_path(cache, signer):
+    cache.get('bucket', 'reports/a.pdf')
+    cache.get('other', 'reports/a.pdf')
+    cache.get('bucket', 'reports/b.pdf')
+    cache.get('bucket', 'reports/a.pdf')
+
+    assert len(signer.signed) == 3
+    assert cache.status() == {'urls': 3, 'hits': 1, 'misses': 3, 'invalidations': 0}
+
+
+def test_invalidate(cache, signer):
+    url = cache.get('bucket', 'reports/a.pdf')
+    cache.invalidate('bucket', 'reports/a.pdf')
+
+    assert cache.get('bucket', 'reports/a.pdf') != url
+    assert cache.status()['invalidations'] == 1
+
+
+@pytest.fixture
+def listing(cache, monkeypatch):
+    collections = RealtimeCollections()
+    monkeypatch.setattr(signed_urls, 'realtime_collections', collections)
+    listing = signed_urls.SignedFileListing('Reports', 'bucket', 'reports', cache)
+    reference = FakeCollectionReference({
+        'a': {'filename': 'a.pdf', 'is_active': True, 'project': 'cbeci', 'order_position': 2},
+        'b': {'filename': 'b.pdf', 'is_active': True, 'project': 'cbeci', 'order_position': 1},
+        'c': {'filename': 'c.pdf', 'is_active': False, 'project': 'cbeci', 'order_position': 0},
+        'd': {'filename': 'd.pdf', 'is_active': True, 'project': 'other', 'order_position': 0},
+    })
+    collection = RealtimeCollection(reference)
+    collections.collections['Reports'] = collection
+    collection.add_index('active_by_project', listing.docs)
+    reference.push_initial()
+    return listing, reference
+
+
+def test_listing_is_sorted_by_project_with_the_cached_urls(listing, signer, clock):
+    listing, _ = listing
+
+    docs = listing.index('cbeci')
+    assert [doc['filename'] for doc in docs] == ['b.pdf', 'a.pdf']
+    assert docs[0]['fileurl'] == ['https://storage.test/bucket/reports/b.pdf?signature=1']
+    assert listing.index('cbeci') is docs
+    assert len(signer.signed) == 2
+
+    # the payload is rebuilt when one of its urls is signed again
+    clock.now += 23 * HOUR
+    assert listing.index('cbeci')[0]['fileurl'] == ['https://storage.test/bucket/reports/b.pdf?signature=3']
+    assert [doc['filename'] for doc in listing.index('other')] == ['d.pdf']
+    assert listing.index('unknown') == []
+
+
+def test_listing_invalidates_the_urls_of_the_changed_docs(listing, signer):
+    listing, reference = listing
+    listing.index('cbeci')
+
+    reference.push({'a': {'filename': 'a.pdf', 'is_active': True, 'project': 'cbeci', 'order_position': 0,
+                          'title': 'new'}})
+    docs = listing.index('cbeci')
+    assert [doc['filename'] for doc in docs] == ['a.pdf', 'b.pdf']
+    assert docs[0]['fileurl'] == ['https://storage.test/bucket/reports/a.pdf?signature=3']
+    assert docs[1]['fileurl'] == ['https://storage.test/bucket/reports/b.pdf?signature=1']
+
+    reference.push(removed=['a'])
+    assert [doc['filename'] for doc in listing.index('cbeci')] == ['b.pdf']
+    assert listing.urls.status()['invalidations'] == 2
+
+
+def test_listing_keeps_only_the_payloads_of_known_projects(listing):
+    listing, reference = listing
+    for project in ('unknown', 'x' * 100, ''):
+        assert listing.index(project) == []
+    listing.index('cbeci')
+    listing.index('other')
+    assert sorted(listing._payloads) == ['cbeci', 'other']
+
+    # a new revision drops the payloads of the previous one, 'other' has no active docs anymore
+    reference.push(removed=['d'])
+    assert listing.index('other') == []
+    listing.index('cbeci')
+    assert sorted(listing._payloads) == ['cbeci']
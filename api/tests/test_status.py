@@ -0,0 +1,37 @@
+import pytest
+from flask import Flask, jsonify
+from blueprints import status
+from decorators.auth import AuthenticationError
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv('RATELIMIT_EXEMPT_IP', '10.0.0.1')
+    monkeypatch.setattr(status.db, 'status', lambda: {'custom_data': {'last_error': 'could not connect to "db.host"'}})
+    monkeypatch.setattr(status.realtime_collections, 'status',
+                        lambda: {'ready': False, 'collections': {'Reports': {'last_error': 'PermissionDenied'}}})
+
+    app = Flask(__name__)
+    app.register_blueprint(status.bp)
+    app.register_error_handler(AuthenticationError, lambda error: (jsonify(error=str(error)), 401))
+    return app.test_client()
+
+
+def test_statuses_are_served_to_the_internal_ip_only(client):
+    response = client.get('/status/db', headers={'X-Real-Ip': '203.0.113.5'})
+    assert response.status_code == 401
+    assert 'db.host' not in response.get_data(as_text=True)
+
+    response = client.get('/status/db', headers={'X-Real-Ip': '10.0.0.1'})
+    assert response.status_code == 200
+    assert response.get_json()['data']['custom_data']['last_error'] == 'could not connect to "db.host"'
+
+
+def test_collections_readiness_is_public_without_the_details(client):
+    response = client.get('/status/collections', headers={'X-Real-Ip': '203.0.113.5'})
+    assert response.status_code == 503
+    assert response.get_json() == {'data': {'ready': False}}
+
+    response = client.get('/status/collections', headers={'X-Real-Ip': '10.0.0.1'})
+    assert response.status_code == 503
+    assert response.get_json()['data']['collections']['Reports']['last_error'] == 'PermissionDenied'
@@ -0,0 +1,113 @@
+import pytest
+from services.write_behind import WriteBehindQueue
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    queue = WriteBehindQueue(max_attempts=2)
+    queue.init(path=str(tmp_path / 'write_behind.sqlite3'))
+    # the jobs are dispatched by the test, not by the background thread
+    monkeypatch.setattr(queue, 'start', lambda: None)
+    return queue
+
+
+def test_poison_job_does_not_fail_the_good_jobs_of_its_batch(queue):
+    committed = []
+
+    def save_rows(jobs):
+        # all or nothing, like one DB transaction
+        rows = [payload['row'] for _, payload in jobs]
+        if any(row is None for row in rows):
+            raise ValueError('null row')
+        committed.extend(rows)
+
+    queue.register('rows', save_rows, batch_size=10)
+    good_ids = [queue.enqueue('rows', {'row': i}) for i in range(3)]
+    poison_id = queue.enqueue('rows', {'row': None})
+    good_ids += [queue.enqueue('rows', {'row': i}) for i in range(3, 5)]
+
+    assert queue.dispatch()
+    assert committed == [0, 1, 2, 3, 4]
+    assert all(queue.job(job_id)['state'] == 'done' for job_id in good_ids)
+    poison = queue.job(poison_id)
+    assert poison['state'] == 'pending'
+    assert poison['attempts'] == 1
+    assert poison['last_error'] == 'ValueError: null row'
+
+
+def test_job_is_dead_after_max_attempts(queue, monkeypatch):
+    import services.write_behind as write_behind
+    monkeypatch.setattr(write_behind, 'WRITE_BEHIND_RETRY_DELAY', 0)
+
+    def fail(jobs):
+        raise RuntimeError('down')
+
+    queue.register('rows', fail)
+    job_id = queue.enqueue('rows', {'row': 1})
+    queue.dispatch()
+    queue.dispatch()
+
+    job = queue.job(job_id)
+    assert job['state'] == 'dead'
+    assert job['attempts'] == 2
+    assert queue.status()['dead'] == {'rows': 1}
+    assert not queue.dispatch()
+
+
+def test_dedupe_key_while_pending(queue):
+    sent = []
+    queue.register('webhook', lambda jobs: sent.extend(jobs))
+
+    assert queue.enqueue('webhook', {'data': 'a'}, target='url', dedupe_key='a') is not None
+    assert queue.enqueue('webhook', {'data': 'a'}, target='url', dedupe_key='a') is None
+    queue.dispatch()
+    assert sent == [('url', {'data': 'a'})]
+    # the key is released once the job is done
+    assert queue.enqueue('webhook', {'data': 'a'}, target='url', dedupe_key='a') is not None
+
+
+def test_unknown_job(queue):
+    assert queue.job(1) is None
+    job_id = queue.enqueue('rows', {'row': 1})
+    assert queue.job(job_id + 1) is None
+
+
+def test_done_job_keeps_its_owner(queue, monkeypatch):
+    import services.write_behind as write_behind
+    queue.register('rows', lambda jobs: None, batch_size=10)
+    job_id = queue.enqueue('rows', {'row': 1}, target='7')
+    queue.dispatch()
+
+    assert queue.job(job_id) == {'id': job_id, 'kind': 'rows', 'target': '7', 'state': 'done'}
+
+    # the markers are pruned by the next done batch after the retention
+    monkeypatch.setattr(write_behind, 'WRITE_BEHIND_DONE_RETENTION', -1)
+    queue.enqueue('rows', {'row': 2})
+    queue.dispatch()
+    assert queue.job(job_id) is None
+
+
+def test_rate_limit_is_shared_by_the_processes(queue, monkeypatch):
+    sent = []
+    # a second queue on the same journal, like another worker process of the host
+    other = WriteBehindQueue()
+    other.init(path=queue.path)
+    monkeypatch.setattr(other, 'start', lambda: None)
+    for q in (queue, other):
+        q.register('webhook', lambda jobs: sent.extend(jobs), batch_size=1, rate_limit=1)
+
+    for i in range(3):
+        queue.enqueue('webhook', {'data': i}, target='url')
+    assert queue.dispatch()
+    assert not other.dispatch()
+    assert not queue.dispatch()
+    assert len(sent) == 1
+
+
+def test_transaction_rolls_back_the_whole_block(queue):
+    job_id = queue.enqueue('rows', {'row': 1})
+    with pytest.raises(RuntimeError):
+        with queue._connection() as conn:
+            conn.execute('DELETE FROM jobs WHERE id = ?', (job_id,))
+            raise RuntimeError
+    assert queue.job(job_id)['state'] == 'pending'
@@ -1,12 +1,17 @@
+import time
 import click
 import psycopg2
+import psycopg2.extras
 import logging
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pformat
 from config import config
 from datetime import datetime
+from api.http_client import get_json, make_session
 
 DEFAULT_LOG_LEVEL = logging.INFO
+DEFAULT_FETCH_WORKERS = 8
+EIA_SERIES_URL = 'http://api.eia.gov/series'
 LOGGER = logging.getLogger()
 
 def get_countries():
@@ -26,12 +31,12 @@ def get_countries():
             return [_to_item(record) for record in cursor.fetchall()]
 
 
-def get_ec_from_api(series_id):
+def get_ec_from_api(series_id, session=None):
     params = {
         'api_key': config['api_eia_gov']['api_key'],
         'series_id': series_id
     }
-    response = requests.get("http://api.eia.gov/series", params=params).json()
+    response = get_json(session or make_session(), EIA_SERIES_URL, params=params)
     LOGGER.debug(f"series_id - {series_id}: Response:\n\n{pformat(response)}\n\n")
 
     return response
@@ -54,44 +59,69 @@ def get_latest_data(data):
     return max_year, value
 
 
-def save_country_value(country, electricity_consumption, year):
-    if country['electricity_consumption'] != electricity_consumption or country['year'] != year:
-        with psycopg2.connect(**config['custom_data']) as connection:
-            with connection.cursor() as cursor:
-                table_name = 'countries'
-                # Template of the query to paste a row to a table
-                insert_sql = """
-                    UPDATE {table_name}
-                    SET electricity_consumption = %(electricity_consumption)s,
-                        year = %(year)s
-                    WHERE series_id = %(series_id)s
-                """.format(table_name=table_name)
-
-                try:
-                    cursor.execute(insert_sql, {
-                        'series_id': country['series_id'],
-                        'electricity_consumption': electricity_consumption,
-                        'year': year
-                    })
-                except Exception as error:
-                    LOGGER.exception(f"{table_name}: {str(error)}")
-                    return False
-                finally:
-                    connection.commit()
-    return True
-
-
-def update_country_ec(country):
+def save_country_values(changes):
+    """
+    Applies all the changed values with one UPDATE in one transaction.
+    `changes` are (series_id, electricity_consumption, year) tuples.
+    """
+    if not changes:
+        return 0
+    with psycopg2.connect(**config['custom_data']) as connection:
+        with connection.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, """
+                UPDATE countries
+                SET electricity_consumption = changes.electricity_consumption,
+                    year = changes.year
+                FROM (VALUES %s) AS changes (series_id, electricity_consumption, year)
+                WHERE countries.series_id = changes.series_id
+            """, changes, template='(%s, %s::double precision, %s::integer)', page_size=len(changes))
+            return cursor.rowcount
+
+
+def fetch_country_ec(country, session=None):
     # LOGGER.info('update_country_electricity_consumption: %s' % country['country'])
-    json = get_ec_from_api(country['series_id'])
+    json = get_ec_from_api(country['series_id'], session)
     data = json['series'][0]['data']
-    year, value = get_latest_data(data)
-    return save_country_value(country, electricity_consumption=value, year=year)
+    return get_latest_data(data)
+
+
+def update_countries_ec(countries, workers=DEFAULT_FETCH_WORKERS):
+    """
+    Fetches the series of the countries concurrently and saves the changed values at once,
+    returns the summary of the run.
+    """
+    countries = [country for country in countries if country['series_id'] is not None]
+    summary = {'countries': len(countries), 'fetched': 0, 'changed': 0, 'failed': 0}
+    changes = []
+    started_at = time.time()
+    session = make_session(pool_size=workers)
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_country_ec, country, session): country for country in countries}
+        for future in as_completed(futures):
+            country = futures[future]
+            try:
+                year, value = future.result()
+            except Exception as error:
+                summary['failed'] += 1
+                LOGGER.error(f"series_id - {country['series_id']} ({country['country']}): {str(error)}")
+                continue
+            summary['fetched'] += 1
+            if country['electricity_consumption'] != value or country['year'] != year:
+                changes.append((country['series_id'], value, year))
+    summary['fetch_time'] = round(time.time() - started_at, 3)
+
+    started_at = time.time()
+    save_country_values(changes)
+    summary['changed'] = len(changes)
+    summary['save_time'] = round(time.time() - started_at, 3)
+
+    return summary
 
 
 @click.command()
 @click.option('--log-level', '-l', default=DEFAULT_LOG_LEVEL)
-def main(log_level):
+@click.option('--workers', '-w', default=DEFAULT_FETCH_WORKERS, show_default=True)
+def main(log_level, workers):
     # Logging
     level = log_level.upper() if isinstance(log_level, str) else log_level
     LOGGER.setLevel(level)
@@ -99,10 +129,10 @@ def main(log_level):
     LOGGER.addHandler(logging.StreamHandler())
 
     LOGGER.info(f"countires electricity_consumption: as of {datetime.utcnow().isoformat()}")
-    countries = get_countries()
-    for country in countries:
-        if country['series_id'] is not None:
-            update_country_ec(country)
+    summary = update_countries_ec(get_countries(), workers)
+    LOGGER.info(f"countires electricity_consumption: {summary['fetched']}/{summary['countries']} fetched, "
+                f"{summary['changed']} changed, {summary['failed']} failed; "
+                f"fetch {summary['fetch_time']}s, save {summary['save_time']}s")
 
 
 if __name__ == '__main__':
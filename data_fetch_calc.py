@@ -5,7 +5,8 @@ from datetime import datetime
 from dateutil import parser
 import click
 import yaml
-from api.helpers import get_guess_consumption, get_hash_rates_by_miners_types, get_avg_effciency_by_miners_types_old, load_typed_hasrates
+from api.bulk_writer import BulkWriter
+from api.helpers import get_guess_consumption, get_avg_effciency_by_miners_types_old, load_typed_hasrates
 from api.data_source.coinmetrics import CoinMetrics
 from api.api.coinmetrics import CoinMetrics as ApiCoinMetrics
 
@@ -18,31 +19,26 @@ else:
 
 DEFAULT_LOG_LEVEL = logging.INFO
 DEFAULT_ELECTRICITY_PRICE = 0.05
+HASH_RATE_START_DATE = '2014-07-01'
+# the days before the watermark which are fetched again, the source revises its latest values
+REVISION_OVERLAP_DAYS = 3
+PROF_THRESHOLD_MA_DAYS = 14
+ENERGY_CONSUMPTION_MA_DAYS = 7
+DAY = 24 * 60 * 60
+# the coinmetrics history is fetched in parallel chunks of that many days
+COINMETRICS_CHUNK_DAYS = 365
 LOGGER = logging.getLogger()
 
 
-def save_values(values, connection, table_name):
-    # Creating cursor to work with DB
-    cursor = connection.cursor()
+def save_values(values, connection, table_name, upsert=False, commit=True):
     # Creating table. timestamp is a PRIMARY KEY, values are unique
-    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name}"
-                   f" (timestamp INT PRIMARY KEY, date TEXT, value REAL);")
-    # Template of the query to paste a row to a table
-    insert_sql = f"INSERT INTO {table_name} (timestamp, date, value) " \
-                 f"VALUES (%s, %s, %s) ON CONFLICT ON CONSTRAINT {table_name}_pkey DO NOTHING;"
-    # Taking 'values' from the API reply and inputting rows one by one
-    for timestamp, value in values:
-        # The second column is going to be date in readable format
-        date = datetime.utcfromtimestamp(timestamp).isoformat()
-        # Trying to insert row
-        try:
-            cursor.execute(insert_sql, (timestamp, date, value))
-        # If the row with this timestamp already exist, ignore it
-        except Exception as error:
-            LOGGER.exception(f"{table_name}: {str(error)}")
-            pass
-        finally:
-            connection.commit()
+    writer = BulkWriter(connection, table_name, ['timestamp', 'date', 'value'], upsert=upsert, commit=commit,
+                        create_sql=f"CREATE TABLE IF NOT EXISTS {table_name}"
+                                   f" (timestamp INT PRIMARY KEY, date TEXT, value REAL);")
+    # Taking 'values' from the API reply, the second column is going to be date in readable format.
+    # All the rows are written in one transaction, the rows with existing timestamps are ignored (or updated)
+    writer.extend((timestamp, datetime.utcfromtimestamp(timestamp).isoformat(), value) for timestamp, value in values)
+    return writer.flush()
 
 @click.group(chain=True)
 @click.option('--log-level', '-l', default=DEFAULT_LOG_LEVEL)
@@ -53,10 +49,52 @@ def cli(log_level):
     # Console outputs
     LOGGER.addHandler(logging.StreamHandler())
 
+
+def get_watermarks(connection, source):
+    # the last stored timestamp of every metric of the source
+    with connection.cursor() as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS fetch_watermarks (source TEXT NOT NULL, metric TEXT NOT NULL, "
+                       "timestamp INT NOT NULL, updated_at timestamp without time zone NOT NULL DEFAULT NOW(), "
+                       "PRIMARY KEY (source, metric));")
+        cursor.execute("SELECT metric, timestamp FROM fetch_watermarks WHERE source = %s", (source,))
+        watermarks = dict(cursor.fetchall())
+    connection.commit()
+    return watermarks
+
+
+def save_watermarks(connection, source, watermarks):
+    # committed with the tables written since the last commit, the watermark never gets ahead of them
+    with connection.cursor() as cursor:
+        for metric, timestamp in watermarks.items():
+            # the watermark never goes back, a shorter (revised) reply doesn't cause a refetch of the history
+            cursor.execute("INSERT INTO fetch_watermarks (source, metric, timestamp) VALUES (%s, %s, %s) "
+                           "ON CONFLICT (source, metric) DO UPDATE SET "
+                           "timestamp = GREATEST(fetch_watermarks.timestamp, EXCLUDED.timestamp), updated_at = NOW()",
+                           (source, metric, int(timestamp)))
+    connection.commit()
+
+
+def load_values(connection, table_name, since):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT timestamp, value FROM {table_name} WHERE timestamp >= %s ORDER BY timestamp", (since,))
+        return cursor.fetchall()
+
+
+def load_last_consumption(connection, before):
+    # the consumption of the last day before the recomputed tail, it is carried over the unprofitable days
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT max_consumption, min_consumption, guess_consumption FROM energy_consumption "
+                       "WHERE timestamp < %s ORDER BY timestamp DESC LIMIT 1", (before,))
+        return cursor.fetchone() or (0, 0, 0)
+
+
 # this is to change parameters from CLI
 @cli.command()
 @click.option('--price', '-p', default=DEFAULT_ELECTRICITY_PRICE)
-def hash_rate(price):
+@click.option('--full', is_flag=True, help='Refetch and recompute the whole history')
+@click.option('--overlap-days', default=REVISION_OVERLAP_DAYS, show_default=True,
+              help='Days before the watermark which are refetched to pick up the revised values')
+def hash_rate(price, full, overlap_days):
     LOGGER.info('hash_rate called')
 
     with psycopg2.connect(**config['custom_data']) as connection2:
@@ -65,26 +103,55 @@ def hash_rate(price):
             miners = c2.fetchall()
 
     all_data = {}
+    metrics = ['difficulty', 'hash-rate', 'miners-revenue', 'market-price']
     # Opening DB. When the 'with' block ends, connection will be closed
     with psycopg2.connect(**config['blockchain_data']) as connection:
-        data = CoinMetrics().get_values(start_date='2014-07-01')
+        watermarks = get_watermarks(connection, 'coinmetrics')
+        if full or any(metric not in watermarks for metric in metrics):
+            start_date = HASH_RATE_START_DATE
+            # everything is recomputed
+            recompute_from = 0
+        else:
+            recompute_from = min(watermarks[metric] for metric in metrics) - overlap_days * DAY
+            start_date = datetime.utcfromtimestamp(recompute_from).strftime('%Y-%m-%d')
+        LOGGER.info(f"hash_rate: fetching since {start_date}")
+
+        data = CoinMetrics().get_values(start_date=start_date)
+        metrics_values = {metric: [] for metric in metrics}
         for item in data:
-            if any(item[metric] is None for metric in ['difficulty', 'hash-rate', 'miners-revenue', 'market-price']):
+            if any(item[metric] is None for metric in metrics):
                 continue
-            for metric in ['difficulty', 'hash-rate', 'miners-revenue', 'market-price']:
+            for metric in metrics:
                 if metric in item:
-                    # this is because table name can't contain hyphens
-                    table_name = metric.replace('-', '_')
                     value = item[metric]
-                    timestamp = item['timestamp']
+                    timestamp = int(item['timestamp'])
 
-                    save_values([(timestamp, value)], connection, table_name)
+                    metrics_values[metric].append((timestamp, value))
 
                     if timestamp not in all_data:
                         all_data[timestamp] = {}
 
                     all_data[timestamp][metric] = value
 
+        # the fetched metrics, the derived tables and the watermarks are written in one transaction:
+        # if a step fails, the next run fetches and recomputes the same days again
+        for metric, values in metrics_values.items():
+            # this is because table name can't contain hyphens
+            # the refetched days are overwritten, the source could have revised them
+            save_values(values, connection, metric.replace('-', '_'), upsert=True, commit=False)
+
+        last_consumption = (0, 0, 0)
+        if recompute_from:
+            # the rolling windows of the recomputed tail start before it, the earlier days are read from the DB
+            context_from = recompute_from - (PROF_THRESHOLD_MA_DAYS + ENERGY_CONSUMPTION_MA_DAYS) * DAY
+            for metric in metrics:
+                for timestamp, value in load_values(connection, metric.replace('-', '_'), context_from):
+                    all_data.setdefault(timestamp, {}).setdefault(metric, value)
+            all_data = {timestamp: data for timestamp, data in sorted(all_data.items())
+                        if all(metric in data for metric in metrics)}
+            last_consumption = load_last_consumption(connection, context_from)
+        LOGGER.info(f"hash_rate: recomputing {sum(timestamp >= recompute_from for timestamp in all_data)} days")
+
         # =============================================================================
         #        # This is to create block reward time series
         #        for timestamp, data in all_data.items():
@@ -133,122 +200,121 @@ def hash_rate(price):
                 LOGGER.warning(f"Zero div: timestamp={timestamp}, data={data}")
 
         save_values(((timestamp, data['prof-threshold']) for timestamp, data
-                     in all_data.items() if 'prof-threshold' in data),
-                    connection, 'prof_threshold')
+                     in all_data.items() if 'prof-threshold' in data and timestamp >= recompute_from),
+                    connection, 'prof_threshold', upsert=True, commit=False)
 
         # Calculating energy consumption
         LOGGER.info(f"energy-consumption: as of {datetime.utcnow().isoformat()}")
-        with connection.cursor() as c:
-            # Creating table. timestamp is a PRIMARY KEY, values are unique
-            c.execute("CREATE TABLE IF NOT EXISTS energy_consumption (timestamp "
-                      "INT PRIMARY KEY, date TEXT, max_consumption REAL, min_consumption REAL, "
-                      "guess_consumption REAL, all_prof_eqp TEXT, all_prof_eqp_qty TEXT);")
-            # Template of the query to paste a row to a table
-            insert_sql = "INSERT INTO energy_consumption (timestamp, date, max_consumption, " \
-                         "min_consumption, guess_consumption, all_prof_eqp, all_prof_eqp_qty) " \
-                         "VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT ON CONSTRAINT " \
-                         "energy_consumption_pkey DO NOTHING;"
-            prof_eqp = []  # temp var for list of profit. eqp efficiency
-            prof_eqp_all = []  # list of lists of profit. eqp efficiency
-            prof_eqp_qty = []  # temp var for the list of profit. eqp qty
-            prof_eqp_qty_all = []  # list of lists of profitable equipment qty
-            max_all = []
-            min_all = []
-            guess_all = []
-            ts_all = []
-
-            data_df = pd.DataFrame.from_dict(all_data, orient='index')
-            data_ma = data_df.rolling(window=14, min_periods=1).mean()
-
-            typed_hasrates = load_typed_hasrates() # @todo: uncomment this for S7/S9
-            typed_avg_effciency = get_avg_effciency_by_miners_types_old(miners) # @todo: uncomment this for S7/S9
-            for timestamp, data in all_data.items():
-                hash_rates = get_hash_rates_by_miners_types(typed_hasrates, timestamp) # @todo: uncomment this for S7/S9
-                for miner in miners:
-                    if timestamp > miner[1] and data_ma['prof-threshold'][timestamp] > miner[2]:
-                        # ^^current date and date of miner release ^^checks if miner is profitable;
-                        # if yes, adds miner's efficiency and qty to the lists:
-                        # prof_eqp.append(miner[2]) # @todo: remove this for S7/S9
-                        # prof_eqp_qty.append(miner[3]) # @todo: remove this for S7/S9
-                        # @todo: uncomment this for S7/S9
-                        type = miner[5]
-                        if not type:
-                            prof_eqp.append(miner[2])
-                            prof_eqp_qty.append(miner[3])
-                        # @todo: uncomment this for S7/S9
-                prof_eqp_qty_all.append(prof_eqp_qty)
-                prof_eqp_all.append(prof_eqp)
-                try:
-                    max_consumption = max(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e9 * 1.2
-                    min_consumption = min(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e9 * 1.01
-                    # @todo: remove this for S7/S9
-                    # if len(prof_eqp) == 0:
-                    #     guess_consumption = 0
-                    # else:
-                    #     guess_consumption = sum(prof_eqp) / len(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.1
-                    # @todo: /remove this for S7/S9
-                    guess_consumption = get_guess_consumption(prof_eqp, data['hash-rate'], hash_rates,
-                                                              typed_avg_effciency)  # @todo: uncomment this for S7/S9
-                # ====this=is=for=weighting===================================================
-                #                 weighted_sum = 0
-                #                 eqp_qty_this_day = 0
-                #                 # calculating the guess_consumption using the weighted average of prof_eqp efficiencies:
-                #                 for j in range(0, len(prof_eqp)):
-                #                     weighted_sum = weighted_sum + prof_eqp[j]*prof_eqp_qty[j]
-                #                     eqp_qty_this_day = eqp_qty_this_day + prof_eqp_qty[j]
-                #                 guess_consumption = weighted_sum/eqp_qty_this_day*hash_rate[i][2]*365.25*24/1e+9*1.05
-                # ===========================================================================
-                except Exception as error:  # in case if mining is not profitable (impossible to find MAX of empty list)
-                    LOGGER.warning(f"Mining was unprofitable at timestamp={timestamp}: '{error}'")
-                    max_consumption = max_all[-1] if len(max_all) > 0 else 0
-                    min_consumption = min_all[-1] if len(min_all) > 0 else 0
-                    guess_consumption = guess_all[-1] if len(guess_all) > 0 else 0
-                max_all.append(max_consumption)
-                min_all.append(min_consumption)
-                guess_all.append(guess_consumption)
-                ts_all.append(timestamp)
-                date = datetime.utcfromtimestamp(timestamp).isoformat()
-                prof_eqp = str(prof_eqp).strip('[]')  # making str from prof_eqp
-                prof_eqp_qty = str(prof_eqp_qty).strip('[]')
-                try:
-                    c.execute(insert_sql, (timestamp, date, max_consumption,
-                                           min_consumption, guess_consumption,
-                                           prof_eqp, prof_eqp_qty))
-                # If the row with this timestamp already exist, ignore it:
-                except Exception as error:
-                    LOGGER.warning(f"Energy consumption saving error at "
-                                   f"timestamp={timestamp}: '{error}'")
-                    pass
-                prof_eqp = []
-                prof_eqp_qty = []
-
-            # calculating MA of the resulting stats
-            LOGGER.info(f"energy-consump-MA: as of {datetime.utcnow().isoformat()}")
-            energy_df = pd.DataFrame(list(zip(max_all, min_all, guess_all)),
-                                     index=ts_all, columns=['MAX', 'MIN', 'GUESS'])
-            energy_ma = energy_df.rolling(window=7, min_periods=1).mean()
-
-            c.execute("CREATE TABLE IF NOT EXISTS energy_consumption_ma (timestamp INT PRIMARY KEY, "
-                      "date TEXT, max_consumption REAL, min_consumption REAL, guess_consumption REAL);")
-            insert_sql = "INSERT INTO energy_consumption_ma (timestamp, date, max_consumption, " \
-                         "min_consumption, guess_consumption) VALUES (%s, %s, %s, %s, %s) " \
-                         "ON CONFLICT ON CONSTRAINT energy_consumption_ma_pkey DO NOTHING;"
-
-            max_ma = list(energy_ma['MAX'])
-            min_ma = list(energy_ma['MIN'])
-            guess_ma = list(energy_ma['GUESS'])
-            ts = ts_all
-            date_all = []
-            for t in ts:
-                date = datetime.utcfromtimestamp(t).isoformat()
-                date_all.append(date)
-
-            for item in zip(ts, date_all, max_ma, min_ma, guess_ma):
-                try:
-                    c.execute(insert_sql, item)
-                except Exception as error:
-                    LOGGER.warning(f"Energy consumption MA saving err: {error}'")
-                    pass
+        # timestamp is a PRIMARY KEY, values are unique. The rows are written in one transaction after the loop
+        energy_consumption_writer = BulkWriter(
+            connection, 'energy_consumption',
+            ['timestamp', 'date', 'max_consumption', 'min_consumption', 'guess_consumption', 'all_prof_eqp',
+             'all_prof_eqp_qty'],
+            create_sql="CREATE TABLE IF NOT EXISTS energy_consumption (timestamp "
+                       "INT PRIMARY KEY, date TEXT, max_consumption REAL, min_consumption REAL, "
+                       "guess_consumption REAL, all_prof_eqp TEXT, all_prof_eqp_qty TEXT);",
+            upsert=True,
+            commit=False
+        )
+        prof_eqp = []  # temp var for list of profit. eqp efficiency
+        prof_eqp_all = []  # list of lists of profit. eqp efficiency
+        prof_eqp_qty = []  # temp var for the list of profit. eqp qty
+        prof_eqp_qty_all = []  # list of lists of profitable equipment qty
+        max_all = []
+        min_all = []
+        guess_all = []
+        ts_all = []
+
+        data_df = pd.DataFrame.from_dict(all_data, orient='index')
+        data_ma = data_df.rolling(window=PROF_THRESHOLD_MA_DAYS, min_periods=1).mean()
+
+        typed_hasrates = load_typed_hasrates() # @todo: uncomment this for S7/S9
+        typed_avg_effciency = get_avg_effciency_by_miners_types_old(miners) # @todo: uncomment this for S7/S9
+        for timestamp, data in all_data.items():
+            hash_rates = typed_hasrates.get(timestamp) # @todo: uncomment this for S7/S9
+            for miner in miners:
+                if timestamp > miner[1] and data_ma['prof-threshold'][timestamp] > miner[2]:
+                    # ^^current date and date of miner release ^^checks if miner is profitable;
+                    # if yes, adds miner's efficiency and qty to the lists:
+                    # prof_eqp.append(miner[2]) # @todo: remove this for S7/S9
+                    # prof_eqp_qty.append(miner[3]) # @todo: remove this for S7/S9
+                    # @todo: uncomment this for S7/S9
+                    type = miner[5]
+                    if not type:
+                        prof_eqp.append(miner[2])
+                        prof_eqp_qty.append(miner[3])
+                    # @todo: uncomment this for S7/S9
+            prof_eqp_qty_all.append(prof_eqp_qty)
+            prof_eqp_all.append(prof_eqp)
+            try:
+                max_consumption = max(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e9 * 1.2
+                min_consumption = min(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e9 * 1.01
+                # @todo: remove this for S7/S9
+                # if len(prof_eqp) == 0:
+                #     guess_consumption = 0
+                # else:
+                #     guess_consumption = sum(prof_eqp) / len(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.1
+                # @todo: /remove this for S7/S9
+                guess_consumption = get_guess_consumption(prof_eqp, data['hash-rate'], hash_rates,
+                                                          typed_avg_effciency)  # @todo: uncomment this for S7/S9
+            # ====this=is=for=weighting===================================================
+            #                 weighted_sum = 0
+            #                 eqp_qty_this_day = 0
+            #                 # calculating the guess_consumption using the weighted average of prof_eqp efficiencies:
+            #                 for j in range(0, len(prof_eqp)):
+            #                     weighted_sum = weighted_sum + prof_eqp[j]*prof_eqp_qty[j]
+            #                     eqp_qty_this_day = eqp_qty_this_day + prof_eqp_qty[j]
+            #                 guess_consumption = weighted_sum/eqp_qty_this_day*hash_rate[i][2]*365.25*24/1e+9*1.05
+            # ===========================================================================
+            except Exception as error:  # in case if mining is not profitable (impossible to find MAX of empty list)
+                LOGGER.warning(f"Mining was unprofitable at timestamp={timestamp}: '{error}'")
+                max_consumption = max_all[-1] if len(max_all) > 0 else last_consumption[0]
+                min_consumption = min_all[-1] if len(min_all) > 0 else last_consumption[1]
+                guess_consumption = guess_all[-1] if len(guess_all) > 0 else last_consumption[2]
+            max_all.append(max_consumption)
+            min_all.append(min_consumption)
+            guess_all.append(guess_consumption)
+            ts_all.append(timestamp)
+            date = datetime.utcfromtimestamp(timestamp).isoformat()
+            prof_eqp = str(prof_eqp).strip('[]')  # making str from prof_eqp
+            prof_eqp_qty = str(prof_eqp_qty).strip('[]')
+            if timestamp >= recompute_from:
+                energy_consumption_writer.add((timestamp, date, max_consumption, min_consumption, guess_consumption,
+                                               prof_eqp, prof_eqp_qty))
+            prof_eqp = []
+            prof_eqp_qty = []
+        energy_consumption_writer.flush()
+
+        # calculating MA of the resulting stats
+        LOGGER.info(f"energy-consump-MA: as of {datetime.utcnow().isoformat()}")
+        energy_df = pd.DataFrame(list(zip(max_all, min_all, guess_all)),
+                                 index=ts_all, columns=['MAX', 'MIN', 'GUESS'])
+        energy_ma = energy_df.rolling(window=ENERGY_CONSUMPTION_MA_DAYS, min_periods=1).mean()
+
+        energy_consumption_ma_writer = BulkWriter(
+            connection, 'energy_consumption_ma',
+            ['timestamp', 'date', 'max_consumption', 'min_consumption', 'guess_consumption'],
+            create_sql="CREATE TABLE IF NOT EXISTS energy_consumption_ma (timestamp INT PRIMARY KEY, "
+                       "date TEXT, max_consumption REAL, min_consumption REAL, guess_consumption REAL);",
+            upsert=True,
+            commit=False
+        )
+
+        max_ma = list(energy_ma['MAX'])
+        min_ma = list(energy_ma['MIN'])
+        guess_ma = list(energy_ma['GUESS'])
+        ts = ts_all
+        date_all = []
+        for t in ts:
+            date = datetime.utcfromtimestamp(t).isoformat()
+            date_all.append(date)
+
+        energy_consumption_ma_writer.extend(item for item in zip(ts, date_all, max_ma, min_ma, guess_ma)
+                                            if item[0] >= recompute_from)
+        energy_consumption_ma_writer.flush()
+
+        save_watermarks(connection, 'coinmetrics', {metric: max(timestamp for timestamp, _ in values)
+                                                    for metric, values in metrics_values.items() if values})
 
 
 # =============================================================================
@@ -258,48 +324,35 @@ def hash_rate(price):
 # =============================================================================
 
 @cli.command()
-def coinmetrics():
+@click.option('--chunk-days', default=COINMETRICS_CHUNK_DAYS, show_default=True)
+def coinmetrics(chunk_days):
     LOGGER.info('coinmetrics called')
-    with psycopg2.connect(**config['blockchain_data']) as connection:
-        cursor = connection.cursor()
-
-        def save_hasrate(type, time, value, asset='btc'):
-            table_name = 'hash_rate_by_types'
-            date = parser.parse(time).date()
-
-            # Template of the query to paste a row to a table
-            insert_sql = f"INSERT INTO {table_name} (type, asset, value, date) " \
-                         f"VALUES (%s, %s, %s, %s) ON CONFLICT ON CONSTRAINT {table_name}_date_ukey DO NOTHING;"
-            try:
-                cursor.execute("CREATE TABLE IF NOT EXISTS hash_rate_by_types ("
-                               "id serial NOT NULL,"
-                               "type text NOT NULL,"
-                               "value real NOT NULL,"
-                               "date date NOT NULL,"
-                               "created_at timestamp without time zone NOT NULL DEFAULT NOW(),"
-                               "asset text NOT NULL,"
-                               "CONSTRAINT hash_rate_by_types_pkey PRIMARY KEY (id),"
-                               "CONSTRAINT hash_rate_by_types_date_ukey UNIQUE (type, date)"
-                          ");")
-                cursor.execute(insert_sql, (type, asset, value, date))
-            except Exception as error:
-                LOGGER.exception(f"{table_name}: {str(error)}")
-            finally:
-                connection.commit()
-
     api_coinmetrics = ApiCoinMetrics(api_key=config['api.coinmetrics.io']['api_key'])
     start_time = datetime(year=2014, month=1, day=1)
     metrics = {
-        's9': 'HashRate30dS9Pct',
-        's7': 'HashRate30dS7Pct'
+        'HashRate30dS9Pct': 's9',
+        'HashRate30dS7Pct': 's7'
     }
-    for t, metric in metrics.items():
-        LOGGER.info(f"hash_rate_by_types (type: {t}): as of {datetime.utcnow().isoformat()}")
-        data = api_coinmetrics.timeseries().asset_metrics(metrics=metric, start_time=start_time)
-        df = pd.DataFrame(data).sort_values(by=['time'])
-
-        for row in df.itertuples(name='Metric'):
-            save_hasrate(type=t, asset=row.asset, time=row.time, value=float(getattr(row, metric)) / 100)
+    with psycopg2.connect(**config['blockchain_data']) as connection:
+        writer = BulkWriter(connection, 'hash_rate_by_types', ['type', 'asset', 'value', 'date'], key=('type', 'date'),
+                            create_sql="CREATE TABLE IF NOT EXISTS hash_rate_by_types ("
+                                       "id serial NOT NULL,"
+                                       "type text NOT NULL,"
+                                       "value real NOT NULL,"
+                                       "date date NOT NULL,"
+                                       "created_at timestamp without time zone NOT NULL DEFAULT NOW(),"
+                                       "asset text NOT NULL,"
+                                       "CONSTRAINT hash_rate_by_types_pkey PRIMARY KEY (id),"
+                                       "CONSTRAINT hash_rate_by_types_date_ukey UNIQUE (type, date)"
+                                       ");")
+        LOGGER.info(f"hash_rate_by_types (types: {', '.join(metrics.values())}): as of {datetime.utcnow().isoformat()}")
+        # the metrics and the years are fetched concurrently, every page is written as soon as it arrives
+        pages = api_coinmetrics.timeseries().iter_asset_metrics_parallel(metrics=list(metrics), start_time=start_time,
+                                                                           chunk_days=chunk_days)
+        for metric, page in pages:
+            writer.extend((metrics[metric], row.get('asset', 'btc'), float(row[metric]) / 100,
+                           parser.parse(row['time']).date()) for row in page if row.get(metric) is not None)
+            writer.flush()
 
 
 if __name__ == '__main__':
@@ -3,9 +3,11 @@ import psycopg2
 import pandas as pd
 from datetime import datetime
 from pprint import pformat
-import requests as rq
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import click
 import yaml
+from api.bulk_writer import BulkWriter
+from api.http_client import HTTP_TIMEOUT, get_json, make_session
 
 config_path = 'CONFIG.yml'
 if config_path:
@@ -22,46 +24,71 @@ table_prefix = 'blockchain_info_'
 
 # comment
 
-def crawl(endpoint):
+BLOCKCHAIN_INFO_URL = 'https://api.blockchain.info/charts/'
+DEFAULT_CRAWL_WORKERS = 4
+PROF_THRESHOLD_INPUTS = {'miners-revenue', 'hash-rate'}
+
+
+def crawl(endpoint, session=None, base_url=BLOCKCHAIN_INFO_URL, timeout=HTTP_TIMEOUT):
     # Showing message that the scrapping started
     LOGGER.info(f"{endpoint}: Scrapping as of {datetime.utcnow().isoformat()}")
-    # Querying data from DATA_API_URL
-    re = rq.get(f"https://api.blockchain.info/charts/{endpoint}?timespan=7years")
-    # Transforming reply into the object of 'dict' type
-    data = re.json()
+    # Querying data from the charts API, the failed requests are retried by the session
+    data = get_json(session or make_session(), f"{base_url.rstrip('/')}/{endpoint}", params={'timespan': '7years'},
+                    timeout=timeout)
     LOGGER.debug(f"{endpoint}: Response:\n\n{pformat(data)}\n\n")
     return [(int(row['x']), row['y']) for row in data['values']]
 
 
-def save_values(values, connection, table_name):
-    # Creating cursor to work with DB
-    cursor = connection.cursor()
+def crawl_all(endpoints, base_url=BLOCKCHAIN_INFO_URL, workers=DEFAULT_CRAWL_WORKERS, timeout=HTTP_TIMEOUT):
+    """
+    Fetches the endpoints concurrently with one keep-alive session,
+    yields (endpoint, values) in the order the replies arrive.
+    """
+    session = make_session(pool_size=workers)
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(crawl, endpoint, session, base_url, timeout): endpoint for endpoint in endpoints}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def save_values(values, connection, table_name, upsert=False):
     # Creating table. timestamp is a PRIMARY KEY, values are unique
-    cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_prefix}{table_name}"
-                   f" (timestamp INT PRIMARY KEY, date TEXT, value REAL);")
-    # Template of the query to paste a row to a table
-    insert_sql = f"INSERT INTO {table_prefix}{table_name} (timestamp, date, value) " \
-                 f"VALUES (%s, %s, %s) ON CONFLICT ON CONSTRAINT {table_prefix}{table_name}_pkey DO NOTHING;"
-    # Taking 'values' from the API reply and inputting rows one by one
-    for timestamp, value in values:
-        # The second column is going to be date in readable format
-        date = datetime.utcfromtimestamp(timestamp).isoformat()
-        # Trying to insert row
+    writer = BulkWriter(connection, f'{table_prefix}{table_name}', ['timestamp', 'date', 'value'], upsert=upsert,
+                        create_sql=f"CREATE TABLE IF NOT EXISTS {table_prefix}{table_name}"
+                                   f" (timestamp INT PRIMARY KEY, date TEXT, value REAL);")
+    # Taking 'values' from the API reply, the second column is going to be date in readable format.
+    # All the rows are written in one transaction, the rows with existing timestamps are ignored (or updated)
+    writer.extend((timestamp, datetime.utcfromtimestamp(timestamp).isoformat(), value) for timestamp, value in values)
+    return writer.flush()
+
+
+def calc_prof_threshold(all_data, price):
+    # Profitability threshold calculation based on the miners revenue est.
+    LOGGER.info(f"prof-threshold: as of {datetime.utcnow().isoformat()}")
+    for timestamp, data in all_data.items():
         try:
-            cursor.execute(insert_sql, (timestamp, date, value))
-        # If the row with this timestamp already exist, ignore it
-        except Exception as error:
-            LOGGER.exception(f"{table_name}: {str(error)}")
+            data['prof-threshold'] = (data['miners-revenue'] /
+                                      (data['hash-rate'] * 60 * 60 * 24)) / (price / 3.6e+06) / 1000
+        except KeyError:
             pass
-        finally:
-            connection.commit()
+        except ZeroDivisionError:
+            data['prof-threshold'] = float('inf')
+            LOGGER.warning(f"Zero div: timestamp={timestamp}, data={data}")
+
+    return [(timestamp, data['prof-threshold']) for timestamp, data in all_data.items() if 'prof-threshold' in data]
 
 
 # this is to change parameters from CLI
 @click.command()
 @click.option('--price', '-p', default=DEFAULT_ELECTRICITY_PRICE)
 @click.option('--log-level', '-l', default=DEFAULT_LOG_LEVEL)
-def main(log_level, price):
+@click.option('--base-url', default=BLOCKCHAIN_INFO_URL, envvar='BLOCKCHAIN_INFO_URL', show_default=True)
+@click.option('--workers', '-w', default=DEFAULT_CRAWL_WORKERS, show_default=True)
+def main(log_level, price, base_url, workers):
     # Logging
     LOGGER.setLevel(log_level.upper())
     # Console outputs
@@ -75,22 +102,13 @@ def main(log_level, price):
     all_data = {}
     # Opening DB. When the 'with' block ends, connection will be closed
     with psycopg2.connect(**config['blockchain_data']) as connection:
-        for endpoint in ['market-price']:
-            # if you need more data, just list it here
-            values = crawl(endpoint)
-            values = values[:-1]
-            # this is because table name can't contain hyphens
-            table_name = endpoint.replace('-', '_')
-            save_values(values, connection, table_name)
-            for timestamp, value in values:
-                try:
-                    all_data[timestamp][endpoint] = value
-                except KeyError:
-                    all_data[timestamp] = {endpoint: value}
-
-        for endpoint in ['difficulty', 'hash-rate', 'miners-revenue']:
-            # if you need more data, just list it here
-            values = crawl(endpoint)
+        # if you need more data, just list it here
+        endpoints = ['market-price', 'difficulty', 'hash-rate', 'miners-revenue']
+        fetched = set()
+        # the endpoints are fetched concurrently, each reply is saved as soon as it arrives
+        for endpoint, values in crawl_all(endpoints, base_url, workers):
+            if endpoint == 'market-price':
+                values = values[:-1]
             # this is because table name can't contain hyphens
             table_name = endpoint.replace('-', '_')
             save_values(values, connection, table_name)
@@ -99,6 +117,12 @@ def main(log_level, price):
                     all_data[timestamp][endpoint] = value
                 except KeyError:
                     all_data[timestamp] = {endpoint: value}
+            fetched.add(endpoint)
+            # the threshold only needs these two, it is computed while the other endpoints are still being fetched
+            if endpoint in PROF_THRESHOLD_INPUTS and PROF_THRESHOLD_INPUTS <= fetched:
+                save_values(calc_prof_threshold(all_data, price), connection, 'prof_threshold')
+        # the replies arrive in any order, the moving averages below need the days in order
+        all_data = dict(sorted(all_data.items()))
 
         # =============================================================================
         #        # This is to create block reward time series
@@ -135,119 +159,93 @@ def main(log_level, price):
         #                    connection, 'prof_threshold_block_reward_only')
         # =============================================================================
 
-        # Profitability threshold calculation based on the miners revenue est.
-        LOGGER.info(f"prof-threshold: as of {datetime.utcnow().isoformat()}")
-        for timestamp, data in all_data.items():
-            try:
-                data['prof-threshold'] = (data['miners-revenue'] /
-                                          (data['hash-rate'] * 60 * 60 * 24)) / (price / 3.6e+06) / 1000
-            except KeyError:
-                pass
-            except ZeroDivisionError:
-                data['prof-threshold'] = float('inf')
-                LOGGER.warning(f"Zero div: timestamp={timestamp}, data={data}")
-
-        save_values(((timestamp, data['prof-threshold']) for timestamp, data
-                     in all_data.items() if 'prof-threshold' in data),
-                    connection, 'prof_threshold')
-
         # Calculating energy consumption
         LOGGER.info(f"energy-consumption: as of {datetime.utcnow().isoformat()}")
-        with connection.cursor() as c:
-            # Creating table. timestamp is a PRIMARY KEY, values are unique
-            c.execute(f"CREATE TABLE IF NOT EXISTS {table_prefix}energy_consumption (timestamp "
-                      "INT PRIMARY KEY, date TEXT, max_consumption REAL, min_consumption REAL, "
-                      "guess_consumption REAL, all_prof_eqp TEXT, all_prof_eqp_qty TEXT);")
-            # Template of the query to paste a row to a table
-            insert_sql = f"INSERT INTO {table_prefix}energy_consumption (timestamp, date, max_consumption, " \
-                         "min_consumption, guess_consumption, all_prof_eqp, all_prof_eqp_qty) " \
-                         "VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT ON CONSTRAINT " \
-                         f"{table_prefix}energy_consumption_pkey DO NOTHING;"
-            prof_eqp = []  # temp var for list of profit. eqp efficiency
-            prof_eqp_all = []  # list of lists of profit. eqp efficiency
-            prof_eqp_qty = []  # temp var for the list of profit. eqp qty
-            prof_eqp_qty_all = []  # list of lists of profitable equipment qty
-            max_all = []
-            min_all = []
-            guess_all = []
-            ts_all = []
+        # timestamp is a PRIMARY KEY, values are unique. The rows are written in one transaction after the loop
+        energy_consumption_writer = BulkWriter(
+            connection, f'{table_prefix}energy_consumption',
+            ['timestamp', 'date', 'max_consumption', 'min_consumption', 'guess_consumption', 'all_prof_eqp',
+             'all_prof_eqp_qty'],
+            create_sql=f"CREATE TABLE IF NOT EXISTS {table_prefix}energy_consumption (timestamp "
+                       "INT PRIMARY KEY, date TEXT, max_consumption REAL, min_consumption REAL, "
+                       "guess_consumption REAL, all_prof_eqp TEXT, all_prof_eqp_qty TEXT);"
+        )
+        prof_eqp = []  # temp var for list of profit. eqp efficiency
+        prof_eqp_all = []  # list of lists of profit. eqp efficiency
+        prof_eqp_qty = []  # temp var for the list of profit. eqp qty
+        prof_eqp_qty_all = []  # list of lists of profitable equipment qty
+        max_all = []
+        min_all = []
+        guess_all = []
+        ts_all = []
 
-            data_df = pd.DataFrame.from_dict(all_data, orient='index')
-            data_ma = data_df.rolling(window=14, min_periods=1).mean()
+        data_df = pd.DataFrame.from_dict(all_data, orient='index')
+        data_ma = data_df.rolling(window=14, min_periods=1).mean()
 
-            for timestamp, data in all_data.items():
-                for miner in miners:
-                    if timestamp > miner[1] and data_ma['prof-threshold'][timestamp] > miner[2]:
-                        # ^^current date and date of miner release ^^checks if miner is profitable;
-                        # if yes, adds miner's efficiency and qty to the lists:
-                        prof_eqp.append(miner[2])
-                        prof_eqp_qty.append(miner[3])
-                prof_eqp_qty_all.append(prof_eqp_qty)
-                prof_eqp_all.append(prof_eqp)
-                try:
-                    max_consumption = max(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.2
-                    min_consumption = min(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.01
-                    guess_consumption = sum(prof_eqp) / len(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.1
-                # ====this=is=for=weighting===================================================
-                #                 weighted_sum = 0
-                #                 eqp_qty_this_day = 0
-                #                 # calculating the guess_consumption using the weighted average of prof_eqp efficiencies:
-                #                 for j in range(0, len(prof_eqp)):
-                #                     weighted_sum = weighted_sum + prof_eqp[j]*prof_eqp_qty[j]
-                #                     eqp_qty_this_day = eqp_qty_this_day + prof_eqp_qty[j]
-                #                 guess_consumption = weighted_sum/eqp_qty_this_day*hash_rate[i][2]*365.25*24/1e+9*1.05
-                # ===========================================================================
-                except Exception as error:  # in case if mining is not profitable (impossible to find MAX of empty list)
-                    LOGGER.warning(f"Mining was unprofitable at timestamp={timestamp}: '{error}'")
-                    max_consumption = max_all[-1]
-                    min_consumption = min_all[-1]
-                    guess_consumption = guess_all[-1]
-                max_all.append(max_consumption)
-                min_all.append(min_consumption)
-                guess_all.append(guess_consumption)
-                ts_all.append(timestamp)
-                date = datetime.utcfromtimestamp(timestamp).isoformat()
-                prof_eqp = str(prof_eqp).strip('[]')  # making str from prof_eqp
-                prof_eqp_qty = str(prof_eqp_qty).strip('[]')
-                try:
-                    c.execute(insert_sql, (timestamp, date, max_consumption,
-                                           min_consumption, guess_consumption,
+        for timestamp, data in all_data.items():
+            for miner in miners:
+                if timestamp > miner[1] and data_ma['prof-threshold'][timestamp] > miner[2]:
+                    # ^^current date and date of miner release ^^checks if miner is profitable;
+                    # if yes, adds miner's efficiency and qty to the lists:
+                    prof_eqp.append(miner[2])
+                    prof_eqp_qty.append(miner[3])
+            prof_eqp_qty_all.append(prof_eqp_qty)
+            prof_eqp_all.append(prof_eqp)
+            try:
+                max_consumption = max(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.2
+                min_consumption = min(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.01
+                guess_consumption = sum(prof_eqp) / len(prof_eqp) * data['hash-rate'] * 365.25 * 24 / 1e+9 * 1.1
+            # ====this=is=for=weighting===================================================
+            #                 weighted_sum = 0
+            #                 eqp_qty_this_day = 0
+            #                 # calculating the guess_consumption using the weighted average of prof_eqp efficiencies:
+            #                 for j in range(0, len(prof_eqp)):
+            #                     weighted_sum = weighted_sum + prof_eqp[j]*prof_eqp_qty[j]
+            #                     eqp_qty_this_day = eqp_qty_this_day + prof_eqp_qty[j]
+            #                 guess_consumption = weighted_sum/eqp_qty_this_day*hash_rate[i][2]*365.25*24/1e+9*1.05
+            # ===========================================================================
+            except Exception as error:  # in case if mining is not profitable (impossible to find MAX of empty list)
+                LOGGER.warning(f"Mining was unprofitable at timestamp={timestamp}: '{error}'")
+                max_consumption = max_all[-1]
+                min_consumption = min_all[-1]
+                guess_consumption = guess_all[-1]
+            max_all.append(max_consumption)
+            min_all.append(min_consumption)
+            guess_all.append(guess_consumption)
+            ts_all.append(timestamp)
+            date = datetime.utcfromtimestamp(timestamp).isoformat()
+            prof_eqp = str(prof_eqp).strip('[]')  # making str from prof_eqp
+            prof_eqp_qty = str(prof_eqp_qty).strip('[]')
+            energy_consumption_writer.add((timestamp, date, max_consumption, min_consumption, guess_consumption,
                                            prof_eqp, prof_eqp_qty))
-                # If the row with this timestamp already exist, ignore it:
-                except Exception as error:
-                    LOGGER.warning(f"Energy consumption saving error at "
-                                   f"timestamp={timestamp}: '{error}'")
-                    pass
-                prof_eqp = []
-                prof_eqp_qty = []
+            prof_eqp = []
+            prof_eqp_qty = []
+        energy_consumption_writer.flush()
 
-            # calculating MA of the resulting stats
-            LOGGER.info(f"energy-consump-MA: as of {datetime.utcnow().isoformat()}")
-            energy_df = pd.DataFrame(list(zip(max_all, min_all, guess_all)),
-                                     index=ts_all, columns=['MAX', 'MIN', 'GUESS'])
-            energy_ma = energy_df.rolling(window=7, min_periods=1).mean()
+        # calculating MA of the resulting stats
+        LOGGER.info(f"energy-consump-MA: as of {datetime.utcnow().isoformat()}")
+        energy_df = pd.DataFrame(list(zip(max_all, min_all, guess_all)),
+                                 index=ts_all, columns=['MAX', 'MIN', 'GUESS'])
+        energy_ma = energy_df.rolling(window=7, min_periods=1).mean()
 
-            c.execute(f"CREATE TABLE IF NOT EXISTS {table_prefix}energy_consumption_ma (timestamp INT PRIMARY KEY, "
-                      "date TEXT, max_consumption REAL, min_consumption REAL, guess_consumption REAL);")
-            insert_sql = f"INSERT INTO {table_prefix}energy_consumption_ma (timestamp, date, max_consumption, " \
-                         "min_consumption, guess_consumption) VALUES (%s, %s, %s, %s, %s) " \
-                         f"ON CONFLICT ON CONSTRAINT {table_prefix}energy_consumption_ma_pkey DO NOTHING;"
+        energy_consumption_ma_writer = BulkWriter(
+            connection, f'{table_prefix}energy_consumption_ma',
+            ['timestamp', 'date', 'max_consumption', 'min_consumption', 'guess_consumption'],
+            create_sql=f"CREATE TABLE IF NOT EXISTS {table_prefix}energy_consumption_ma (timestamp INT PRIMARY KEY, "
+                       "date TEXT, max_consumption REAL, min_consumption REAL, guess_consumption REAL);"
+        )
 
-            max_ma = list(energy_ma['MAX'])
-            min_ma = list(energy_ma['MIN'])
-            guess_ma = list(energy_ma['GUESS'])
-            ts = ts_all
-            date_all = []
-            for t in ts:
-                date = datetime.utcfromtimestamp(t).isoformat()
-                date_all.append(date)
+        max_ma = list(energy_ma['MAX'])
+        min_ma = list(energy_ma['MIN'])
+        guess_ma = list(energy_ma['GUESS'])
+        ts = ts_all
+        date_all = []
+        for t in ts:
+            date = datetime.utcfromtimestamp(t).isoformat()
+            date_all.append(date)
 
-            for item in zip(ts, date_all, max_ma, min_ma, guess_ma):
-                try:
-                    c.execute(insert_sql, item)
-                except Exception as error:
-                    LOGGER.warning(f"Energy consumption MA saving err: {error}'")
-                    pass
+        energy_consumption_ma_writer.extend(zip(ts, date_all, max_ma, min_ma, guess_ma))
+        energy_consumption_ma_writer.flush()
 
 
 # =============================================================================
@@ -0,0 +1 @@
+from api.extensions import *
\ No newline at end of file